@@ -0,0 +1,201 @@
+# backend/admission.py
+#
+# /chat 生成请求的准入控制 (本地只有一个 Ollama 实例)。
+#   - 同时进行的生成数不超过 max_concurrent (与模型的并行能力一致，例如 OLLAMA_NUM_PARALLEL)，
+#     多出的请求排队，而不是同时涌向模型使所有回复一起变慢、甚至超时；
+#   - 队列按到达顺序 (FIFO) 放行，但按参与者轮转：同一参与者同时最多一个生成，且已有请求在进行或排队的
+#     参与者的新请求排在其他参与者之后 (每个请求的 round = 该参与者已有的请求数，队列按 (round, 到达顺序) 排列)，
+#     单个参与者连续发送不会占用多个名额或挤占其他人；
+#   - 排队超过 max_wait_s 秒、或队列已满时立即失败 (AdmissionError)，不会无限等待；
+#   - 等待期间每当排队位置变化 (以及每隔 HEARTBEAT_S 秒)，wait() / wait_async() 产出当前位置 (1 表示下一个)，
+#     由调用方告知客户端；定期产出也让调用方能及时发现排队期间断开的客户端。
+# 同一个控制器同时支持线程 (WSGI) 和 asyncio (ASGI) 调用方。
+
+import asyncio
+import threading
+import time
+from typing import NamedTuple
+
+HEARTBEAT_S = 5.0
+
+
+class AdmissionError(Exception):
+    """排队超时 (reason="timeout") 或队列已满 (reason="queue_full")"""
+
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class QueuePosition(NamedTuple):
+    """排队期间流式生成器产出的位置更新 (与回复的 bytes 片段区分)"""
+    position: int
+
+
+class Ticket:
+    """一个生成请求的排队凭证"""
+    __slots__ = ("participant_id", "round", "enqueued_at", "admitted_at", "released", "_event", "_loop")
+
+    def __init__(self, participant_id: str, loop=None):
+        self.participant_id = participant_id
+        self.round = 0
+        self.enqueued_at = time.monotonic()
+        self.admitted_at = None
+        self.released = False
+        self._loop = loop
+        self._event = asyncio.Event() if loop is not None else threading.Event()
+
+    @property
+    def admitted(self) -> bool:
+        return self.admitted_at is not None
+
+    @property
+    def wait_s(self) -> float:
+        return (self.admitted_at or time.monotonic()) - self.enqueued_at
+
+    def wake(self):
+        if self._loop is None:
+            self._event.set()
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:  # 事件循环已关闭
+            pass
+
+
+class AdmissionController:
+    """max_concurrent 为 0 时不限制 (所有请求立即放行)"""
+
+    def __init__(self, max_concurrent: int, max_wait_s: float, max_queue: int):
+        self.max_concurrent = max_concurrent
+        self.max_wait_s = max_wait_s
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._waiting = []  # 按到达顺序排队的 Ticket
+        self._active = {}   # participant_id -> 进行中的生成数
+        self._active_total = 0
+
+    # --- 状态 (用于 /metrics 和提前拒绝) ---
+    def active_count(self) -> int:
+        return self._active_total
+
+    def waiting_count(self) -> int:
+        return len(self._waiting)
+
+    def is_full(self) -> bool:
+        """没有空闲名额且队列已满 (新请求会被立即拒绝)"""
+        return self.max_concurrent > 0 and self._active_total >= self.max_concurrent \
+            and len(self._waiting) >= self.max_queue
+
+    # --- 排队和放行 ---
+    def enter(self, participant_id: str, loop=None) -> Ticket:
+        """
+        申请一个生成名额；有空闲名额时立即放行，否则排队。
+        loop 为 asyncio 事件循环时，使用 wait_async() 等待。队列已满时抛出 AdmissionError。
+        """
+        ticket = Ticket(participant_id, loop)
+        with self._lock:
+            if self.max_concurrent <= 0:
+                self._admit_locked(ticket)
+                return ticket
+            if len(self._waiting) >= self.max_queue:
+                raise AdmissionError(f"the assistant is busy ({len(self._waiting)} requests waiting), "
+                                     f"please try again in a moment", "queue_full")
+            ticket.round = self._active.get(participant_id, 0) + sum(
+                1 for t in self._waiting if t.participant_id == participant_id)
+            i = len(self._waiting)
+            while i > 0 and self._waiting[i - 1].round > ticket.round:
+                i -= 1
+            self._waiting.insert(i, ticket)
+            self._dispatch_locked()
+        return ticket
+
+    def release(self, ticket: Ticket):
+        """生成结束 (或放弃排队) 时调用；可以重复调用"""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.admitted:
+                remaining = self._active.get(ticket.participant_id, 0) - 1
+                if remaining > 0:
+                    self._active[ticket.participant_id] = remaining
+                else:
+                    self._active.pop(ticket.participant_id, None)
+                self._active_total -= 1
+            else:
+                self._waiting.remove(ticket)
+            self._dispatch_locked()
+
+    def position(self, ticket: Ticket) -> int:
+        """排队位置 (1 表示下一个)；已放行时为 0"""
+        with self._lock:
+            return self._position_locked(ticket)
+
+    def _position_locked(self, ticket: Ticket) -> int:
+        if ticket.admitted:
+            return 0
+        return self._waiting.index(ticket) + 1
+
+    def _admit_locked(self, ticket: Ticket):
+        ticket.admitted_at = time.monotonic()
+        self._active[ticket.participant_id] = self._active.get(ticket.participant_id, 0) + 1
+        self._active_total += 1
+
+    def _dispatch_locked(self):
+        """按队列顺序放行 (跳过已有生成在进行的参与者)，并唤醒所有等待者更新位置"""
+        i = 0
+        while self._active_total < self.max_concurrent and i < len(self._waiting):
+            ticket = self._waiting[i]
+            if self._active.get(ticket.participant_id):
+                i += 1
+                continue
+            del self._waiting[i]
+            self._admit_locked(ticket)
+            ticket.wake()
+        for ticket in self._waiting:
+            ticket.wake()
+
+    def _check_locked(self, ticket: Ticket):
+        """返回 (已放行, 位置, 剩余等待秒数)；超时时移出队列并抛出 AdmissionError"""
+        if ticket.admitted:
+            return True, 0, 0.0
+        remaining = self.max_wait_s - ticket.wait_s
+        if remaining <= 0:
+            ticket.released = True
+            self._waiting.remove(ticket)
+            self._dispatch_locked()
+            raise AdmissionError(f"the assistant is busy (waited {ticket.wait_s:.1f}s in the queue), "
+                                 f"please try again in a moment", "timeout")
+        return False, self._position_locked(ticket), remaining
+
+    def wait(self, ticket: Ticket):
+        """等待放行 (线程)；排队位置变化时 (以及每隔 HEARTBEAT_S 秒) 产出当前位置。超时抛出 AdmissionError"""
+        last_position, last_yield = None, 0.0
+        while True:
+            with self._lock:
+                admitted, position, remaining = self._check_locked(ticket)
+            if admitted:
+                return
+            if position != last_position or time.monotonic() - last_yield >= HEARTBEAT_S:
+                last_position, last_yield = position, time.monotonic()
+                yield position
+            ticket._event.wait(min(remaining, HEARTBEAT_S))
+            ticket._event.clear()
+
+    async def wait_async(self, ticket: Ticket):
+        """wait() 的 asyncio 版本 (ticket 需要用 enter(..., loop) 创建)"""
+        last_position, last_yield = None, 0.0
+        while True:
+            with self._lock:
+                admitted, position, remaining = self._check_locked(ticket)
+            if admitted:
+                return
+            if position != last_position or time.monotonic() - last_yield >= HEARTBEAT_S:
+                last_position, last_yield = position, time.monotonic()
+                yield position
+            try:
+                await asyncio.wait_for(ticket._event.wait(), min(remaining, HEARTBEAT_S))
+            except asyncio.TimeoutError:
+                pass
+            ticket._event.clear()
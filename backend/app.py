@@ -1,33 +1,145 @@
-from flask import Flask, request, jsonify, Response, send_from_directory, render_template_string, redirect, url_for
+from flask import Flask, request, jsonify, Response, send_from_directory, render_template, redirect, url_for, g
 from flask_cors import CORS
+from jinja2 import FileSystemBytecodeCache, TemplateNotFound
 import os
-import json
 import time
 from datetime import datetime
 import csv
 
 from backend import llm_service
 from backend import data_manager
-from backend.config import VERSION_MAP, EXPERIMENT_STEPS, INSTRUCTION_VERSION_MAP
+from backend import chat_stream
+from backend import metrics
+from backend.config import EXPERIMENT_STEPS, TEMPLATE_AUTO_RELOAD, TEMPLATE_BYTECODE_CACHE_DIR, STATIC_AUTO_RELOAD, \
+    PAGE_CACHE_SIZE, CHAT_STREAM_COALESCE_BYTES, CHAT_STREAM_COALESCE_MS, SENTIMENT_LEXICON_PATH, \
+    SENTIMENT_WORKER_THREADS, SENTIMENT_BATCH_SIZE, SENTIMENT_WAIT_TIMEOUT, WASHOUT_SECONDS
 from backend.localization import get_localization_for_page
+from backend.routing import ROUTES
+from backend.static_files import StaticFileCache
+from backend.page_cache import RenderedPageCache
+from backend.admission import QueuePosition
+from backend.sentiment import SentimentWorker, load_engine, label_for
+from backend.token_counter import count_tokens, TOKEN_COUNT_METHOD
 
 # --- Flask App Setup ---
 project_root = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.dirname(project_root)
-app = Flask(__name__, static_folder=project_root)
+# 模板 (index.html 和 html/*.html) 通过 Flask 的 Jinja 环境加载：每个模板只编译一次并缓存，
+# 之后的页面请求只做变量替换。模板名相对于项目根目录，例如 "html/debrief.html"。
+app = Flask(__name__, static_folder=project_root, template_folder=project_root)
+app.config["TEMPLATES_AUTO_RELOAD"] = TEMPLATE_AUTO_RELOAD  # 开发模式下按 mtime 重新加载修改过的模板
+if TEMPLATE_BYTECODE_CACHE_DIR:
+    # 编译结果保存在磁盘上，进程重启时跳过编译
+    os.makedirs(TEMPLATE_BYTECODE_CACHE_DIR, exist_ok=True)
+    app.jinja_options = {**app.jinja_options, "bytecode_cache": FileSystemBytecodeCache(TEMPLATE_BYTECODE_CACHE_DIR)}
 CORS(app)
 
 data_manager.create_data_dir()
 
 
-# (calculate_text_metrics 保持不变)
-def calculate_text_metrics(text: str) -> dict:
-    """计算字符数、词数和模拟的 token 数"""
+def _template_name(template_file_name: str) -> str:
+    """页面文件名 -> 模板名 (index.html 在项目根目录，其余页面在 html/ 下)"""
+    if template_file_name == 'index.html':
+        return template_file_name
+    return f"html/{template_file_name}"
+
+
+def precompile_templates():
+    """启动时编译所有页面模板，第一次访问页面时不再需要解析"""
+    names = ['index.html'] + sorted(
+        name for name in os.listdir(os.path.join(project_root, 'html')) if name.endswith('.html'))
+    compiled = 0
+    for name in names:
+        try:
+            app.jinja_env.get_template(_template_name(name))
+            compiled += 1
+        except Exception as e:
+            print(f"⚠️ Failed to precompile template {name}: {e}")
+    print(f"✅ Precompiled {compiled} page templates")
+
+
+# 静态文件缓存 (ETag / 304 / 预压缩)；页面通过 asset_url() 引用带内容哈希的 URL
+static_assets = StaticFileCache(os.path.join(project_root, 'assets'), auto_reload=STATIC_AUTO_RELOAD)
+static_pages = StaticFileCache(os.path.join(project_root, 'html'), include={'admin_setup.html'},
+                               auto_reload=STATIC_AUTO_RELOAD)
+
+
+@app.template_global()
+def asset_url(filename: str) -> str:
+    """模板中使用: {{ asset_url('favicon.svg') }} -> /assets/favicon.svg?v=<hash>"""
+    return static_assets.asset_url('/assets', filename)
+
+
+precompile_templates()
+
+# 已渲染页面的缓存 (页面中的 asset_url 在开发模式下可能随静态文件变化，此时不缓存)
+page_cache = RenderedPageCache(0 if STATIC_AUTO_RELOAD else PAGE_CACHE_SIZE)
+
+# --- 指标 (本地 /metrics，Prometheus 文本格式) ---
+# 快速路由 (页面、静态文件、保存数据) 使用细粒度的分桶；/chat 包含整个生成过程，使用延迟分桶
+_SLOW_ROUTES = ("/chat", "/end_dialogue")
+_template_render_ms = metrics.histogram("template_render_ms", metrics.FAST_BUCKETS_MS,
+                                        "Jinja render time for page cache misses")
+_page_cache_hits = metrics.counter("page_cache_requests_total", "Rendered page cache lookups", {"result": "hit"})
+_page_cache_misses = metrics.counter("page_cache_requests_total", "Rendered page cache lookups", {"result": "miss"})
+chat_active_streams = metrics.gauge("chat_active_streams", "Chat replies currently streaming")
+metrics.gauge("llm_sessions", "Participant sessions held by the session store").set_function(
+    lambda: len(llm_service.session_store))
+metrics.gauge("summary_jobs_pending", "Summary jobs queued or running").set_function(
+    llm_service.summary_worker.pending_count)
+metrics.gauge("record_writer_queue_depth", "JSONL records waiting for the background writer").set_function(
+    data_manager.pending_records)
+metrics.gauge("page_cache_entries", "Rendered pages held in the page cache").set_function(lambda: len(page_cache))
+
+
+def observe_request(route: str, method: str, status: int, elapsed_ms: float):
+    """记录一次请求的耗时和状态码 (WSGI 和 ASGI 模式共用)"""
+    buckets = metrics.LATENCY_BUCKETS_MS if route in _SLOW_ROUTES else metrics.FAST_BUCKETS_MS
+    metrics.histogram("http_request_duration_ms", buckets, "Request duration (streamed responses until the stream ends)",
+                      {"route": route, "method": method}).observe(elapsed_ms)
+    metrics.counter("http_requests_total", "Requests by route and status code",
+                    {"route": route, "status": str(status)}).inc()
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def _record_request_metrics(response):
+    start = g.pop("request_start", None)
+    if start is not None:
+        # 使用路由规则而不是实际路径 (避免参与者 ID 等造成无限多的标签组合)
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        method, status = request.method, response.status_code
+        if response.is_streamed:
+            # 流式响应 (/chat) 计时到流结束为止，与 ASGI 模式一致
+            response.call_on_close(
+                lambda: observe_request(route, method, status, (time.perf_counter() - start) * 1000))
+        else:
+            observe_request(route, method, status, (time.perf_counter() - start) * 1000)
+    return response
+
+
+@app.route('/metrics')
+def serve_metrics():
+    """Prometheus 文本格式的指标，只允许本机访问"""
+    if request.remote_addr not in ("127.0.0.1", "::1"):
+        return Response("Forbidden", status=403, mimetype='text/plain')
+    return Response(metrics.render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+def calculate_text_metrics(text: str, token_count: int = None) -> dict:
+    """
+    计算字符数、词数和 token 数。
+    token_count 为已知的 token 数 (例如 Ollama 的 eval_count)；未提供时用分词器统计 (见 token_counter.py)。
+    """
     text = text.strip()
     char_count = len(text)
     word_count = len(text.split())
-    # 模拟 token 计数: 假设一个字符平均 1/3 个 token
-    token_count = max(1, int(char_count / 3))
+    if token_count is None:
+        token_count = count_tokens(text)
 
     return {
         "length_char": char_count,
@@ -40,29 +152,39 @@ def calculate_text_metrics(text: str) -> dict:
 def render_template_page(template_file_name: str, module_name: str, participant_id: str, context: dict = None):
     """
     根据受试者ID从状态中获取语言，然后用正确的本地化文本和附加 context 渲染 HTML 模板。
+    相同输入的渲染结果会被缓存；浏览器带着匹配的 If-None-Match 重新请求时返回 304。
     """
     language = data_manager.get_participant_language(participant_id)
     strings = get_localization_for_page(module_name, language)
 
-    # 确定文件路径
-    if template_file_name == 'index.html':
-        file_path = os.path.join(app.static_folder, template_file_name)
-    else:
-        file_path = os.path.join(app.static_folder, 'html', template_file_name)
-
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            html_content = f.read()
-    except FileNotFoundError:
+        template = app.jinja_env.get_template(_template_name(template_file_name))
+    except TemplateNotFound:
         return Response(f"Template not found: {template_file_name}", status=404)
 
-    # 合并 context 变量
-    render_context = {"strings": strings}
-    if context:
-        render_context.update(context)
+    cache_key = page_cache.make_key(template_file_name, module_name, language, context)
+    page = page_cache.get(cache_key, template, strings)
+    if page is None:
+        _page_cache_misses.inc()
+        # 合并 context 变量
+        render_context = {"strings": strings}
+        if context:
+            render_context.update(context)
+
+        # 使用已编译的模板渲染
+        start = time.perf_counter()
+        html = render_template(template, **render_context)
+        _template_render_ms.observe((time.perf_counter() - start) * 1000)
+        page = page_cache.put(cache_key, template, strings, html)
+    else:
+        _page_cache_hits.inc()
 
-    # 使用 render_template_string 渲染
-    return render_template_string(html_content, **render_context)
+    # 页面取决于参与者当前的步骤，浏览器每次都需要验证 (no-cache)，但内容未变时只返回 304
+    headers = {"ETag": page.etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("If-None-Match", "")
+    if page.etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status=304, headers=headers)
+    return Response(page.html, mimetype="text/html", headers=headers)
 
 
 # --- 静态文件服务路由 ---
@@ -111,13 +233,8 @@ def redirect_to_expected_step(participant_id: str, status: dict = None):
     expected_index = status.get("current_step_index", -1)
     condition = status.get("condition", "NON_XAI")  # 获取当前条件
 
-    if expected_index == -1:
-        expected_url = f"/index.html?pid={participant_id}"
-    elif expected_index >= len(EXPERIMENT_STEPS):  # 超出范围，去 Debrief
-        expected_url = f"/html/debrief.html?pid={participant_id}"
-    else:
-        expected_step_key = EXPERIMENT_STEPS[expected_index]
-        expected_url = get_url_for_step(expected_step_key, condition, participant_id)
+    # 超出范围时为 Debrief，-1 (或无效索引) 时为 Consent 页面
+    expected_url = ROUTES.route(expected_index, condition).url(participant_id)
 
     print(f"🔄 Redirecting PID {participant_id} to expected step {expected_index} at {expected_url}")
     return redirect(expected_url)
@@ -125,32 +242,8 @@ def redirect_to_expected_step(participant_id: str, status: dict = None):
 
 # --- NEW HELPER: Get URL for a step key ---
 def get_url_for_step(step_key: str, condition: str, participant_id: str) -> str:
-    """根据步骤 Key 和当前条件确定正确的 URL"""
-    if step_key == "INSTRUCTIONS_1" or step_key == "INSTRUCTIONS_2":
-        # Instruction 页面的 URL 取决于 *当前* 条件
-        url_path = INSTRUCTION_VERSION_MAP.get(condition, INSTRUCTION_VERSION_MAP["NON_XAI"])
-    elif step_key == "DIALOGUE_1" or step_key == "DIALOGUE_2":
-        # Dialogue 页面的 URL 也取决于 *当前* 条件
-        url_path = VERSION_MAP.get(condition, VERSION_MAP["NON_XAI"])
-    elif step_key == "POST_QUESTIONNAIRE_1" or step_key == "POST_QUESTIONNAIRE_2":
-        url_path = "/html/post_questionnaire.html"  # 两个问卷使用同一个文件
-    elif step_key == "WASHOUT":
-        url_path = "/html/washout.html"
-    elif step_key == "OPEN_ENDED_QS":
-        url_path = "/html/open_ended_qs.html"
-    elif step_key == "DEBRIEF":
-        url_path = "/html/debrief.html"
-    # 处理流程开始的几个页面
-    elif step_key == "DEMOGRAPHICS":
-        url_path = "/html/demographics.html"
-    elif step_key == "BASELINE_MOOD":
-        url_path = "/html/baseline_mood.html"
-    else:
-        # Fallback or error case? Default to debrief?
-        print(f"⚠️ Unknown step key encountered: {step_key}. Defaulting to debrief.")
-        url_path = "/html/debrief.html"
-
-    return f"{url_path}?pid={participant_id}"
+    """根据步骤 Key 和当前条件确定正确的 URL (Instruction / Dialogue 页面取决于 *当前* 条件)"""
+    return ROUTES.route_for_step(step_key, condition).url(participant_id)
 
 
 # --- MAJOR REWRITE: serve_html (核心流程控制) ---
@@ -169,6 +262,9 @@ def serve_html(filename):
             print(f"🚫 Access Denied: Participant {participant_id} tried to access admin_setup.html")
             return "Access Denied: Participants cannot access this page.", 403
         else:  # 允许实验者访问
+            response = static_pages.response(filename, request)
+            if response is not None:
+                return response
             return send_from_directory(os.path.join(app.static_folder, 'html'), filename)
 
     # 2. 如果没有 PID 就试图访问任何其他 HTML 页面，踢回 admin 设置
@@ -197,37 +293,22 @@ def serve_html(filename):
                 print(f"⚠️ Invalid state index {expected_index} for PID {participant_id}. Redirecting.")
                 return redirect_to_expected_step(participant_id, status)
 
-        # 获取预期的步骤 Key 和对应的 URL
-        expected_step_key = EXPERIMENT_STEPS[expected_index]
-        expected_url = get_url_for_step(expected_step_key, current_condition, participant_id)
-        # 从 URL 中提取预期的文件名 (移除查询参数)
-        expected_filename = expected_url.split('?')[0].split('/')[-1]
+        # 获取预期的步骤 (URL、文件名和 localization 模块名都来自路由表)
+        route = ROUTES.route(expected_index, current_condition)
+        if route is ROUTES.consent:  # 无效的步骤索引 (Consent 页面由 serve_index 处理)
+            print(f"⚠️ Invalid state index {expected_index} for PID {participant_id}. Redirecting.")
+            return redirect(route.url(participant_id))
+        expected_step_key = route.step_key
+        expected_filename = route.filename
+        module_name = route.module
 
         # 检查请求的文件名是否与预期匹配
         if filename != expected_filename:
             print(
-                f"⚠️ Access Violation: PID {participant_id} requested {filename} but expected {expected_filename} (step {expected_index}). Redirecting.")
-            return redirect(expected_url)
+                f"⚠️ Access Violation: PID {participant_id} requested {filename} (steps {ROUTES.steps_for_filename(filename)}) but expected {expected_filename} (step {expected_index}). Redirecting.")
+            return redirect(route.url(participant_id))
 
         # --- 验证通过 ---
-        # 确定 localization 模块名
-        module_name = "unknown"
-        if expected_step_key.startswith("DEMOGRAPHICS"):
-            module_name = "demographics"
-        elif expected_step_key.startswith("BASELINE_MOOD"):
-            module_name = "baseline_mood"
-        elif expected_step_key.startswith("INSTRUCTIONS"):
-            module_name = "instructions"
-        elif expected_step_key.startswith("DIALOGUE"):
-            module_name = "chat_interface"
-        elif expected_step_key.startswith("POST_QUESTIONNAIRE"):
-            module_name = "post_questionnaire"
-        elif expected_step_key.startswith("WASHOUT"):
-            module_name = "washout"
-        elif expected_step_key.startswith("OPEN_ENDED_QS"):
-            module_name = "open_ended_qs"
-        elif expected_step_key.startswith("DEBRIEF"):
-            module_name = "debrief"
 
         # 准备注入的 context
         context = {
@@ -242,6 +323,8 @@ def serve_html(filename):
             button_key = "continue_to_washout" if next_step_is_washout else "continue_to_open_ended"
             # (假设 localization.py 中添加了这两个 key)
             # context["button_text"] = get_localization_for_page(module_name, status.get("language","en")).get(button_key, "Continue")
+        elif expected_step_key == "WASHOUT":
+            context["washout_seconds"] = WASHOUT_SECONDS  # 页面倒计时与后端校验一致
 
         # 渲染预期的页面
         return render_template_page(expected_filename, module_name, participant_id, context=context)
@@ -254,10 +337,13 @@ def serve_html(filename):
         return "An error occurred during state validation.", 500
 
 
-# (serve_assets 保持不变)
+# --- MODIFIED: serve_assets (内存缓存 + 条件请求 + 预压缩) ---
 @app.route('/assets/<path:filename>')
 def serve_assets(filename):
-    """服务 assets 目录下的静态文件"""
+    """服务 assets 目录下的静态文件 (优先使用内存缓存，支持 304 和压缩)"""
+    response = static_assets.response(filename, request)
+    if response is not None:
+        return response
     return send_from_directory(os.path.join(app.static_folder, 'assets'), filename)
 
 
@@ -315,9 +401,11 @@ def save_data():
         if not participant_id or not step_name or step_data is None or current_step_index is None:
             return jsonify({"error": "Missing required fields"}), 400
 
+        # 只读取一次状态；所有状态修改在下面的第 3 步中一次性写入
+        status = data_manager.get_participant_status(participant_id)
+
         # --- (NEW) Washout 验证 ---
         if step_name == "WASHOUT":
-            status = data_manager.get_participant_status(participant_id)
             start_ts = status.get("washout_start_ts")
             if not start_ts:  # 如果没有开始时间戳 (不应发生)
                 print(f"Error: Washout start timestamp missing for {participant_id}")
@@ -325,25 +413,23 @@ def save_data():
 
             duration = time.time() - start_ts
 
-            if duration < 300:  # 强制 5 分钟
+            if duration < WASHOUT_SECONDS:  # 强制 5 分钟 (见 config.WASHOUT_SECONDS)
                 print(f"Info: PID {participant_id} tried to submit Washout early ({duration:.1f}s). Denied.")
+                break_length = (f"{WASHOUT_SECONDS // 60}-minute" if WASHOUT_SECONDS % 60 == 0
+                                else f"{WASHOUT_SECONDS}-second")
                 return jsonify({"success": False,
-                                "error": "Please wait for the full 5-minute break."}), 400
+                                "error": f"Please wait for the full {break_length} break."}), 400
 
             # Washout 验证通过
             step_data["duration_seconds"] = round(duration, 2)
             step_data["washout_start_ts"] = start_ts
             print(f"✅ Washout complete for PID {participant_id} after {duration:.1f}s.")
 
-            # (NEW) 清除 LLM 会话并更新到下一个 condition
+            # (NEW) 清除 LLM 会话 (condition 在第 3 步推进步骤时一并切换)
             llm_service.clear_session(participant_id)
-            if not data_manager.update_participant_condition(participant_id):
-                # 如果更新 condition 失败，也应阻止流程继续
-                return jsonify({"error": "Failed to update participant condition after washout."}), 500
 
         # --- (NEW) XAI 问卷字段填充 ---
         if step_name in ["POST_QUESTIONNAIRE_1", "POST_QUESTIONNAIRE_2"]:
-            status = data_manager.get_participant_status(participant_id)
             current_condition = status.get("condition")
             if current_condition == "NON_XAI":
                 # 确保这些键存在且值为 null
@@ -359,38 +445,32 @@ def save_data():
         # 2. 确定下一个步骤的索引
         next_step_index = current_step_index + 1
 
-        # 3. 更新状态文件中的步骤索引
-        if not data_manager.update_participant_step(participant_id, next_step_index):
-            return jsonify({"error": "Failed to update participant step."}), 500
-
-        # --- (NEW) Washout 开始时间戳记录 ---
+        # --- (NEW) Washout 开始时间戳记录 (与步骤索引在同一次写入中保存) ---
+        extra_fields = None
         if step_name == "POST_QUESTIONNAIRE_1":
-            try:
-                status_path = os.path.join(data_manager.DATA_DIR, f"P_{participant_id}_status.json")
-                status_data = data_manager.get_participant_status(participant_id)  # 重新读取以获取最新的 index
-                if status_data.get("current_step_index") == EXPERIMENT_STEPS.index("WASHOUT"):  # 确认已进入 Washout 步骤
-                    status_data["washout_start_ts"] = time.time()
-                    with open(status_path, 'w', encoding='utf-8') as f:
-                        json.dump(status_data, f, ensure_ascii=False, indent=4)
-                    print(f"⏱️ Washout timer started for PID {participant_id}")
-                else:
-                    print(
-                        f"Warning: Did not record washout_start_ts for {participant_id}. Expected index {EXPERIMENT_STEPS.index('WASHOUT')}, got {status_data.get('current_step_index')}")
-            except Exception as e:
-                print(f"Error recording washout_start_ts for {participant_id}: {e}")
-                # 不阻止流程，但记录错误
+            if next_step_index == ROUTES.index_of("WASHOUT"):  # 确认将进入 Washout 步骤
+                extra_fields = {"washout_start_ts": time.time()}
+            else:
+                print(
+                    f"Warning: Did not record washout_start_ts for {participant_id}. Expected index {ROUTES.index_of('WASHOUT')}, got {next_step_index}")
+
+        # 3. 在一次原子写入中更新步骤索引 (washout 之后同时切换到下一个 condition)
+        status = data_manager.advance_participant_step(
+            participant_id, next_step_index,
+            switch_condition=(step_name == "WASHOUT"),
+            extra_fields=extra_fields
+        )
+        if not status:
+            if step_name == "WASHOUT":
+                # 如果更新 condition 失败，也应阻止流程继续
+                return jsonify({"error": "Failed to update participant condition after washout."}), 500
+            return jsonify({"error": "Failed to update participant step."}), 500
+        if extra_fields:
+            print(f"⏱️ Washout timer started for PID {participant_id}")
 
         # 4. 确定下一个页面的 URL (使用更新后的状态)
-        status = data_manager.get_participant_status(participant_id)  # 确保使用最新状态
-        current_condition = status.get("condition")
-
-        if next_step_index >= len(EXPERIMENT_STEPS):
-            next_url_path = "/html/debrief.html"
-        else:
-            next_step_key = EXPERIMENT_STEPS[next_step_index]
-            # get_url_for_step 需要当前 condition 来决定 instruction/dialogue URL
-            next_url_path = get_url_for_step(next_step_key, current_condition, participant_id).split('?')[
-                0]  # Remove PID for response
+        # 路由表需要当前 condition 来决定 instruction/dialogue URL (超出范围时为 Debrief)
+        next_url_path = ROUTES.route(next_step_index, status.get("condition")).url_path
 
         # 5. 返回下一个页面的 URL (携带 PID)
         return jsonify({
@@ -406,16 +486,28 @@ def save_data():
         return jsonify({"error": f"Internal server error: {e}"}), 500
 
 
-# --- MODIFIED: chat (添加 session_part) ---
-@app.route('/chat', methods=['POST'])
-def chat():
-    user_input = request.json.get("message", "")
-    participant_id = request.json.get("participant_id", "")
+# --- chat 辅助函数 (WSGI 与 ASGI 两种模式共用) ---
+def prepare_chat_turn(body: dict, accept: str = ""):
+    """
+    校验 /chat 请求并收集本轮需要记录的信息。
+    返回 (turn, None)；请求无效时返回 (None, (错误信息, 状态码))。
+    """
+    user_input = body.get("message", "")
+    participant_id = body.get("participant_id", "")
     # explanation_shown 在 XAI_Version.html 中可能为 true/false， NonXAI 中不存在
-    explanation_shown = request.json.get("explanation_shown", False)
+    explanation_shown = body.get("explanation_shown", False)
 
     if not user_input or not participant_id:
-        return Response("⚠️ No message or participant_id provided", status=400, mimetype='text/plain')
+        return None, ("⚠️ No message or participant_id provided", 400)
+
+    # 流式输出格式: "text" (默认) / "ndjson" / "sse"，见 chat_stream.py
+    stream_format = chat_stream.select_stream_format(body, accept)
+    if stream_format is None:
+        return None, (f"⚠️ Invalid stream_format. Must be one of {list(chat_stream.STREAM_FORMATS)}", 400)
+
+    # 模型已满负荷且队列已满时直接拒绝 (排队超时则在流中报告)
+    if llm_service.admission.is_full():
+        return None, ("⚠️ The assistant is busy right now, please try again in a moment", 503)
 
     # 获取当前状态以确定 condition 和 session_part
     status = data_manager.get_participant_status(participant_id)
@@ -423,24 +515,197 @@ def chat():
     current_index = status.get("current_step_index")
 
     session_part = 1  # 默认是第一部分
-    if current_index == EXPERIMENT_STEPS.index("DIALOGUE_2"):  # 7
+    if current_index == ROUTES.index_of("DIALOGUE_2"):  # 7
         session_part = 2
 
     session = llm_service.get_session(participant_id)
-    # 在流开始前记录回合数（LLM Service 内部会+1）
-    current_turn = session['turn_count'] + 1
-    user_metrics = calculate_text_metrics(user_input)
+    turn = {
+        "participant_id": participant_id,
+        "user_input": user_input,
+        "explanation_shown": explanation_shown,
+        "condition": condition,
+        "session_part": session_part,
+        # 在流开始前记录回合数（LLM Service 内部会+1）
+        "current_turn": session['turn_count'] + 1,
+        "user_metrics": calculate_text_metrics(user_input),
+        "stream_format": stream_format
+    }
+    return turn, None
+
+
+def save_turn_sentiment(job: dict, scores: dict):
+    """情绪评分线程的回调：写入 DIALOGUE_TURN_SENTIMENT 记录，并追加到会话的 sentiment_scores"""
+    participant_id = job["participant_id"]
+    sentiment_data = {
+        "turn": job["turn"],
+        "session_part": job["session_part"],
+        "user_sentiment_score": scores["user"],
+        "user_sentiment_label": label_for(scores["user"]),
+        "agent_sentiment_score": scores["agent"],
+        "agent_sentiment_label": label_for(scores["agent"]),
+        "sentiment_model": sentiment_worker.engine.name,
+    }
+    data_manager.save_turn_sentiment(participant_id, sentiment_data)
+    llm_service.record_sentiment(participant_id, job["session_id"], {
+        "turn": job["turn"], "session_part": job["session_part"], "user": scores["user"], "agent": scores["agent"]
+    })
+
+
+# 回合的情绪评分在后台线程池中完成，不影响流式回复 (见 sentiment.py)
+sentiment_worker = SentimentWorker(load_engine(SENTIMENT_LEXICON_PATH), save_turn_sentiment,
+                                   num_threads=SENTIMENT_WORKER_THREADS, batch_size=SENTIMENT_BATCH_SIZE)
+metrics.gauge("sentiment_jobs_pending", "Turns waiting for sentiment scoring").set_function(
+    sentiment_worker.pending_count)
+
+
+def wait_for_sentiment(participant_id: str, session_part: int, timeout: float) -> dict:
+    """
+    等待该对话部分登记的回合全部评分，返回会话。
+    本进程的任务直接等待评分线程；评分在其他 worker 进程中进行时 (sqlite 会话存储) 轮询会话。
+    超时后 emotion_fluctuation 的 complete 为 False。
+    """
+    deadline = time.monotonic() + timeout
+    sentiment_worker.wait_idle(participant_id, timeout)
+    session = llm_service.get_session(participant_id)
+    while llm_service.sentiment_pending(session, session_part) and time.monotonic() < deadline:
+        time.sleep(0.05)
+        session = llm_service.get_session(participant_id)
+    pending = llm_service.sentiment_pending(session, session_part)
+    if pending:
+        print(f"⚠️ Sentiment scoring still pending for PID {participant_id} ({pending} turn(s)); "
+              f"emotion_fluctuation is marked incomplete.")
+    return session
+
+
+def log_chat_turn(turn: dict, stream_error, got_reply: bool):
+    """流结束后，记录回合分析数据 (仅当没有流错误且 LLM 有回复)；返回保存的数据，未保存时返回 None"""
+    participant_id = turn["participant_id"]
+    current_turn = turn["current_turn"]
+    # 重新读取会话 (共享会话存储返回的是快照，需要获取流结束后的最新状态)
+    session = llm_service.get_session(participant_id)
+    condition = turn["condition"]
+    user_metrics = turn["user_metrics"]
+
+    if not stream_error and got_reply and session.get('turn_count',
+                                                      0) == current_turn:  # Safely get turn_count
+        # 从 session history 获取最新的 AI 消息
+        # (需要确保 llm_service 在 finally 块中添加了 history)
+        ai_message = ""
+        agent_tokens = None
+        if session.get('history') and session['history'][-1]['role'] == 'ai':
+            ai_message = session['history'][-1]['content']
+            agent_tokens = session['history'][-1].get('tokens')  # Ollama eval_count (如有)
+
+        agent_metrics = calculate_text_metrics(ai_message, agent_tokens)
+        llm_stats = session.get('last_llm_stats') or {}
+
+        turn_data = {
+            "user_id": participant_id,
+            "condition": condition,
+            "turn": current_turn,
+            "session_part": turn["session_part"],  # (NEW)
+            # 情绪评分在后台完成，结果写入随后的 DIALOGUE_TURN_SENTIMENT 记录 (相同的 turn / session_part)
+            "user_sentiment_score": None,
+            "user_sentiment_label": None,
+            "user_input_length_token": user_metrics["length_token"],
+            "user_input_length_char": user_metrics["length_char"],
+            "user_input_length_word": user_metrics["length_word"],
+            "agent_sentiment_score": None,
+            "agent_sentiment_label": None,
+            "agent_response_length_token": agent_metrics["length_token"],
+            "agent_response_length_char": agent_metrics["length_char"],
+            "agent_response_length_word": agent_metrics["length_word"],
+            # token 数的来源: "tokenizer" (离线分词器)、"estimate" (按字符数估算) 或 "eval_count" (Ollama 报告)
+            "token_count_method": {
+                "user": TOKEN_COUNT_METHOD,
+                "agent": "eval_count" if llm_stats.get("eval_count") else TOKEN_COUNT_METHOD,
+            },
+            # explanation_shown is only relevant for XAI condition
+            "explanation_shown": turn["explanation_shown"] if condition == "XAI" else False,
+            # LLM 延迟和吞吐 (TTFT / wall / 提示词构建时间，以及 Ollama 报告的 token 数、耗时和模型加载时间)
+            "llm_stats": session.get('last_llm_stats')
+        }
+
+        # 3. 存储回合分析数据，然后投递情绪评分 (不等待)
+        if data_manager.save_turn_data(participant_id, turn_data):
+            llm_service.expect_sentiment(participant_id, session['session_id'], turn["session_part"], current_turn)
+            sentiment_worker.submit({
+                "participant_id": participant_id,
+                "session_id": session['session_id'],
+                "turn": current_turn,
+                "session_part": turn["session_part"],
+                "texts": {"user": turn["user_input"], "agent": ai_message},
+            })
+            return turn_data
+    elif stream_error:
+        print(f"Info: Turn data not saved for {participant_id} turn {current_turn} due to stream error.")
+    elif not got_reply:
+        print(f"Info: Turn data not saved for {participant_id} turn {current_turn} because AI reply was empty.")
+    # else: # turn count mismatch or other issue
+    #    print(f"Warning: Turn data may not be saved for {participant_id} turn {current_turn}. Session turn: {session.get('turn_count', 0)}")
+    return None
+
+
+# --- MODIFIED: chat (添加 session_part) ---
+@app.route('/chat', methods=['POST'])
+def chat():
+    turn, error = prepare_chat_turn(request.json, request.headers.get("Accept", ""))
+    if error:
+        message, status_code = error
+        return Response(message, status=status_code, mimetype='text/plain')
+
+    participant_id = turn["participant_id"]
+    stream_format = turn["stream_format"]
+
+    def generate_framed_stream_and_log():
+        """分帧协议 (ndjson / sse)：合并文本片段，错误和结束信息作为单独的帧发送"""
+        got_reply = False
+        stream_error = None
+        coalescer = chat_stream.ChunkCoalescer(CHAT_STREAM_COALESCE_BYTES, CHAT_STREAM_COALESCE_MS)
+        yield chat_stream.encode_frame(stream_format, chat_stream.meta_frame(turn))
+
+        chat_active_streams.inc()
+        try:
+            stream = llm_service.get_llm_response_stream(participant_id, turn["user_input"], raise_errors=True,
+                                                         queue_updates=True)
+            for chunk in stream:
+                if isinstance(chunk, QueuePosition):
+                    yield chat_stream.encode_frame(stream_format, chat_stream.queue_frame(chunk.position))
+                    continue
+                got_reply = True
+                text = coalescer.add(chunk)
+                if text:
+                    yield chat_stream.encode_frame(stream_format, {"type": "text", "text": text})
+        except Exception as e:
+            stream_error = e
+            print(f"Error during LLM stream for {participant_id}: {e}")
+        finally:
+            chat_active_streams.dec()
+            turn_data = log_chat_turn(turn, stream_error, got_reply)
+
+        text = coalescer.flush()
+        if text:
+            yield chat_stream.encode_frame(stream_format, {"type": "text", "text": text})
+        if stream_error:
+            yield chat_stream.encode_frame(stream_format, chat_stream.error_frame(stream_error))
+        else:
+            yield chat_stream.encode_frame(stream_format, chat_stream.done_frame(turn, turn_data))
+
+    if stream_format != "text":
+        return Response(generate_framed_stream_and_log(), content_type=chat_stream.CONTENT_TYPES[stream_format],
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
     def generate_stream_and_log():
-        full_ai_reply = b''
+        got_reply = False  # 只需要知道是否有回复，不在这里累积回复内容
         stream_error = None  # Track potential errors during streaming
 
+        chat_active_streams.inc()
         try:
             # 1. 调用 LLM 服务生成流
-            stream = llm_service.get_llm_response_stream(participant_id, user_input)
+            stream = llm_service.get_llm_response_stream(participant_id, turn["user_input"])
 
             for chunk in stream:
-                full_ai_reply += chunk
+                got_reply = True
                 yield chunk
 
         except Exception as e:
@@ -449,44 +714,9 @@ def chat():
             yield f"⚠️ Backend LLM error: {e}".encode('utf-8')  # Inform frontend
 
         finally:
-            # 2. 在流结束后，记录回合分析数据 (仅当没有流错误且 LLM 有回复)
-            if not stream_error and full_ai_reply and session.get('turn_count',
-                                                                  0) == current_turn:  # Safely get turn_count
-                # 从 session history 获取最新的 AI 消息
-                # (需要确保 llm_service 在 finally 块中添加了 history)
-                ai_message = ""
-                if session.get('history') and session['history'][-1]['role'] == 'ai':
-                    ai_message = session['history'][-1]['content']
-
-                agent_metrics = calculate_text_metrics(ai_message)
-
-                turn_data = {
-                    "user_id": participant_id,
-                    "condition": condition,
-                    "turn": current_turn,
-                    "session_part": session_part,  # (NEW)
-                    "user_sentiment_score": None,  # (Placeholder)
-                    "user_sentiment_label": None,  # (Placeholder)
-                    "user_input_length_token": user_metrics["length_token"],
-                    "user_input_length_char": user_metrics["length_char"],
-                    "user_input_length_word": user_metrics["length_word"],
-                    "agent_sentiment_score": None,  # (Placeholder)
-                    "agent_sentiment_label": None,  # (Placeholder)
-                    "agent_response_length_token": agent_metrics["length_token"],
-                    "agent_response_length_char": agent_metrics["length_char"],
-                    "agent_response_length_word": agent_metrics["length_word"],
-                    # explanation_shown is only relevant for XAI condition
-                    "explanation_shown": explanation_shown if condition == "XAI" else False
-                }
-
-                # 3. 存储回合分析数据
-                data_manager.save_turn_data(participant_id, turn_data)
-            elif stream_error:
-                print(f"Info: Turn data not saved for {participant_id} turn {current_turn} due to stream error.")
-            elif not full_ai_reply:
-                print(f"Info: Turn data not saved for {participant_id} turn {current_turn} because AI reply was empty.")
-            # else: # turn count mismatch or other issue
-            #    print(f"Warning: Turn data may not be saved for {participant_id} turn {current_turn}. Session turn: {session.get('turn_count', 0)}")
+            chat_active_streams.dec()
+            # 2. 在流结束后，记录回合分析数据
+            log_chat_turn(turn, stream_error, got_reply)
 
     return Response(generate_stream_and_log(), mimetype='text/plain')
 
@@ -507,30 +737,35 @@ def end_dialogue():
         if not participant_id:
             return jsonify({"error": "Missing participant_id"}), 400
 
-        session = llm_service.get_session(participant_id)
         status = data_manager.get_participant_status(participant_id)
         current_index = status.get("current_step_index")
 
         # 确定是哪个对话结束
         step_name = "DIALOGUE_END_UNKNOWN"
         dialogue_step_index = -1
-        if current_index == EXPERIMENT_STEPS.index("DIALOGUE_1"):  # 3
+        if current_index == ROUTES.index_of("DIALOGUE_1"):  # 3
             step_name = "DIALOGUE_END_1"
             dialogue_step_index = current_index
-        elif current_index == EXPERIMENT_STEPS.index("DIALOGUE_2"):  # 7
+        elif current_index == ROUTES.index_of("DIALOGUE_2"):  # 7
             step_name = "DIALOGUE_END_2"
             dialogue_step_index = current_index
         else:
             print(f"Error: /end_dialogue called at unexpected step index {current_index} for {participant_id}")
             return jsonify({"error": "Dialogue ended at unexpected step."}), 400
 
+        # 最后一轮的情绪评分可能仍在后台进行，等待完成后再读取会话 (会话中的在线统计，无额外 I/O)
+        end_time = time.time()
+        session_part = 1 if step_name == "DIALOGUE_END_1" else 2
+        session = wait_for_sentiment(participant_id, session_part, SENTIMENT_WAIT_TIMEOUT)
+
         # 1. 记录对话结束状态和指标
         dialogue_end_data = {
             "status": "Completed by user",
-            "end_time": time.time(),
+            "end_time": end_time,
             "total_turns": session.get('turn_count', 0),  # Safely get turn count
-            "session_part": 1 if step_name == "DIALOGUE_END_1" else 2,  # (NEW)
-            "emotion_fluctuation": None  # (Placeholder)
+            "session_part": session_part,  # (NEW)
+            # 本部分用户情绪得分的均值、方差和平均绝对逐次差 (MASD)，见 emotion_stats.py
+            "emotion_fluctuation": llm_service.get_emotion_fluctuation(session, session_part)
         }
 
         if not data_manager.save_participant_data(participant_id, step_name, dialogue_end_data):
@@ -540,18 +775,12 @@ def end_dialogue():
         next_step_index = dialogue_step_index + 1  # 4 或 8
 
         # 3. 更新状态文件中的步骤索引
-        if not data_manager.update_participant_step(participant_id, next_step_index):
+        status = data_manager.advance_participant_step(participant_id, next_step_index)
+        if not status:
             return jsonify({"error": "Failed to update participant step after dialogue end."}), 500
 
-        # 4. 确定下一个步骤的 URL (需要更新后的状态来获取 condition)
-        status = data_manager.get_participant_status(participant_id)  # Re-read status
-        current_condition = status.get("condition")
-
-        if next_step_index >= len(EXPERIMENT_STEPS):
-            next_url_path = "/html/debrief.html"
-        else:
-            next_step_key = EXPERIMENT_STEPS[next_step_index]  # POST_QUESTIONNAIRE_1 or _2
-            next_url_path = get_url_for_step(next_step_key, current_condition, participant_id).split('?')[0]
+        # 4. 确定下一个步骤的 URL (使用更新后的状态来获取 condition)
+        next_url_path = ROUTES.route(next_step_index, status.get("condition")).url_path  # POST_QUESTIONNAIRE_1 or _2
 
         # 5. 返回下一个页面的 URL
         return jsonify({
@@ -632,6 +861,7 @@ if __name__ == "__main__":
     # app.run(debug=False, port=5000, threaded=True, use_reloader=False)
 
     # Run in single-threaded mode for debugging LLM connection issues
+    # (并发服务多个参与者请使用 ASGI 模式: python -m backend.asgi)
     print("🚦 Running Flask in single-threaded mode for debugging.")
     app.run(debug=False, port=5000, threaded=False, use_reloader=False)
 
@@ -0,0 +1,309 @@
+# backend/asgi.py
+#
+# asyncio (ASGI) 服务模式：一个进程、一个事件循环同时服务多个参与者。
+#   - POST /chat 在事件循环上使用异步 Ollama 客户端流式返回，长时间的生成不占用线程；
+#   - 其余路由 (/save_data, /end_dialogue, HTML 页面等) 原样复用 Flask 视图，
+#     在线程池中执行，因此行为与 WSGI 模式完全一致。
+#
+# 运行: python -m backend.asgi  (需要 httpx 和 uvicorn)
+
+import asyncio
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend import app as flask_module
+from backend import chat_stream
+from backend import llm_service
+from backend import ollama_client
+from backend.admission import QueuePosition
+from backend.config import ASGI_WSGI_THREADS, CHAT_STREAM_COALESCE_BYTES, CHAT_STREAM_COALESCE_MS
+
+flask_app = flask_module.app
+
+_executor = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix="wsgi")
+
+
+async def _read_body(receive) -> bytes:
+    """读取完整的 HTTP 请求体"""
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    return b"".join(chunks)
+
+
+def _build_environ(scope, body: bytes) -> dict:
+    """将 ASGI scope 转换为 WSGI environ"""
+    server = scope.get("server") or ("127.0.0.1", 5000)
+    client = scope.get("client") or ("127.0.0.1", 0)
+    raw_path = scope.get("raw_path")
+    path = raw_path.split(b"?", 1)[0].decode("latin-1") if raw_path else \
+        scope["path"].encode("utf-8").decode("latin-1")
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": path,
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key == "CONTENT_TYPE":
+            environ["CONTENT_TYPE"] = value
+        elif key == "CONTENT_LENGTH":
+            environ["CONTENT_LENGTH"] = value
+        else:
+            key = f"HTTP_{key}"
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+def _run_wsgi(environ: dict):
+    """在工作线程中执行 Flask 视图，返回 (status, headers, body)"""
+    response_start = {}
+
+    def start_response(status, headers, exc_info=None):
+        response_start["status"] = status
+        response_start["headers"] = headers
+
+    result = flask_app(environ, start_response)
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response_start["status"], response_start["headers"], body
+
+
+async def _serve_wsgi(scope, receive, send):
+    """在线程池中执行 Flask 视图 (除 POST /chat 外的所有路由)"""
+    body = await _read_body(receive)
+    environ = _build_environ(scope, body)
+    loop = asyncio.get_running_loop()
+    status, headers, payload = await loop.run_in_executor(_executor, _run_wsgi, environ)
+
+    await send({
+        "type": "http.response.start",
+        "status": int(status.split(" ", 1)[0]),
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers],
+    })
+    await send({"type": "http.response.body", "body": payload})
+
+
+async def _send_plain(send, status: int, text: str):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"text/plain; charset=utf-8"),
+            (b"access-control-allow-origin", b"*"),
+        ],
+    })
+    await send({"type": "http.response.body", "body": text.encode("utf-8")})
+
+
+async def _serve_chat(scope, receive, send):
+    """异步版本的 /chat：与 app.chat 相同的校验、流式输出和回合记录"""
+    try:
+        body = json.loads(await _read_body(receive) or b"null")
+    except ValueError:
+        body = None
+    if not isinstance(body, dict):
+        await _send_plain(send, 400, "Bad Request: invalid JSON body")
+        return
+
+    accept = ",".join(value.decode("latin-1") for name, value in scope.get("headers", []) if name == b"accept")
+    loop = asyncio.get_running_loop()
+    # 读取状态文件属于阻塞 I/O，放到线程池中执行
+    turn, error = await loop.run_in_executor(_executor, flask_module.prepare_chat_turn, body, accept)
+    if error:
+        message, status_code = error
+        await _send_plain(send, status_code, message)
+        return
+
+    participant_id = turn["participant_id"]
+    stream_format = turn["stream_format"]
+    framed = stream_format != "text"  # ndjson / sse 分帧协议，见 chat_stream.py
+    headers = [
+        (b"content-type", chat_stream.CONTENT_TYPES[stream_format].encode("latin-1")),
+        (b"access-control-allow-origin", b"*"),
+    ]
+    if framed:
+        headers += [(b"cache-control", b"no-cache"), (b"x-accel-buffering", b"no")]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+
+    async def send_frame(frame: dict):
+        await send({"type": "http.response.body",
+                    "body": chat_stream.encode_frame(stream_format, frame), "more_body": True})
+
+    # 监听客户端断开：断开后停止生成 (与 WSGI 模式下生成器被关闭的行为一致)
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                disconnected.set()
+                return
+
+    watcher = asyncio.create_task(watch_disconnect())
+
+    got_reply = False
+    stream_error = None
+    coalescer = chat_stream.ChunkCoalescer(CHAT_STREAM_COALESCE_BYTES, CHAT_STREAM_COALESCE_MS)
+    if framed:
+        await send_frame(chat_stream.meta_frame(turn))
+
+    stream = llm_service.get_llm_response_stream_async(participant_id, turn["user_input"], raise_errors=framed,
+                                                        queue_updates=True, executor=_executor)
+    flask_module.chat_active_streams.inc()
+    chunks = _chunks_with_flush_timer(stream, coalescer)
+    try:
+        async for chunk in chunks:
+            if disconnected.is_set():
+                print(f"Info: Client disconnected during LLM stream for {participant_id}.")
+                break
+            if chunk is _WINDOW_EXPIRED:
+                # 模型停顿：合并窗口到期，发送已缓冲的文本
+                text = coalescer.flush_expired()
+                if text:
+                    await send_frame({"type": "text", "text": text})
+                continue
+            if isinstance(chunk, QueuePosition):
+                # 排队期间的位置更新 (也用于及时发现排队期间断开的客户端)；text 格式不发送
+                if framed:
+                    await send_frame(chat_stream.queue_frame(chunk.position))
+                continue
+            got_reply = True
+            if not framed:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                continue
+            text = coalescer.add(chunk)
+            if text:
+                await send_frame({"type": "text", "text": text})
+    except Exception as e:
+        stream_error = e  # Capture error
+        print(f"Error during LLM stream for {participant_id}: {e}")
+        if not framed:
+            await send({"type": "http.response.body",
+                        "body": f"⚠️ Backend LLM error: {e}".encode('utf-8'), "more_body": True})
+    finally:
+        flask_module.chat_active_streams.dec()
+        watcher.cancel()
+        await chunks.aclose()  # 先结束等待中的读取，再关闭流
+        await stream.aclose()
+        # 在流结束后，记录回合分析数据 (写文件属于阻塞 I/O)
+        turn_data = await loop.run_in_executor(_executor, flask_module.log_chat_turn, turn, stream_error, got_reply)
+
+    if framed and not disconnected.is_set():
+        text = coalescer.flush()
+        if text:
+            await send_frame({"type": "text", "text": text})
+        if stream_error:
+            await send_frame(chat_stream.error_frame(stream_error))
+        else:
+            await send_frame(chat_stream.done_frame(turn, turn_data))
+
+    await send({"type": "http.response.body", "body": b""})
+
+
+_WINDOW_EXPIRED = object()
+
+
+async def _chunks_with_flush_timer(stream, coalescer):
+    """
+    逐个产出 stream 的片段；合并器中有缓冲的文本、且等待下一个片段超过剩余的合并窗口时，
+    产出 _WINDOW_EXPIRED。等待在单独的任务中进行，超时不会取消流本身。
+    """
+    next_chunk = None
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(stream.__anext__())
+            done, _ = await asyncio.wait((next_chunk,), timeout=coalescer.time_left())
+            if not done:
+                yield _WINDOW_EXPIRED
+                continue
+            try:
+                chunk = next_chunk.result()
+            except StopAsyncIteration:
+                return
+            next_chunk = None
+            yield chunk
+    finally:
+        if next_chunk is not None and not next_chunk.done():
+            # 提前结束 (客户端断开) 时停止正在等待的读取，流的清理 (finally) 在该任务中完成
+            next_chunk.cancel()
+            try:
+                await next_chunk
+            except (asyncio.CancelledError, StopAsyncIteration, Exception):
+                pass
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await ollama_client.close_async_client()
+            _executor.shutdown(wait=False)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGI 入口"""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] == "/chat" and scope["method"] == "POST":
+        # /chat 不经过 Flask，在这里记录路由耗时 (到响应结束为止)
+        start = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        try:
+            await _serve_chat(scope, receive, send_with_status)
+        finally:
+            flask_module.observe_request("/chat", "POST", status["code"], (time.perf_counter() - start) * 1000)
+    else:
+        await _serve_wsgi(scope, receive, send)
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    print("🚀 Starting ASGI server on http://127.0.0.1:5000")
+    print(f"💾 Data will be saved to: {flask_module.data_manager.DATA_DIR}")
+    print(f"🔄 Experiment Flow Steps: {flask_module.EXPERIMENT_STEPS}")
+    print(f"🧵 Non-streaming routes run on a pool of {ASGI_WSGI_THREADS} threads")
+    # 单进程、单事件循环：参与者的会话数据仍保存在本进程内存中
+    uvicorn.run(application, host="127.0.0.1", port=5000, loop="asyncio", workers=1)
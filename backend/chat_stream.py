@@ -0,0 +1,123 @@
+# backend/chat_stream.py
+#
+# /chat 的分帧流式协议 (可选，请求体中 "stream_format": "ndjson" 或 "sse")。
+# 默认的 "text" 格式与之前相同：每个 token 直接作为 text/plain 写出。
+#
+# 分帧格式下每一帧是一个 JSON 对象，"type" 字段为：
+#   meta:  {"type": "meta", "turn": 3, "session_part": 1, "user_tokens": 12}      (开始时)
+#   queue: {"type": "queue", "position": 2}                                         (排队等待模型时，位置变化时发送)
+#   text:  {"type": "text", "text": "..."}                                         (合并后的回复片段)
+#   error: {"type": "error", "message": "..."}                                     (出错时，代替文本中的 ⚠️ 提示)
+#   done:  {"type": "done", "turn": 3, "saved": true, "agent_tokens": 85, ...}     (正常结束时)
+# ndjson: 每帧一行；sse: "event: <type>\ndata: <json>\n\n"。
+#
+# 文本帧按字节数或时间窗口合并：第一个片段立即发送 (不影响首字延迟)，之后的片段
+# 累积到 CHAT_STREAM_COALESCE_BYTES 字节或距离上次发送超过 CHAT_STREAM_COALESCE_MS 毫秒时再发送，
+# 减少写入次数和浏览器端的重新渲染次数。
+# ASGI 模式在等待下一个片段时以 time_left() 为超时，模型停顿时窗口到期也会发送缓冲的文本；
+# WSGI 模式 (同步生成器) 只在下一个片段到达时检查窗口，模型停顿期间缓冲的文本要等到下一个片段或流结束。
+
+import json
+import time
+
+STREAM_FORMATS = ("text", "ndjson", "sse")
+
+CONTENT_TYPES = {
+    "text": "text/plain; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+    "sse": "text/event-stream; charset=utf-8",
+}
+
+_ACCEPT_FORMATS = {
+    "application/x-ndjson": "ndjson",
+    "text/event-stream": "sse",
+}
+
+
+def select_stream_format(body: dict, accept: str = "") -> str:
+    """
+    请求体中的 stream_format 优先，其次根据 Accept 头选择；默认 "text"。
+    stream_format 无效时返回 None。
+    """
+    stream_format = body.get("stream_format")
+    if stream_format is not None:
+        return stream_format if stream_format in STREAM_FORMATS else None
+    for media_type in (accept or "").split(","):
+        stream_format = _ACCEPT_FORMATS.get(media_type.split(";", 1)[0].strip())
+        if stream_format:
+            return stream_format
+    return "text"
+
+
+def encode_frame(stream_format: str, frame: dict) -> bytes:
+    data = json.dumps(frame, ensure_ascii=False)
+    if stream_format == "sse":
+        return f"event: {frame['type']}\ndata: {data}\n\n".encode("utf-8")
+    return (data + "\n").encode("utf-8")
+
+
+def meta_frame(turn: dict) -> dict:
+    return {
+        "type": "meta",
+        "turn": turn["current_turn"],
+        "session_part": turn["session_part"],
+        "user_tokens": turn["user_metrics"]["length_token"],
+    }
+
+
+def queue_frame(position: int) -> dict:
+    return {"type": "queue", "position": position}
+
+
+def error_frame(error: Exception) -> dict:
+    return {"type": "error", "message": f"Backend LLM error: {error}"}
+
+
+def done_frame(turn: dict, turn_data: dict = None) -> dict:
+    frame = {"type": "done", "turn": turn["current_turn"], "saved": turn_data is not None}
+    if turn_data is not None:
+        frame["agent_tokens"] = turn_data["agent_response_length_token"]
+        frame["agent_chars"] = turn_data["agent_response_length_char"]
+    return frame
+
+
+class ChunkCoalescer:
+    """
+    合并流式回复片段 (utf-8 bytes)。
+    add() 返回需要立即发送的文本 (或 None)；流结束时调用 flush() 取出剩余文本。
+    """
+
+    def __init__(self, max_bytes: int, window_ms: float):
+        self.max_bytes = max_bytes
+        self.window = window_ms / 1000.0
+        self._parts = []
+        self._size = 0
+        self._last_sent = None  # 第一个片段之前为 None (立即发送)
+
+    def add(self, chunk: bytes):
+        self._parts.append(chunk)
+        self._size += len(chunk)
+        now = time.monotonic()
+        if self._last_sent is None or self._size >= self.max_bytes or now - self._last_sent >= self.window:
+            self._last_sent = now
+            return self.flush()
+        return None
+
+    def time_left(self):
+        """距离时间窗口到期的秒数；没有缓冲的文本时为 None (不需要定时发送)"""
+        if not self._parts or self._last_sent is None:
+            return None
+        return max(0.0, self._last_sent + self.window - time.monotonic())
+
+    def flush_expired(self):
+        """时间窗口到期 (没有新片段到达) 时取出缓冲的文本"""
+        self._last_sent = time.monotonic()
+        return self.flush()
+
+    def flush(self):
+        if not self._parts:
+            return None
+        text = b"".join(self._parts).decode("utf-8")
+        self._parts = []
+        self._size = 0
+        return text
@@ -4,10 +4,22 @@ import os
 
 # --- 全局常量 ---
 
-# Ollama API 配置
-OLLAMA_API_URL = "http://localhost:11434/api/generate"
+# Ollama API 配置 (可用环境变量 OLLAMA_API_URL 覆盖，例如指向 loadtest/mock_ollama.py)
+OLLAMA_API_URL = os.environ.get("OLLAMA_API_URL", "http://localhost:11434/api/generate")
 MODEL_NAME = "qwen2.5:1.5b"
 
+# Ollama HTTP 连接池配置 (所有 LLM 调用共享一个 keep-alive 连接池)
+OLLAMA_POOL_SIZE = 8               # 连接池中保持的最大 keep-alive 连接数
+OLLAMA_CONNECT_TIMEOUT = 5         # 建立 TCP 连接的超时 (秒)
+OLLAMA_STREAM_READ_TIMEOUT = 300   # 流式对话的读取超时 (秒)
+OLLAMA_SUMMARY_READ_TIMEOUT = 120  # 摘要生成的读取超时 (秒)
+OLLAMA_MAX_RETRIES = 3             # 连接失败时的最大重试次数 (只重试连接错误)
+OLLAMA_RETRY_BACKOFF = 0.5         # 重试退避因子 (0.5s, 1s, 2s ...)
+
+# ASGI (asyncio) 服务模式配置 (python -m backend.asgi)
+# /chat 在事件循环上异步流式处理；其余路由在线程池中执行原有的 Flask 视图
+ASGI_WSGI_THREADS = 32
+
 # LLM 服务的系统提示
 SYSTEM_PROMPT = (
     "You are a gentle and empathetic conversational partner. "
@@ -19,8 +31,102 @@ SYSTEM_PROMPT = (
 # 摘要生成间隔 (每进行 X 轮用户-AI对话后生成一次摘要)
 SUMMARY_INTERVAL = 5
 
-# 实验数据存储路径
-DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
+# 提示词的 token 预算 (系统提示、摘要和历史消息都计入预算)
+# 历史消息从最新的开始向前填充，直到预算或条数上限用完
+PROMPT_TOKEN_BUDGET = 1024
+PROMPT_MAX_MESSAGES = 10
+
+# 增量对话模式: 保存 Ollama /api/generate 返回的 context (KV 缓存对应的 token 序列)，
+# 之后每轮只发送新的用户消息，避免每轮重新 prefill 全部历史。
+# 摘要更新或 context 超过上限时自动回退为完整重建提示词。
+INCREMENTAL_CONTEXT = False
+# context 的 token 上限 (应小于模型的 num_ctx，Ollama 默认为 2048)
+INCREMENTAL_CONTEXT_MAX_TOKENS = 1536
+
+# /chat 分帧流式协议 (stream_format 为 "ndjson" / "sse" 时) 的文本合并参数：
+# 第一个片段立即发送，之后累积到该字节数或距上次发送超过该毫秒数时发送一帧
+# (ASGI 模式按定时器发送；WSGI 模式在下一个片段到达时检查，见 chat_stream.py)
+CHAT_STREAM_COALESCE_BYTES = 256
+CHAT_STREAM_COALESCE_MS = 30
+
+# 模型加载时间 (Ollama 返回的 load_duration) 超过该毫秒数时视为冷启动，在回合记录中标记
+LLM_COLD_LOAD_MS = 1000
+
+# /chat 的准入控制 (见 admission.py)：同时进行的生成数上限；多出的请求按到达顺序排队，
+# 每个参与者同时最多一个生成。
+# 控制器在每个 worker 进程内独立计数，因此默认值为本地模型的并行能力 (Ollama 的 OLLAMA_NUM_PARALLEL)
+# 平均分给 WEB_CONCURRENCY 个 worker 进程 (gunicorn 读取同一个环境变量作为默认的 worker 数)，
+# 使所有进程合计不超过模型的并行能力；排队的公平性也只在同一进程内保证。
+# 0 表示不限制。可用环境变量 LLM_MAX_CONCURRENT 直接指定每个进程的上限 (例如压测时)。
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", 2))
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+LLM_MAX_CONCURRENT = int(os.environ.get("LLM_MAX_CONCURRENT", max(1, OLLAMA_NUM_PARALLEL // WEB_CONCURRENCY)))
+LLM_QUEUE_MAX_WAIT_S = 60   # 排队超过该秒数时放弃，提示参与者稍后重试
+LLM_QUEUE_MAX_LENGTH = 50   # 队列已满时新请求立即被拒绝 (HTTP 503)
+
+# 离线分词器 (HuggingFace tokenizers 格式的 tokenizer.json，需要 pip install tokenizers)，
+# 用于统计用户输入的 token 数和提示词预算；文件或依赖不存在时回退为按字符数估算。
+# AI 回复的 token 数直接使用 Ollama 返回的 eval_count。
+TOKENIZER_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "models", "qwen2.5", "tokenizer.json")
+TOKEN_COUNT_CACHE_SIZE = 4096  # 分词结果的 LRU 缓存条数 (同一文本在一个回合中会被统计多次)
+
+# 后台摘要线程数 (摘要在后台生成，每个参与者同时最多一个)
+SUMMARY_WORKER_THREADS = 2
+
+# 回合情绪评分 (后台线程池，见 sentiment.py)
+# 词典文件为 VADER 格式 (每行 "词<TAB>效价...")；None 时使用内置的中英文小词典
+SENTIMENT_LEXICON_PATH = None
+SENTIMENT_WORKER_THREADS = 1
+SENTIMENT_BATCH_SIZE = 32  # 每个工作线程一次最多评分的回合数
+# 对话结束时等待该参与者尚未完成的评分 (最后一轮) 的最长时间 (秒)，之后计算 emotion_fluctuation
+SENTIMENT_WAIT_TIMEOUT = 2.0
+
+# 实验数据存储路径 (可用环境变量 DATA_DIR 覆盖，例如压力测试时使用临时目录)
+DATA_DIR = os.environ.get("DATA_DIR", os.path.join(os.path.dirname(os.path.dirname(__file__)), "data"))
+
+# LLM 会话存储后端
+#   "memory": 保存在进程内存中 (只能运行一个 worker 进程)
+#   "sqlite": 保存在本地 SQLite (WAL) 文件中，多个 worker 进程可共享同一参与者的会话
+SESSION_STORE_BACKEND = "memory"
+SESSION_STORE_PATH = os.path.join(DATA_DIR, "llm_sessions.sqlite3")
+
+# JSONL 记录的后台批量写入 (group commit)
+#   "always":   每条记录在请求返回前 fsync (同一批次共享一次 fsync)
+#   "interval": 每 LOG_FLUSH_INTERVAL_MS 毫秒写入并 fsync 一次 (请求不等待磁盘)
+#   "none":     写入操作系统缓存，不主动 fsync
+# LOG_DURABILITY 用于问卷和步骤记录 (写入失败时 /save_data 返回 500，数据不会静默丢失)；
+# LOG_TURN_DURABILITY 用于高频的对话回合和情绪评分记录 (写入失败在同一参与者下一次保存时报告)。
+LOG_DURABILITY = "always"
+LOG_TURN_DURABILITY = "interval"
+LOG_WRITE_TIMEOUT_S = 10  # "always" 记录等待 fsync 的最长时间 (秒)，超时视为保存失败
+LOG_FLUSH_INTERVAL_MS = 200
+LOG_FLUSH_BYTES = 64 * 1024  # 缓冲的数据达到该大小时立即写入
+
+# 参与者记录和状态的存储后端
+#   "file":   每位参与者一个 P_<pid>.jsonl 和 P_<pid>_status.json (默认)
+#   "sqlite": 保存在一个 SQLite (WAL) 数据库中，可按参与者/步骤查询和导出
+#             (已有的文件数据可用 python -m backend.sqlite_storage import 导入)
+DATA_BACKEND = "file"
+DATA_DB_PATH = os.path.join(DATA_DIR, "experiment.sqlite3")
+
+# 页面模板和静态文件
+# 开发模式下设为 True：修改 HTML 后无需重启即可生效 (每次渲染检查文件 mtime)
+TEMPLATE_AUTO_RELOAD = False
+# 模板编译结果的磁盘缓存目录 (None 表示不使用)，可缩短进程启动时间
+TEMPLATE_BYTECODE_CACHE_DIR = None
+# 静态文件 (assets/ 和 admin_setup.html) 在启动时载入内存并预先压缩；
+# 开发模式下设为 True：文件修改后自动重新载入
+STATIC_AUTO_RELOAD = False
+# 已渲染页面的 LRU 缓存条目数 (按模板、语言和步骤缓存；0 表示不缓存)
+PAGE_CACHE_SIZE = 256
+
+# 额外的语言文件目录: <language>.json，格式 {模块: {键: 文本}}，覆盖/补充 localization.py 中的内置文本。
+# 文件新增或修改后最多 LOCALES_RELOAD_INTERVAL 秒生效，无需重启。
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "locales")
+LOCALES_RELOAD_INTERVAL = 2.0
+
+# Washout 休息时长 (秒)。正式实验为 5 分钟；压力测试时可用环境变量 WASHOUT_SECONDS 缩短
+WASHOUT_SECONDS = int(os.environ.get("WASHOUT_SECONDS", 300))
 
 # 实验版本配置 (用于手动指定)
 VERSION_MAP = {
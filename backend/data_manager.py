@@ -1,7 +1,290 @@
 import json
 import os
+import threading
 import time
-from backend.config import DATA_DIR, VERSION_MAP
+import weakref
+import zlib
+from contextlib import contextmanager
+from backend.config import DATA_DIR, VERSION_MAP, LOG_DURABILITY, LOG_TURN_DURABILITY, LOG_WRITE_TIMEOUT_S, \
+    LOG_FLUSH_INTERVAL_MS, LOG_FLUSH_BYTES, DATA_BACKEND, DATA_DB_PATH
+from backend import metrics
+from backend.log_writer import get_record_writer
+from backend.sqlite_storage import SQLiteStorage
+
+# fcntl 只在类 Unix 系统上可用；其他系统上只使用进程内的锁
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+if DATA_BACKEND not in ("file", "sqlite"):
+    raise ValueError(f"Unknown data backend: {DATA_BACKEND}. Must be 'file' or 'sqlite'.")
+
+# "sqlite" 后端：记录和状态都保存在 DATA_DB_PATH 中 (本模块的函数接口与文件后端相同)
+_sqlite = SQLiteStorage(DATA_DB_PATH) if DATA_BACKEND == "sqlite" else None
+
+# === 存储耗时指标 (毫秒，见 /metrics) ===
+_status_read_ms = metrics.histogram("status_read_ms", metrics.FAST_BUCKETS_MS,
+                                    "Time to read a participant status (cache hit or file read)")
+_status_write_ms = metrics.histogram("status_write_ms", metrics.FAST_BUCKETS_MS,
+                                     "Time to atomically write a participant status file")
+_status_transaction_ms = metrics.histogram("status_transaction_ms", metrics.FAST_BUCKETS_MS,
+                                           "Duration of a status transaction including lock wait")
+_record_append_ms = metrics.histogram("record_append_ms", metrics.FAST_BUCKETS_MS,
+                                      "Time to hand a JSONL record to storage")
+_status_cache_hits = metrics.counter("status_cache_requests_total", "Status cache lookups", {"result": "hit"})
+_status_cache_misses = metrics.counter("status_cache_requests_total", "Status cache lookups", {"result": "miss"})
+
+# === 参与者状态缓存 (write-through) ===
+# Key: participant_id
+# Value: (文件签名 (inode, mtime_ns, size), 状态字典)
+# 本进程写入状态文件时同步更新缓存；其他进程写入时文件签名变化，缓存自动失效。
+_status_cache = {}
+_status_cache_lock = threading.Lock()
+
+
+def _status_path(participant_id: str) -> str:
+    return os.path.join(DATA_DIR, f"P_{participant_id}_status.json")
+
+
+def _file_signature(st: os.stat_result) -> tuple:
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _write_status(participant_id: str, status_data: dict):
+    """
+    原子地写入状态文件并更新缓存：先写临时文件并 fsync，再 rename 覆盖。
+    写入过程中崩溃不会留下被截断的 JSON 文件。
+    """
+    start = time.perf_counter()
+    status_path = _status_path(participant_id)
+    tmp_path = f"{status_path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(status_data, f, ensure_ascii=False, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+            signature = _file_signature(os.fstat(f.fileno()))  # rename 不改变 inode / mtime
+        os.replace(tmp_path, status_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_dir(DATA_DIR)
+    with _status_cache_lock:
+        _status_cache[participant_id] = (signature, dict(status_data))
+    _status_write_ms.observe((time.perf_counter() - start) * 1000)
+
+
+def _fsync_dir(path: str):
+    """fsync 目录，使 rename 本身也持久化 (不支持的系统上跳过)"""
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# === 参与者锁 (进程内每个参与者一把锁 + 跨进程 flock) ===
+# 进程内的锁不再被使用时自动回收 (WeakValueDictionary)，任意 pid (包括无效的 pid) 不会使锁表无限增长。
+# 状态文件通过 rename 原子替换，不能直接对它加 flock；跨进程的锁按 pid 的哈希映射到
+# 固定数量的锁文件 (.locks/stripe_<n>.lock)，锁文件的数量有上限。
+_LOCK_FILE_STRIPES = 64
+
+
+class _ParticipantLock:
+    """可以被弱引用的锁 (threading.Lock 本身不支持弱引用)"""
+    __slots__ = ("_lock", "__weakref__")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self._lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self._lock.release()
+
+
+_participant_locks = weakref.WeakValueDictionary()
+_participant_locks_guard = threading.Lock()
+
+
+def _participant_lock(participant_id: str) -> _ParticipantLock:
+    with _participant_locks_guard:
+        lock = _participant_locks.get(participant_id)
+        if lock is None:
+            lock = _participant_locks[participant_id] = _ParticipantLock()
+        return lock
+
+
+def _lock_file_path(participant_id: str) -> str:
+    stripe = zlib.crc32(str(participant_id).encode("utf-8")) % _LOCK_FILE_STRIPES
+    return os.path.join(DATA_DIR, ".locks", f"stripe_{stripe}.lock")
+
+
+@contextmanager
+def status_transaction(participant_id: str):
+    """
+    参与者状态的事务：在锁内读取一次状态，with 块内可以修改多个字段，
+    正常退出时只原子写回一次 (内容未变化时不写)；块内抛出异常则不写入。
+
+        with data_manager.status_transaction(pid) as status:
+            status["current_step_index"] = 5
+            status["washout_start_ts"] = time.time()
+
+    状态文件不存在时得到空字典 {}。
+    """
+    start = time.perf_counter()
+    try:
+        with _status_transaction(participant_id) as status_data:
+            yield status_data
+    finally:
+        _status_transaction_ms.observe((time.perf_counter() - start) * 1000)
+
+
+@contextmanager
+def _status_transaction(participant_id: str):
+    if _sqlite is not None:
+        with _sqlite.status_transaction(participant_id) as status_data:
+            yield status_data
+        return
+
+    with _participant_lock(participant_id):
+        lock_file = None
+        if fcntl is not None:
+            lock_path = _lock_file_path(participant_id)
+            os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+            lock_file = open(lock_path, 'a')
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            original = get_participant_status(participant_id)
+            status_data = dict(original)
+            yield status_data
+            if status_data != original:
+                _write_status(participant_id, status_data)
+        finally:
+            if lock_file is not None:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+                lock_file.close()
+
+
+def update_participant_status(participant_id: str, changes: dict) -> dict:
+    """
+    在一次读写中更新多个状态字段，返回更新后的状态。
+    状态文件不存在或写入失败时返回 {}。
+    """
+    try:
+        with status_transaction(participant_id) as status_data:
+            if not status_data:
+                print(f"❌ CRITICAL ERROR: Status file missing for PID {participant_id}. Cannot update status.")
+                return {}
+            status_data.update(changes)
+        return status_data
+    except Exception as e:
+        print(f"❌ Failed to update participant status: {e}")
+        return {}
+
+
+def _records_path(participant_id: str) -> str:
+    return os.path.join(DATA_DIR, f"P_{participant_id}.jsonl")
+
+
+def _record_writer():
+    # 后台刷新节奏按回合记录的模式；问卷和步骤记录逐条指定 LOG_DURABILITY
+    return get_record_writer(LOG_TURN_DURABILITY, LOG_FLUSH_INTERVAL_MS, LOG_FLUSH_BYTES, LOG_WRITE_TIMEOUT_S)
+
+
+def _append_record(record: dict, durability: str = LOG_DURABILITY) -> bool:
+    """
+    保存一条记录：文件后端交给后台写入线程 ('always' 模式下等待 fsync 完成)，
+    sqlite 后端直接插入 records 表。
+    """
+    start = time.perf_counter()
+    try:
+        if _sqlite is not None:
+            _sqlite.append_record(record)
+            return True
+        json_line = json.dumps(record, ensure_ascii=False)
+        return _record_writer().append(_records_path(record["participant_id"]), json_line, durability)
+    finally:
+        _record_append_ms.observe((time.perf_counter() - start) * 1000)
+
+
+def pending_records() -> int:
+    """后台写入线程中尚未处理的记录数 (sqlite 后端为 0)"""
+    if _sqlite is not None:
+        return 0
+    return _record_writer().queue_depth()
+
+
+def flush_records(timeout: float = None) -> bool:
+    """等待所有已提交的 JSONL 记录写入磁盘 (读取记录文件之前调用)"""
+    if _sqlite is not None:
+        return True
+    return _record_writer().flush(timeout)
+
+
+def get_participant_records(participant_id: str, step: str = None) -> list:
+    """
+    按写入顺序返回参与者的记录 (可只返回某个步骤的记录)。
+    sqlite 后端使用 (participant_id, step) 索引；文件后端读取 P_<pid>.jsonl。
+    """
+    if _sqlite is not None:
+        return _sqlite.get_records(participant_id, step)
+
+    flush_records()
+    records = []
+    try:
+        with open(_records_path(participant_id), 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if step is None or record.get("step") == step:
+                    records.append(record)
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def export_records(step: str = None) -> list:
+    """返回所有参与者的记录 (可只返回某个步骤的记录)，用于导出分析"""
+    if _sqlite is not None:
+        return _sqlite.get_records(step=step)
+    records = []
+    for participant_id in _list_participant_ids():
+        records.extend(get_participant_records(participant_id, step))
+    return records
+
+
+def _list_participant_ids() -> list:
+    """文件后端：扫描数据目录中的状态文件"""
+    try:
+        names = os.listdir(DATA_DIR)
+    except FileNotFoundError:
+        return []
+    suffix = "_status.json"
+    return sorted(name[len("P_"):-len(suffix)] for name in names
+                  if name.startswith("P_") and name.endswith(suffix))
+
+
+def list_participant_progress() -> list:
+    """所有参与者的当前进度：[{participant_id, current_step_index, condition}, ...]"""
+    if _sqlite is not None:
+        return _sqlite.list_progress()
+    progress = []
+    for participant_id in _list_participant_ids():
+        status = get_participant_status(participant_id)
+        progress.append({
+            "participant_id": participant_id,
+            "current_step_index": status.get("current_step_index"),
+            "condition": status.get("condition"),
+        })
+    return progress
 
 
 # (create_data_dir 保持不变)
@@ -11,14 +294,40 @@ def create_data_dir():
     print(f"✅ Data directory ensured: {DATA_DIR}")
 
 
-# (get_participant_status 保持不变)
 def get_participant_status(participant_id: str) -> dict:
-    """从状态文件中获取受试者的实验条件和其他状态信息"""
-    status_path = os.path.join(DATA_DIR, f"P_{participant_id}_status.json")
+    """
+    从状态文件中获取受试者的实验条件和其他状态信息。
+    文件未变化时直接返回缓存 (只做一次 stat)，返回值是副本，可以安全修改。
+    """
+    start = time.perf_counter()
+    try:
+        return _read_status(participant_id)
+    finally:
+        _status_read_ms.observe((time.perf_counter() - start) * 1000)
+
+
+def _read_status(participant_id: str) -> dict:
+    if _sqlite is not None:
+        return _sqlite.get_status(participant_id)
+
+    status_path = _status_path(participant_id)
     try:
+        signature = _file_signature(os.stat(status_path))
+        cached = _status_cache.get(participant_id)
+        if cached and cached[0] == signature:
+            _status_cache_hits.inc()
+            return dict(cached[1])
+
+        _status_cache_misses.inc()
         with open(status_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            signature = _file_signature(os.fstat(f.fileno()))
+            status_data = json.load(f)
+        with _status_cache_lock:
+            _status_cache[participant_id] = (signature, status_data)
+        return dict(status_data)
     except FileNotFoundError:
+        with _status_cache_lock:
+            _status_cache.pop(participant_id, None)
         return {}
     except Exception as e:
         print(f"❌ Error reading status file: {e}")
@@ -44,10 +353,8 @@ def get_participant_language(participant_id: str) -> str:
 def save_participant_data(participant_id: str, step_name: str, data: dict):
     """
     通用数据保存函数：将一个步骤数据（如问卷、初始化）以 JSON Line 格式追加写入。
+    (文件后端由后台写入线程批量写入，持久化方式见 config.LOG_DURABILITY)
     """
-    create_data_dir()
-    file_path = os.path.join(DATA_DIR, f"P_{participant_id}.jsonl")
-
     record = {
         "timestamp": time.time(),
         "datetime": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
@@ -56,11 +363,9 @@ def save_participant_data(participant_id: str, step_name: str, data: dict):
         "data": data
     }
 
-    json_line = json.dumps(record, ensure_ascii=False)
-
     try:
-        with open(file_path, 'a', encoding='utf-8') as f:
-            f.write(json_line + '\n')
+        if not _append_record(record):
+            raise OSError(f"write to {_records_path(participant_id)} failed")
 
         print(f"✅ Data saved for PID {participant_id} at step {step_name}")
         return True
@@ -100,9 +405,9 @@ def init_participant_session(participant_id: str, condition_order: str, language
     save_participant_data(participant_id, "INIT", init_data)
 
     # 2. 写入一个单独的 JSON 文件来保存**会话状态** (用于 LLM 部分的引用)
-    status_path = os.path.join(DATA_DIR, f"P_{participant_id}_status.json")
-    with open(status_path, 'w', encoding='utf-8') as f:
-        json.dump(init_data, f, ensure_ascii=False, indent=4)
+    with status_transaction(participant_id) as status_data:
+        status_data.clear()
+        status_data.update(init_data)
 
     # print(f"🎉 Session initialized for PID {participant_id} in {condition} condition. Language: {language}") # (OLD)
     print(f"🎉 Session initialized for PID {participant_id} in {condition_order_upper} order. Language: {language}")
@@ -112,43 +417,45 @@ def init_participant_session(participant_id: str, condition_order: str, language
 
 
 # --- (NEW) NEW FUNCTION: update_participant_condition ---
+def switch_participant_condition(participant_id: str, status_data: dict) -> str:
+    """
+    (Within-Subjects) 在给定的状态字典上切换到第二个条件并标记 washout 完成。
+    只修改字典，不写文件 (在 status_transaction 内使用)。返回新的条件。
+    """
+    current_condition = status_data.get("condition")
+    condition_order = status_data.get("condition_order")
+
+    # Determine the new condition
+    new_condition = "UNKNOWN"
+    if condition_order == "AB" and current_condition == "XAI":
+        new_condition = "NON_XAI"
+    elif condition_order == "BA" and current_condition == "NON_XAI":
+        new_condition = "XAI"
+    else:
+        # This case shouldn't happen if logic is correct, but good to check
+        print(
+            f"⚠️ Warning: Condition update for PID {participant_id} in unexpected state. Order: {condition_order}, Current: {current_condition}")
+        # Force set to the *other* condition
+        new_condition = "NON_XAI" if current_condition == "XAI" else "XAI"
+
+    status_data["condition"] = new_condition
+
+    # (NEW) Also add a marker that washout is complete
+    status_data["washout_completed"] = True
+    return new_condition
+
+
 def update_participant_condition(participant_id: str):
     """
     (Within-Subjects) Updates the participant's status file to the second condition
     after the washout period.
     """
-    status_path = os.path.join(DATA_DIR, f"P_{participant_id}_status.json")
     try:
-        # 1. Read existing status
-        status_data = get_participant_status(participant_id)
-        if not status_data:
-            print(f"❌ CRITICAL ERROR: Status file missing for PID {participant_id}. Cannot update condition.")
-            return False
-
-        current_condition = status_data.get("condition")
-        condition_order = status_data.get("condition_order")
-
-        # 2. Determine the new condition
-        new_condition = "UNKNOWN"
-        if condition_order == "AB" and current_condition == "XAI":
-            new_condition = "NON_XAI"
-        elif condition_order == "BA" and current_condition == "NON_XAI":
-            new_condition = "XAI"
-        else:
-            # This case shouldn't happen if logic is correct, but good to check
-            print(
-                f"⚠️ Warning: Condition update for PID {participant_id} in unexpected state. Order: {condition_order}, Current: {current_condition}")
-            # Force set to the *other* condition
-            new_condition = "NON_XAI" if current_condition == "XAI" else "XAI"
-
-        status_data["condition"] = new_condition
-
-        # (NEW) Also add a marker that washout is complete
-        status_data["washout_completed"] = True
-
-        # 3. Write back the file
-        with open(status_path, 'w', encoding='utf-8') as f:
-            json.dump(status_data, f, ensure_ascii=False, indent=4)
+        with status_transaction(participant_id) as status_data:
+            if not status_data:
+                print(f"❌ CRITICAL ERROR: Status file missing for PID {participant_id}. Cannot update condition.")
+                return False
+            new_condition = switch_participant_condition(participant_id, status_data)
 
         print(f"✅ PID {participant_id} condition switched to {new_condition}")
         return True
@@ -157,43 +464,44 @@ def update_participant_condition(participant_id: str):
         return False
 
 
-# --- (OLD) update_participant_step ---
 def update_participant_step(participant_id: str, new_step_index: int):
     """
     更新受试者的状态文件，记录他们当前所在的步骤索引。
     """
-    status_path = os.path.join(DATA_DIR, f"P_{participant_id}_status.json")
-    try:
-        # 1. 读取现有状态
-        status_data = get_participant_status(participant_id)
-        if not status_data:
-            print(f"❌ CRITICAL ERROR: Status file missing for PID {participant_id}. Cannot update step.")
-            return False
+    return bool(advance_participant_step(participant_id, new_step_index))
 
-        # 2. 更新步骤索引
-        status_data["current_step_index"] = new_step_index
 
-        # 3. 写回文件
-        with open(status_path, 'w', encoding='utf-8') as f:
-            json.dump(status_data, f, ensure_ascii=False, indent=4)
+def advance_participant_step(participant_id: str, new_step_index: int,
+                             switch_condition: bool = False, extra_fields: dict = None) -> dict:
+    """
+    在一次读写中推进到 new_step_index，可同时切换条件 (washout 之后) 和写入额外字段。
+    返回更新后的状态 (调用方可直接用来确定下一步 URL，无需再次读取)；失败时返回 {}。
+    """
+    try:
+        with status_transaction(participant_id) as status_data:
+            if not status_data:
+                print(f"❌ CRITICAL ERROR: Status file missing for PID {participant_id}. Cannot update step.")
+                return {}
+            if switch_condition:
+                new_condition = switch_participant_condition(participant_id, status_data)
+                print(f"✅ PID {participant_id} condition switched to {new_condition}")
+            status_data["current_step_index"] = new_step_index
+            if extra_fields:
+                status_data.update(extra_fields)
 
         print(f"✅ PID {participant_id} advanced to step index {new_step_index}")
-        return True
+        return status_data
     except Exception as e:
         print(f"❌ Failed to update participant step: {e}")
-        return False
+        return {}
 
 
 # (save_turn_data 保持不变)
 def save_turn_data(participant_id: str, turn_data: dict):
     """
     将一轮对话的分析数据以 JSON Line 格式追加写入其专属文件。
+    (高频记录，持久化方式见 config.LOG_TURN_DURABILITY)
     """
-    create_data_dir()
-
-    # 构造文件路径
-    file_path = os.path.join(DATA_DIR, f"P_{participant_id}.jsonl")
-
     # 构造完整的记录对象
     record = {
         "timestamp": time.time(),
@@ -203,14 +511,34 @@ def save_turn_data(participant_id: str, turn_data: dict):
         "data": turn_data
     }
 
-    json_line = json.dumps(record, ensure_ascii=False)
-
     try:
-        with open(file_path, 'a', encoding='utf-8') as f:
-            f.write(json_line + '\n')
+        if not _append_record(record, LOG_TURN_DURABILITY):
+            raise OSError(f"write to {_records_path(participant_id)} failed")
 
         print(f"✅ Turn data saved for PID {participant_id}, Turn {turn_data.get('turn')}")
         return True
     except Exception as e:
         print(f"❌ Failed to save turn data: {e}")
-        return False
\ No newline at end of file
+        return False
+
+
+def save_turn_sentiment(participant_id: str, sentiment_data: dict):
+    """
+    追加一轮对话的情绪评分 (DIALOGUE_TURN_SENTIMENT)。
+    评分在后台完成，晚于对应的 DIALOGUE_TURN 记录写入；两者通过 turn 和 session_part 对应。
+    """
+    record = {
+        "timestamp": time.time(),
+        "datetime": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+        "participant_id": participant_id,
+        "step": "DIALOGUE_TURN_SENTIMENT",
+        "data": sentiment_data
+    }
+
+    try:
+        if not _append_record(record, LOG_TURN_DURABILITY):
+            raise OSError(f"write to {_records_path(participant_id)} failed")
+        return True
+    except Exception as e:
+        print(f"❌ Failed to save turn sentiment: {e}")
+        return False
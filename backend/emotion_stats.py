@@ -0,0 +1,75 @@
+# backend/emotion_stats.py
+#
+# 对话中情绪得分的在线统计 (每轮 O(1)，不保存历史得分)：
+#   - Welford 算法维护均值和方差；
+#   - 相邻两轮得分之差的绝对值之和，用于平均绝对逐次差 (MASD)。
+# MASD 依赖得分的顺序，而后台评分完成的顺序不一定是回合顺序 (多个评分线程、多个 worker 进程)：
+# 投递评分前用 expect() 登记回合，add_score() 先暂存提前完成的得分，按登记的回合顺序计入统计。
+# 状态是普通字典，可以直接保存在会话中 (sqlite 会话存储以 JSON 序列化)。
+# 对话结束时 summarize() 的结果写入 DIALOGUE_END_1 / _2 记录的 emotion_fluctuation。
+
+import math
+
+
+def new_state() -> dict:
+    # pending: 已登记、尚未计入的回合 (按回合顺序)；held: 已评分但在等前面回合的得分 {回合: 得分}
+    return {"n": 0, "mean": 0.0, "m2": 0.0, "last": None, "abs_diff_sum": 0.0, "pending": [], "held": {}}
+
+
+def expect(state: dict, turn: int) -> dict:
+    """登记一个将要评分的回合 (按回合顺序调用)"""
+    state.setdefault("pending", []).append(turn)
+    return state
+
+
+def add_score(state: dict, turn: int, value: float) -> dict:
+    """
+    加入一个回合的得分：按登记的回合顺序计入统计，前面的回合尚未评分时先暂存。
+    未登记的回合 (例如旧会话) 直接计入。
+    """
+    pending = state.setdefault("pending", [])
+    if turn not in pending:
+        return update(state, value)
+    held = state.setdefault("held", {})
+    held[str(turn)] = value  # 键为字符串，sqlite 会话存储 JSON 序列化前后一致
+    while pending and str(pending[0]) in held:
+        update(state, held.pop(str(pending.pop(0))))
+    return state
+
+
+def update(state: dict, value: float) -> dict:
+    """加入一个得分 (原地修改并返回 state)"""
+    state["n"] += 1
+    delta = value - state["mean"]
+    state["mean"] += delta / state["n"]
+    state["m2"] += delta * (value - state["mean"])
+    if state["last"] is not None:
+        state["abs_diff_sum"] += abs(value - state["last"])
+    state["last"] = value
+    return state
+
+
+def summarize(state: dict) -> dict:
+    """
+    n / mean / variance (样本方差) / std / masd / complete；得分少于两个时方差和 MASD 为 None。
+    仍有登记的回合没有评分时 complete 为 False：暂存的得分跳过缺失的回合按顺序计入 (不修改 state)。
+    state 为 None (对话中没有评分) 时返回 n = 0。
+    """
+    complete = not (state and state.get("pending"))
+    if not complete:
+        held = state.get("held", {})
+        state = dict(state)
+        for turn in state["pending"]:
+            if str(turn) in held:
+                update(state, held[str(turn)])
+    n = state["n"] if state else 0
+    if n == 0:
+        return {"n": 0, "mean": None, "variance": None, "std": None, "masd": None, "complete": complete}
+    summary = {"n": n, "mean": round(state["mean"], 4), "variance": None, "std": None, "masd": None,
+               "complete": complete}
+    if n >= 2:
+        variance = state["m2"] / (n - 1)
+        summary["variance"] = round(variance, 4)
+        summary["std"] = round(math.sqrt(variance), 4)
+        summary["masd"] = round(state["abs_diff_sum"] / (n - 1), 4)
+    return summary
@@ -1,39 +1,128 @@
+import asyncio
 import requests
 import json
-from backend.config import OLLAMA_API_URL, MODEL_NAME, SYSTEM_PROMPT, SUMMARY_INTERVAL
+import time
+import uuid
+from backend import emotion_stats
+from backend.admission import AdmissionController, AdmissionError, QueuePosition
+from backend import metrics
+from backend import ollama_client
+from backend.session_store import create_session_store
+from backend.summarizer import SummaryWorker
+from backend.token_counter import count_tokens
+from backend.config import (
+    MODEL_NAME, SYSTEM_PROMPT, SUMMARY_INTERVAL, SUMMARY_WORKER_THREADS,
+    INCREMENTAL_CONTEXT, INCREMENTAL_CONTEXT_MAX_TOKENS,
+    PROMPT_TOKEN_BUDGET, PROMPT_MAX_MESSAGES,
+    OLLAMA_STREAM_READ_TIMEOUT, OLLAMA_SUMMARY_READ_TIMEOUT,
+    SESSION_STORE_BACKEND, SESSION_STORE_PATH, LLM_COLD_LOAD_MS,
+    LLM_MAX_CONCURRENT, LLM_QUEUE_MAX_WAIT_S, LLM_QUEUE_MAX_LENGTH, OLLAMA_NUM_PARALLEL, WEB_CONCURRENCY
+)
+
+# orjson (可选) 解析 Ollama 的 NDJSON 行更快，且可直接解析 bytes；未安装时使用标准库
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+SUMMARY_PROMPT_HEADER = "The following is a summary of previous conversation to help you understand context:\n"
+_SYSTEM_PROMPT_TOKENS = count_tokens(SYSTEM_PROMPT + "\n\n")
+# 每条历史消息的 "User: " / "AI: " 前缀和换行，以及结尾的 "AI:" 提示
+_MESSAGE_OVERHEAD_TOKENS = max(count_tokens("User: \n"), count_tokens("AI: \n"))
+_REPLY_CUE_TOKENS = count_tokens("AI:")
+
+
+def _new_session() -> dict:
+    """新的参与者会话数据"""
+    return {
+        'session_id': uuid.uuid4().hex,  # <--- 用于识别会话是否已被清除重建
+        'history': [],
+        'summary': "",
+        'summary_tokens': 0,  # <--- 摘要部分 (含引导语) 的 token 数
+        'full_prompt': "",
+        'turn_count': 0,  # <--- 回合计数器
+        'sentiment_scores': [],  # <--- 每轮的情绪得分 {"turn", "session_part", "user", "agent"} (后台评分后追加)
+        'emotion_stats': {},  # <--- 用户情绪得分的在线统计，按对话部分 ("1" / "2") 分开 (见 emotion_stats.py)
+        'last_llm_stats': None,  # <--- 最近一次回合的延迟和吞吐统计 (见 _llm_stats)
+        'context': None,  # <--- Ollama 返回的 KV context (增量对话模式)
+        'context_summary': ""  # <--- 构建 context 时提示词中使用的摘要
+    }
+
 
 # === 全局存储 - 参与者会话数据隔离 ===
 # Key: participant_id
 # Value: {'history': [...], 'summary': '...', 'turn_count': 0, 'sentiment_scores': []}
-session_data = {}
+# 后端由 SESSION_STORE_BACKEND 决定 (memory: 本进程内存; sqlite: 多个 worker 进程共享)
+session_store = create_session_store(SESSION_STORE_BACKEND, _new_session, SESSION_STORE_PATH)
 
 
 def get_session(participant_id: str) -> dict:
-    """获取或初始化参与者的会话数据"""
-    if participant_id not in session_data:
-        session_data[participant_id] = {
-            'history': [],
-            'summary': "",
-            'full_prompt': "",
-            'turn_count': 0,  # <--- 回合计数器
-            'sentiment_scores': []  # <--- 情绪得分占位符列表
-        }
-    return session_data[participant_id]
+    """
+    获取或初始化参与者的会话数据。
+    注意: 使用 sqlite 后端时返回的是快照，修改必须通过 session_store.update 完成。
+    """
+    return session_store.get_or_create(participant_id)
 
 
 def clear_session(participant_id: str) -> bool:
     """清除特定参与者的会话历史和摘要 (用于新实验开始时)"""
-    if participant_id in session_data:
-        del session_data[participant_id]
+    summary_worker.discard(participant_id)
+    if session_store.delete(participant_id):
         print(f"🧹 Session cleared for PID {participant_id}")
         return True
     return False
 
 
-def generate_summary(session: dict):
-    """生成近期对话的简短摘要 (用于上下文记忆)"""
+def _emotion_state(session: dict, session_part: int) -> dict:
+    # 键为字符串，sqlite 会话存储 JSON 序列化前后一致
+    return session.setdefault('emotion_stats', {}).setdefault(str(session_part), emotion_stats.new_state())
 
-    conversation_history = session['history']
+
+def expect_sentiment(participant_id: str, session_id: str, session_part: int, turn: int) -> bool:
+    """投递评分任务前登记回合，使该对话部分的得分按回合顺序计入在线统计"""
+    def apply(current):
+        if current['session_id'] != session_id:
+            return False
+        emotion_stats.expect(_emotion_state(current, session_part), turn)
+        return True
+
+    return session_store.update(participant_id, apply)
+
+
+def record_sentiment(participant_id: str, session_id: str, entry: dict) -> bool:
+    """
+    把后台评分的结果追加到会话的 sentiment_scores，并按回合顺序更新该对话部分的情绪在线统计；
+    会话已被清除重建时丢弃。
+    """
+    def apply(current):
+        if current['session_id'] != session_id:
+            return False
+        current['sentiment_scores'].append(entry)
+        emotion_stats.add_score(_emotion_state(current, entry["session_part"]), entry["turn"], entry["user"])
+        return True
+
+    return session_store.update(participant_id, apply)
+
+
+def sentiment_pending(session: dict, session_part: int) -> int:
+    """该对话部分已登记但尚未评分的回合数"""
+    return len(session.get('emotion_stats', {}).get(str(session_part), {}).get("pending", ()))
+
+
+def get_emotion_fluctuation(session: dict, session_part: int) -> dict:
+    """某个对话部分的用户情绪波动 (均值、方差、MASD)，直接取会话中的在线统计"""
+    return emotion_stats.summarize(session.get('emotion_stats', {}).get(str(session_part)))
+
+
+def generate_summary(session: dict, conversation_history: list = None) -> str:
+    """
+    生成近期对话的简短摘要 (用于上下文记忆)，返回新摘要 (失败时返回空字符串)。
+    conversation_history 为请求摘要时的历史快照；在其基础上合并最新完成的摘要。
+    """
+
+    if conversation_history is None:
+        conversation_history = session['history']
     summary_memory = session['summary']
 
     recent_dialogue = "\n".join(
@@ -54,98 +143,457 @@ Output the new summary:
 """
 
     try:
-        resp = requests.post(
-            OLLAMA_API_URL,
-            json={
+        resp, timing = ollama_client.post_generate(
+            {
                 "model": MODEL_NAME,
                 "prompt": summary_prompt,
                 "stream": False
             },
-            timeout=120
+            stream=False,
+            read_timeout=OLLAMA_SUMMARY_READ_TIMEOUT
         )
         resp.raise_for_status()
+        timing.mark_first_byte()  # 非流式请求: 响应头到达即首字节
         data = resp.json()
-        new_summary = data.get("response", "").strip()
-        if new_summary:
-            session['summary'] = new_summary
-            print("✅ [Summary Updated]:", new_summary)
+        print(f"⏱️ Summary latency: {timing}")
+        return data.get("response", "").strip()
     except requests.RequestException as e:
         print(f"⚠️ Failed to generate summary: {e}")
     except Exception as e:
         print(f"⚠️ An unexpected error occurred during summary generation: {e}")
+    return ""
+
+
+def _run_summary_job(participant_id: str, job: dict):
+    """后台摘要任务：生成摘要并写回会话 (会话已被清除时丢弃结果)"""
+    session = get_session(participant_id)  # 读取最新完成的摘要
+    if session['session_id'] != job['session_id']:
+        print(f"ℹ️ Skipping summary for PID {participant_id}: session was cleared.")
+        return
+    new_summary = generate_summary(session, job['history'])
+    if not new_summary:
+        return
+
+    def apply(current):
+        if current['session_id'] != job['session_id']:
+            return False
+        current['summary'] = new_summary
+        current['summary_tokens'] = count_tokens(SUMMARY_PROMPT_HEADER + new_summary)
+        return True
+
+    if session_store.update(participant_id, apply):
+        print("✅ [Summary Updated]:", new_summary)
+    else:
+        print(f"ℹ️ Discarding summary for PID {participant_id}: session was cleared.")
+
 
+# === 后台摘要线程 (摘要生成不阻塞参与者的回复) ===
+summary_worker = SummaryWorker(_run_summary_job, num_threads=SUMMARY_WORKER_THREADS)
 
-def get_llm_response_stream(participant_id: str, user_input: str):
+
+def _message_tokens(msg: dict) -> int:
+    """历史消息的 token 数；没有 tokens 字段的消息 (旧会话或其他来源) 现场统计"""
+    tokens = msg.get('tokens')
+    return tokens if tokens is not None else count_tokens(msg['content'])
+
+
+def build_prompt(session: dict) -> str:
     """
-    处理聊天逻辑和 LLM 响应流。
+    在 PROMPT_TOKEN_BUDGET 内组装完整的提示词。
+    固定部分先计入预算：系统提示 (仅第一轮)、摘要 (含引导语) 和结尾的 "AI:"；
+    然后从最新的消息开始向前填充历史 (每条消息另计前缀)，最多 PROMPT_MAX_MESSAGES 条；
+    最新的用户消息总是包含在内。
     """
-    session = get_session(participant_id)
     conversation_history = session['history']
     summary_memory = session['summary']
+    budget = PROMPT_TOKEN_BUDGET - _REPLY_CUE_TOKENS
 
-    # 1. 将用户输入添加到历史记录 (此历史记录只保留在内存中，不写入文件)
-    conversation_history.append({"role": "user", "content": user_input})
-
-    # --- 构建完整的提示词 (Prompt) ---
-    full_prompt = ""
-
+    header = ""
     if len(conversation_history) == 1:
-        full_prompt += SYSTEM_PROMPT + "\n\n"
+        header += SYSTEM_PROMPT + "\n\n"
+        budget -= _SYSTEM_PROMPT_TOKENS
 
     if summary_memory:
-        full_prompt += f"The following is a summary of previous conversation to help you understand context:\n{summary_memory}\n\n"
+        summary_block = f"{SUMMARY_PROMPT_HEADER}{summary_memory}\n\n"
+        header += summary_block
+        # 旧会话 (sqlite 会话存储) 可能没有 summary_tokens
+        budget -= session.get('summary_tokens') or count_tokens(summary_block)
 
-    for msg in conversation_history[-10:]:
+    # 从新到旧选择消息，直到超出预算
+    window = []
+    for msg in reversed(conversation_history):
+        if len(window) >= PROMPT_MAX_MESSAGES:
+            break
+        cost = _message_tokens(msg) + _MESSAGE_OVERHEAD_TOKENS
+        if window and cost > budget:
+            break
+        window.append(msg)
+        budget -= cost
+
+    lines = []
+    for msg in reversed(window):
         prefix = "User:" if msg["role"] == "user" else "AI:"
-        full_prompt += f"{prefix} {msg['content']}\n"
+        lines.append(f"{prefix} {msg['content']}\n")
+
+    return header + "".join(lines) + "AI:"
+
+
+def _prepare_turn(participant_id: str, user_input: str) -> dict:
+    """将用户输入加入历史记录，构建本轮的提示词，返回请求 payload"""
+    return session_store.update(participant_id, lambda session: _add_user_message(participant_id, session, user_input))
+
+
+def _add_user_message(participant_id: str, session: dict, user_input: str) -> dict:
+    conversation_history = session['history']
+    summary_memory = session['summary']
 
-    full_prompt += "AI:"
+    # 1. 将用户输入添加到历史记录 (此历史记录只保留在内存中，不写入文件)
+    # token 数在加入时计算一次并缓存在消息上
+    conversation_history.append({"role": "user", "content": user_input, "tokens": count_tokens(user_input)})
+
+    payload = {
+        "model": MODEL_NAME,
+        "stream": True
+    }
+
+    # --- 增量对话模式: 复用上一轮的 KV context，只发送新的用户消息 ---
+    context = session['context']
+    if INCREMENTAL_CONTEXT:
+        if context and session['context_summary'] == summary_memory \
+                and len(context) <= INCREMENTAL_CONTEXT_MAX_TOKENS:
+            full_prompt = f"User: {user_input}\nAI:"
+            payload["prompt"] = full_prompt
+            payload["context"] = context
+            session['full_prompt'] = full_prompt
+            print(f"\n--- LLM Prompt (incremental, {len(context)} context tokens reused) ---")
+            print(full_prompt)
+            print("------------------\n")
+            return payload
+        if context:
+            reason = "summary rotated" if session['context_summary'] != summary_memory else "context too large"
+            print(f"🔁 Rebuilding full prompt for PID {participant_id} ({reason})")
+
+    # 完整重建: 旧的 context 作废，本轮返回的 context 以新的摘要为基础
+    session['context'] = None
+    session['context_summary'] = summary_memory
+
+    # --- 构建完整的提示词 (Prompt) ---
+    full_prompt = build_prompt(session)
 
     session['full_prompt'] = full_prompt
     print("\n--- LLM Prompt ---")
     print(full_prompt)
     print("------------------\n")
 
+    payload["prompt"] = full_prompt
+    return payload
+
+
+def _parse_stream_line(line):
+    """
+    解析 Ollama 的一行 NDJSON (bytes 或 str)，返回 (text_chunk, final_data)。
+    final_data 仅在最后一行 (done=true) 时为该行的完整数据，否则为 None；
+    无法解析的行返回 ("", None)。
+    """
+    try:
+        data = _json_loads(line)
+    except ValueError:  # JSONDecodeError / UnicodeDecodeError
+        return "", None
+    return data.get("response", ""), (data if data.get("done", False) else None)
+
+
+class _StreamState:
+    """流式回复的累积结果：文本片段列表 (结束时 join 一次) 和最后一行的数据"""
+    __slots__ = ("parts", "final_data")
+
+    def __init__(self):
+        self.parts = []
+        self.final_data = None
+
+    @property
+    def reply(self) -> str:
+        return "".join(self.parts)
+
+
+def _relay_stream(lines, timing, state: _StreamState):
+    """
+    流式回复的热循环：逐行解析 NDJSON，每个文本片段只 encode 一次并 yield。
+    文本追加到 state.parts (避免字符串反复拼接)，最后一行的数据保存在 state.final_data。
+    """
+    parts_append = state.parts.append
+    for line in lines:
+        if not line:
+            continue
+        timing.mark_first_byte()
+        text_chunk, done_data = _parse_stream_line(line)
+        if text_chunk:
+            parts_append(text_chunk)
+            yield text_chunk.encode('utf-8')
+        if done_data is not None:
+            # 不使用 break: 提前退出 iter_lines 会关闭底层连接，
+            # 读完流的结尾才能让连接回到连接池
+            state.final_data = done_data
+
+
+# Ollama 最后一行中的耗时字段 (纳秒)
+_OLLAMA_DURATIONS = ("prompt_eval_duration", "eval_duration", "load_duration", "total_duration")
+
+# 每回合统计值 -> 直方图 (名称, 分桶)
+_STAT_HISTOGRAMS = {
+    "queue_wait_ms": ("llm_queue_wait_ms", metrics.LATENCY_BUCKETS_MS),
+    "prompt_build_ms": ("llm_prompt_build_ms", metrics.LATENCY_BUCKETS_MS),
+    "ttft_ms": ("llm_ttft_ms", metrics.LATENCY_BUCKETS_MS),
+    "wall_ms": ("llm_wall_ms", metrics.LATENCY_BUCKETS_MS),
+    "load_ms": ("llm_load_ms", metrics.LATENCY_BUCKETS_MS),
+    "prompt_eval_ms": ("llm_prompt_eval_ms", metrics.LATENCY_BUCKETS_MS),
+    "eval_ms": ("llm_eval_ms", metrics.LATENCY_BUCKETS_MS),
+    "prompt_eval_count": ("llm_prompt_tokens", metrics.COUNT_BUCKETS),
+    "eval_count": ("llm_eval_tokens", metrics.COUNT_BUCKETS),
+    "eval_tokens_per_s": ("llm_eval_tokens_per_s", metrics.COUNT_BUCKETS),
+}
+
+
+def _llm_stats(timing, final_data: dict, prompt_build_s: float, queue_wait_s: float = 0.0) -> dict:
+    """
+    一个回合的延迟和吞吐统计 (毫秒)：
+    - 服务端测量: 准入排队时间、提示词构建、连接/首字节、首个 token (TTFT，从放行后开始计)、总耗时 (wall)；
+    - Ollama 报告 (最后一行): prompt / 生成的 token 数和耗时、模型加载时间。
+    """
+    stats = timing.as_dict() if timing is not None else {}
+    prompt_build_ms = round(prompt_build_s * 1000, 2)
+    stats["prompt_build_ms"] = prompt_build_ms
+    stats["queue_wait_ms"] = round(queue_wait_s * 1000, 2)
+    if timing is not None:
+        if stats["first_byte_ms"] is not None:
+            stats["ttft_ms"] = round(prompt_build_ms + stats["first_byte_ms"], 2)
+        if stats["end_ms"] is not None:
+            stats["wall_ms"] = round(prompt_build_ms + stats["end_ms"], 2)
+
+    if final_data:
+        for key in ("prompt_eval_count", "eval_count"):
+            if key in final_data:
+                stats[key] = final_data[key]
+        for key in _OLLAMA_DURATIONS:
+            if key in final_data:
+                stats[key.replace("_duration", "_ms")] = round(final_data[key] / 1e6, 2)
+        if stats.get("eval_count") and stats.get("eval_ms"):
+            stats["eval_tokens_per_s"] = round(stats["eval_count"] / (stats["eval_ms"] / 1000), 2)
+        if stats.get("prompt_eval_count") and stats.get("prompt_eval_ms"):
+            stats["prompt_tokens_per_s"] = round(stats["prompt_eval_count"] / (stats["prompt_eval_ms"] / 1000), 2)
+        stats["cold_load"] = stats.get("load_ms", 0) >= LLM_COLD_LOAD_MS
+    return stats
+
+
+def _observe_llm_stats(participant_id: str, stats: dict):
+    for key, (name, buckets) in _STAT_HISTOGRAMS.items():
+        if stats.get(key) is not None:
+            metrics.histogram(name, buckets).observe(stats[key])
+    if stats.get("cold_load"):
+        print(f"🧊 Model cold load for PID {participant_id}: load_duration {stats['load_ms']}ms")
+
+
+def _finish_turn(participant_id: str, full_ai_reply: str, final_data: dict = None, timing=None,
+                 prompt_build_s: float = 0.0, queue_wait_s: float = 0.0):
+    """流结束后：保存 KV context，记录 AI 回复和统计，增加回合计数，按间隔投递后台摘要请求"""
+    if timing is not None:
+        timing.mark_end()
+    stats = _llm_stats(timing, final_data, prompt_build_s, queue_wait_s)
+    _observe_llm_stats(participant_id, stats)
+    summary_job = session_store.update(
+        participant_id, lambda session: _add_ai_reply(session, full_ai_reply, final_data, stats)
+    )
+    if summary_job:
+        # 下一轮的提示词使用最近一次 *完成* 的摘要
+        summary_worker.submit(participant_id, summary_job)
+    print("✅ Streaming Complete")
+
+
+def _add_ai_reply(session: dict, full_ai_reply: str, final_data: dict, stats: dict):
+    """在会话中记录本轮结果；需要生成摘要时返回摘要任务"""
+    conversation_history = session['history']
+    session['last_llm_stats'] = stats
+
+    # 只有完整结束的流才能继续复用 context；否则下一轮完整重建
+    if INCREMENTAL_CONTEXT and final_data and final_data.get("context"):
+        session['context'] = final_data["context"]
+    else:
+        session['context'] = None
+
+    if full_ai_reply:
+        # 2. 将完整的 AI 回复添加到历史记录
+        ai_message = full_ai_reply.strip()
+        # 完整结束的流由 Ollama 报告生成的 token 数 (eval_count)，无需再次分词
+        tokens = stats.get("eval_count") or count_tokens(ai_message)
+        conversation_history.append({"role": "ai", "content": ai_message, "tokens": tokens})
+
+        # --- 新增: 增加回合计数 ---
+        session['turn_count'] += 1
+
+        if len(conversation_history) % (SUMMARY_INTERVAL * 2) == 0:
+            return {
+                'session_id': session['session_id'],
+                'history': conversation_history[-10:]
+            }
+    return None
+
+
+# === 准入控制 - 本进程同时只处理 LLM_MAX_CONCURRENT 个生成，其余按到达顺序排队 ===
+# (每个 worker 进程一个控制器；默认上限为 OLLAMA_NUM_PARALLEL / WEB_CONCURRENCY，见 config.py)
+admission = AdmissionController(LLM_MAX_CONCURRENT, LLM_QUEUE_MAX_WAIT_S, LLM_QUEUE_MAX_LENGTH)
+if LLM_MAX_CONCURRENT and LLM_MAX_CONCURRENT * WEB_CONCURRENCY > OLLAMA_NUM_PARALLEL:
+    print(f"⚠️ {WEB_CONCURRENCY} worker(s) x LLM_MAX_CONCURRENT={LLM_MAX_CONCURRENT} exceeds "
+          f"OLLAMA_NUM_PARALLEL={OLLAMA_NUM_PARALLEL}; the model may be asked for more replies than it runs in parallel.")
+metrics.gauge("llm_generations_active", "Chat generations admitted to the model").set_function(
+    admission.active_count)
+metrics.gauge("llm_generations_queued", "Chat generations waiting for admission").set_function(
+    admission.waiting_count)
+
+
+def _admission_rejected(e: AdmissionError):
+    metrics.counter("llm_admission_rejected_total", "Chat turns rejected by admission control",
+                    {"reason": e.reason}).inc()
+    print(f"🚦 Chat turn rejected ({e.reason}): {e}")
+
+
+def get_llm_response_stream(participant_id: str, user_input: str, raise_errors: bool = False,
+                            queue_updates: bool = False):
+    """
+    处理聊天逻辑和 LLM 响应流。
+    raise_errors=False 时连接错误作为文本提示输出；True 时 (分帧流式协议) 重新抛出，由调用方发送 error 帧。
+    生成前先经过准入控制：queue_updates=True 时排队期间产出 QueuePosition (位置变化时)；
+    排队超时或队列已满时本轮消息不记入历史，错误与连接错误同样处理。
+    """
+    try:
+        ticket = admission.enter(participant_id)
+        try:
+            for position in admission.wait(ticket):
+                if queue_updates:
+                    yield QueuePosition(position)
+        except BaseException:  # 超时或客户端在排队期间断开
+            admission.release(ticket)
+            raise
+    except AdmissionError as e:
+        _admission_rejected(e)
+        if raise_errors:
+            raise
+        yield f"⚠️ {e}".encode('utf-8')
+        return
+
+    try:
+        yield from _stream_reply(participant_id, user_input, raise_errors, ticket.wait_s)
+    finally:
+        admission.release(ticket)
+
+
+def _stream_reply(participant_id: str, user_input: str, raise_errors: bool, queue_wait_s: float):
+    """放行后的一个回合：构建提示词并转发 Ollama 的流式回复"""
+    build_start = time.perf_counter()
+    payload = _prepare_turn(participant_id, user_input)
+    prompt_build_s = time.perf_counter() - build_start
+
     # --- 流式响应 ---
-    full_ai_reply = ""
+    state = _StreamState()
+    response = None
+    timing = None
     try:
-        response = requests.post(
-            OLLAMA_API_URL,
-            json={
-                "model": MODEL_NAME,
-                "prompt": full_prompt,
-                "stream": True
-            },
+        response, timing = ollama_client.post_generate(
+            payload,
             stream=True,
-            timeout=300
+            read_timeout=OLLAMA_STREAM_READ_TIMEOUT
         )
         response.raise_for_status()
 
-        for line in response.iter_lines():
-            if line:
-                try:
-                    json_line = line.decode('utf-8')
-                    data = json.loads(json_line)
-                    text_chunk = data.get("response", "")
-                    if text_chunk:
-                        full_ai_reply += text_chunk
-                        yield text_chunk.encode('utf-8')
-                    if data.get("done", False):
-                        break
-                except json.JSONDecodeError:
-                    pass
+        yield from _relay_stream(response.iter_lines(), timing, state)
 
     except requests.RequestException as e:
+        if raise_errors:
+            raise
         yield f"⚠️ Failed connecting backend LLM: {e}".encode('utf-8')
 
     finally:
-        if full_ai_reply:
-            # 2. 将完整的 AI 回复添加到历史记录
-            conversation_history.append({"role": "ai", "content": full_ai_reply.strip()})
+        # 流正常结束时将连接放回连接池 (keep-alive)，否则直接关闭
+        ollama_client.release(response, drain=state.final_data is not None)
+        if response is not None:
+            print(f"⏱️ LLM latency: {timing}")
+
+        _finish_turn(participant_id, state.reply, state.final_data, timing, prompt_build_s, queue_wait_s)
+
+
+async def get_llm_response_stream_async(participant_id: str, user_input: str, raise_errors: bool = False,
+                                        queue_updates: bool = False, executor=None):
+    """
+    get_llm_response_stream 的 asyncio 版本 (用于 ASGI 模式)。
+    使用异步 Ollama 客户端，排队和流式等待期间不占用线程。
+    会话读写 (sqlite 会话存储会等待写锁和 fsync) 在 executor 线程池中执行，不阻塞事件循环上的其他流。
+    """
+    try:
+        ticket = admission.enter(participant_id, asyncio.get_running_loop())
+        try:
+            async for position in admission.wait_async(ticket):
+                if queue_updates:
+                    yield QueuePosition(position)
+        except BaseException:
+            admission.release(ticket)
+            raise
+    except AdmissionError as e:
+        _admission_rejected(e)
+        if raise_errors:
+            raise
+        yield f"⚠️ {e}".encode('utf-8')
+        return
+
+    reply = _stream_reply_async(participant_id, user_input, raise_errors, ticket.wait_s, executor)
+    try:
+        async for chunk in reply:
+            yield chunk
+    finally:
+        await reply.aclose()  # 客户端断开时先结束本轮 (关闭 Ollama 连接、记录回合)，再释放名额
+        admission.release(ticket)
+
+
+def _timed_prepare_turn(participant_id: str, user_input: str):
+    build_start = time.perf_counter()
+    payload = _prepare_turn(participant_id, user_input)
+    return payload, time.perf_counter() - build_start
+
+
+async def _stream_reply_async(participant_id: str, user_input: str, raise_errors: bool, queue_wait_s: float,
+                              executor=None):
+    loop = asyncio.get_running_loop()
+    payload, prompt_build_s = await loop.run_in_executor(executor, _timed_prepare_turn, participant_id, user_input)
+
+    state = _StreamState()
+    response = None
+    timing = None
+    try:
+        response, timing = await ollama_client.post_generate_async(
+            payload,
+            read_timeout=OLLAMA_STREAM_READ_TIMEOUT
+        )
+        response.raise_for_status()
+
+        # 与 _relay_stream 相同的热循环 (异步迭代)
+        parts_append = state.parts.append
+        async for line in response.aiter_lines():
+            if line:
+                timing.mark_first_byte()
+                text_chunk, done_data = _parse_stream_line(line)
+                if text_chunk:
+                    parts_append(text_chunk)
+                    yield text_chunk.encode('utf-8')
+                if done_data is not None:
+                    state.final_data = done_data
+
+    except ollama_client.AsyncRequestError as e:
+        if raise_errors:
+            raise
+        yield f"⚠️ Failed connecting backend LLM: {e}".encode('utf-8')
 
-            # --- 新增: 增加回合计数 ---
-            session['turn_count'] += 1
+    finally:
+        if response is not None:
+            await response.aclose()  # 读完的连接回到连接池，未读完的直接关闭
+            timing.mark_end()  # 在切换到线程池之前记录结束时间
+            print(f"⏱️ LLM latency: {timing}")
 
-            if len(conversation_history) % (SUMMARY_INTERVAL * 2) == 0:
-                generate_summary(session)
-        print("✅ Streaming Complete")
\ No newline at end of file
+        await loop.run_in_executor(executor, _finish_turn, participant_id, state.reply, state.final_data, timing,
+                                   prompt_build_s, queue_wait_s)
@@ -1,5 +1,13 @@
 # backend/localization.py
 
+import json
+import os
+import threading
+import time
+from types import MappingProxyType
+
+from backend.config import LOCALES_DIR, LOCALES_RELOAD_INTERVAL
+
 # 实验中所有 UI 文本的本地化字典
 # 键为模块/页面名，值为文本键值对
 LOCALIZATION_STRINGS = {
@@ -244,44 +252,116 @@ LOCALIZATION_STRINGS = {
 }
 
 
-# (辅助函数 get_localized_string 保持不变)
-def get_localized_string(module: str, key: str, language: str) -> str:
-    """从本地化字典中安全地获取指定语言的文本"""
-    # 优先获取模块内的文本
-    if module in LOCALIZATION_STRINGS and key in LOCALIZATION_STRINGS[module].get(language, {}):
-        return LOCALIZATION_STRINGS[module][language][key]
+# === 预先合并的本地化字符串 (按 (模块, 语言) 缓存) ===
+# 回退链在第一次使用时解析一次，结果是只读的 MappingProxyType，渲染页面时直接使用，
+# 不再逐个键合并。LOCALES_DIR 中的 <language>.json 文件 (格式: {模块: {键: 文本}})
+# 覆盖/补充上面的内置文本；文件新增或修改后缓存自动失效，无需重启。
+_page_bundles = {}    # (page_module, language) -> 页面使用的全部文本
+_lookup_bundles = {}  # (module, language) -> get_localized_string 使用的完整回退结果
+_strings = LOCALIZATION_STRINGS  # 内置文本 + 语言文件
+_locales_signature = None
+_locales_checked_at = 0.0
+_bundles_lock = threading.Lock()
 
-    # 其次尝试获取全局文本
-    if key in LOCALIZATION_STRINGS["global"].get(language, {}):
-        return LOCALIZATION_STRINGS["global"][language][key]
 
-    # 如果找不到任何翻译，则回退到英文版本（默认）
-    default_lang = "en"
-    if module in LOCALIZATION_STRINGS and key in LOCALIZATION_STRINGS[module].get(default_lang, {}):
-        return LOCALIZATION_STRINGS[module][default_lang][key]
-    if key in LOCALIZATION_STRINGS["global"].get(default_lang, {}):
-        return LOCALIZATION_STRINGS["global"][default_lang][key]
+def _scan_locales() -> tuple:
+    """语言文件的签名 (文件名, mtime_ns, size)，用于判断是否需要重新加载"""
+    try:
+        entries = sorted(
+            (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size)
+            for entry in os.scandir(LOCALES_DIR) if entry.name.endswith(".json")
+        )
+    except FileNotFoundError:
+        return ()
+    return tuple(entries)
 
-    # 如果连默认英文都找不到，则返回一个错误提示
-    return f"[[MISSING_KEY: {module}.{key}]]"
 
+def _load_locales() -> dict:
+    """内置文本合并 LOCALES_DIR 中的语言文件"""
+    merged = {module: {lang: dict(texts) for lang, texts in langs.items()}
+              for module, langs in LOCALIZATION_STRINGS.items()}
+    for name, _, _ in _locales_signature:
+        language = name[:-len(".json")]
+        try:
+            with open(os.path.join(LOCALES_DIR, name), 'r', encoding='utf-8') as f:
+                modules = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Failed to load locale file {name}: {e}")
+            continue
+        for module, texts in modules.items():
+            merged.setdefault(module, {}).setdefault(language, {}).update(texts)
+    return merged
 
-# (主函数 get_localization_for_page 保持不变)
-def get_localization_for_page(page_module: str, language: str) -> dict:
-    """返回给定页面和语言的所有本地化字符串"""
 
-    # 收集当前页面所需的文本
+def _check_locales():
+    """最多每 LOCALES_RELOAD_INTERVAL 秒检查一次语言文件，有变化时清空缓存"""
+    global _strings, _locales_signature, _locales_checked_at
+    now = time.monotonic()
+    if _locales_signature is not None and now - _locales_checked_at < LOCALES_RELOAD_INTERVAL:
+        return
+    with _bundles_lock:
+        _locales_checked_at = now
+        signature = _scan_locales()
+        if signature == _locales_signature:
+            return
+        _locales_signature = signature
+        _strings = _load_locales() if signature else LOCALIZATION_STRINGS
+        _page_bundles.clear()
+        _lookup_bundles.clear()
+        if signature:
+            print(f"🌐 Loaded {len(signature)} locale file(s) from {LOCALES_DIR}")
+
+
+def invalidate_localization_cache():
+    """立即清空缓存 (例如在运行时修改了 LOCALIZATION_STRINGS)"""
+    global _locales_signature
+    with _bundles_lock:
+        _locales_signature = None
+        _page_bundles.clear()
+        _lookup_bundles.clear()
+
+
+def _build_lookup_bundle(module: str, language: str) -> MappingProxyType:
+    # 回退顺序: 模块[语言] > 全局[语言] > 模块[en] > 全局[en]
+    default_lang = "en"
+    merged = {}
+    for source, lang in (("global", default_lang), (module, default_lang), ("global", language), (module, language)):
+        merged.update(_strings.get(source, {}).get(lang, {}))
+    return MappingProxyType(merged)
+
+
+def _build_page_bundle(page_module: str, language: str) -> MappingProxyType:
     strings = {}
 
     # 1. 收集全局文本 (确保所有全局文本都存在)
-    for key, value_dict in LOCALIZATION_STRINGS["global"]["en"].items():
+    global_lang = _strings["global"].get(language, {})
+    for key, default_value in _strings["global"]["en"].items():
         # 尝试获取用户语言，失败则使用英文默认
-        strings[key] = LOCALIZATION_STRINGS["global"].get(language, {}).get(key, value_dict)
+        strings[key] = global_lang.get(key, default_value)
 
     # 2. 收集模块特定文本
-    page_data = LOCALIZATION_STRINGS.get(page_module, {})
+    page_data = _strings.get(page_module, {})
     # 尝试获取用户语言，失败则使用英文默认
-    lang_data = page_data.get(language, page_data.get("en", {}))
-    strings.update(lang_data)
+    strings.update(page_data.get(language, page_data.get("en", {})))
+
+    return MappingProxyType(strings)
+
+
+def get_localized_string(module: str, key: str, language: str) -> str:
+    """从本地化字典中安全地获取指定语言的文本"""
+    _check_locales()
+    bundle = _lookup_bundles.get((module, language))
+    if bundle is None:
+        bundle = _lookup_bundles[(module, language)] = _build_lookup_bundle(module, language)
+
+    # 如果连默认英文都找不到，则返回一个错误提示
+    return bundle.get(key, f"[[MISSING_KEY: {module}.{key}]]")
+
 
-    return strings
\ No newline at end of file
+def get_localization_for_page(page_module: str, language: str):
+    """返回给定页面和语言的所有本地化字符串 (只读映射，多个请求共享)"""
+    _check_locales()
+    bundle = _page_bundles.get((page_module, language))
+    if bundle is None:
+        bundle = _page_bundles[(page_module, language)] = _build_page_bundle(page_module, language)
+    return bundle
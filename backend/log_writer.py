@@ -0,0 +1,255 @@
+# backend/log_writer.py
+#
+# 参与者 JSONL 记录的后台写入线程 (group commit)。
+# 请求线程只把记录放入队列；后台线程保持文件句柄打开，把所有参与者的记录攒成批次，
+# 按时间间隔或字节阈值写入，并按持久化模式 fsync：
+#   "always":   每条记录在返回前都已 fsync (同一批次的记录共享一次 fsync)；
+#   "interval": 每 flush_interval_ms 毫秒写入并 fsync 一次，调用方不等待；
+#   "none":     每批写入操作系统缓存，不主动 fsync。
+# 写入器的模式决定后台刷新节奏；单条记录可以用 append(..., durability="always") 要求等待 fsync
+# (例如问卷数据，而高频的对话回合记录使用 "interval")。
+# 不等待的记录写入失败时按文件记下错误，下一次对同一文件的 append() (以及 flush()) 返回 False，
+# 使调用方能发现数据丢失；其他文件的写入不受影响。
+
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+from backend import metrics
+
+DURABILITY_MODES = ("always", "interval", "none")
+
+
+class _Barrier:
+    """flush() 使用的标记：后台线程处理到这里时写完并 fsync 之前的所有记录"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class _Ticket:
+    """'always' 模式下调用方等待自己的记录被 fsync"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+
+
+_STOP = object()
+
+# 追加写入只需要持久化数据和文件长度，fdatasync 可以跳过无关的元数据 (如 mtime)
+_datasync = getattr(os, "fdatasync", os.fsync)
+
+_write_errors = metrics.counter("record_write_errors_total", "JSONL record writes (per file and batch) that failed to reach disk")
+
+
+class RecordWriter:
+    """后台 JSONL 记录写入器"""
+
+    def __init__(self, durability: str = "interval", flush_interval_ms: int = 200,
+                 flush_bytes: int = 64 * 1024, max_open_files: int = 64, ack_timeout_s: float = 10.0):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Invalid durability mode: {durability}. Must be one of {DURABILITY_MODES}")
+        self.durability = durability
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.flush_bytes = flush_bytes
+        self.max_open_files = max_open_files
+        self.ack_timeout = ack_timeout_s  # 'always' 记录等待 fsync 的最长时间
+
+        # path -> 不等待的记录写入失败时的错误描述 (下一次对该文件的 append 或 flush 时报告)
+        self._failed = {}
+        self._failed_lock = threading.Lock()
+
+        self._queue = queue.Queue()
+        self._files = OrderedDict()  # path -> fd (LRU)
+        self._known_dirs = set()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="record-writer", daemon=True)
+        self._thread.start()
+
+    # --- 请求线程调用的接口 ---
+
+    def append(self, path: str, line: str, durability: str = None) -> bool:
+        """
+        追加一行记录 (不含换行符)。durability 默认为写入器的模式。
+        'always' 时阻塞到记录已 fsync，并返回是否成功 (超过 ack_timeout 秒返回 False)；
+        其他模式立即返回 True。
+        记录总是会放入队列；但之前对同一文件不等待的记录写入失败、或后台线程已停止时返回 False。
+        """
+        if self._closed:
+            raise RuntimeError("RecordWriter is closed")
+        data = (line + "\n").encode("utf-8")
+        ticket = _Ticket() if (durability or self.durability) == "always" else None
+        healthy = self._check_healthy([path])
+        self._queue.put((path, data, ticket))
+        if ticket is None:
+            return healthy
+        if not self._thread.is_alive():
+            return False
+        if not ticket.done.wait(self.ack_timeout):
+            print(f"❌ Timed out after {self.ack_timeout}s waiting for a record to reach disk: {path}")
+            return False
+        return ticket.ok and healthy
+
+    def _check_healthy(self, paths=None) -> bool:
+        """
+        后台线程是否在运行，且 paths 中的文件 (None 表示所有文件) 之前没有写入失败。
+        写入失败只报告一次 (报告后清除)。
+        """
+        if not self._thread.is_alive():
+            print("❌ Record writer thread is not running; records cannot be saved")
+            return False
+        with self._failed_lock:
+            if paths is None:
+                failed = list(self._failed.values())
+                self._failed.clear()
+            else:
+                failed = [self._failed.pop(p) for p in paths if p in self._failed]
+        for error in failed:
+            print(f"❌ Earlier records were not saved: {error}")
+        return not failed
+
+    def queue_depth(self) -> int:
+        """队列中尚未被后台线程取出的条目数 (近似值)"""
+        return self._queue.qsize()
+
+    def flush(self, timeout: float = None) -> bool:
+        """等待到目前为止放入队列的记录全部写入并 fsync"""
+        if self._closed:
+            return True
+        if not self._check_healthy():
+            return False
+        barrier = _Barrier()
+        self._queue.put(barrier)
+        return barrier.done.wait(timeout) and self._check_healthy()
+
+    def close(self):
+        """写完剩余记录、fsync 并关闭所有文件 (进程退出时自动调用)"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+
+    # --- 后台线程 ---
+
+    def _run(self):
+        batch = OrderedDict()  # path -> [bytes, ...]
+        tickets = []  # [(path, _Ticket), ...]
+        unacked = set()  # 批次中有调用方没有等待的记录的文件
+        barriers = []
+        batch_bytes = 0
+        last_sync = time.monotonic()
+        stopping = False
+
+        while not stopping:
+            # 决定等待多久：有未写入的数据时最多等到下一个刷新时刻
+            if not batch:
+                timeout = None
+            elif tickets or self.durability == "always":
+                timeout = 0
+            else:
+                timeout = max(0.0, self.flush_interval - (time.monotonic() - last_sync))
+
+            try:
+                item = self._queue.get(timeout=timeout) if timeout != 0 else self._queue.get_nowait()
+            except queue.Empty:
+                item = None
+
+            # 取出队列中已有的所有记录，组成一个批次
+            while item is not None:
+                if item is _STOP:
+                    stopping = True
+                elif isinstance(item, _Barrier):
+                    barriers.append(item)
+                else:
+                    path, data, ticket = item
+                    batch.setdefault(path, []).append(data)
+                    batch_bytes += len(data)
+                    if ticket is not None:
+                        tickets.append((path, ticket))
+                    else:
+                        unacked.add(path)
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+
+            due = (time.monotonic() - last_sync) >= self.flush_interval
+            if stopping or barriers or tickets or batch_bytes >= self.flush_bytes or (batch and due) \
+                    or self.durability == "always":
+                failed = self._write_batch(batch, sync=(self.durability != "none" or stopping or bool(barriers)
+                                                        or bool(tickets)))
+                if failed & unacked:
+                    # 没有调用方在等待这些记录：下一次对同一文件的 append (或 flush) 报告失败
+                    with self._failed_lock:
+                        for path in failed & unacked:
+                            self._failed[path] = f"write to {path} failed"
+                for path, ticket in tickets:
+                    ticket.ok = path not in failed
+                    ticket.done.set()
+                for barrier in barriers:
+                    barrier.done.set()
+                batch = OrderedDict()
+                tickets = []
+                unacked = set()
+                barriers = []
+                batch_bytes = 0
+                last_sync = time.monotonic()
+
+        for fd in self._files.values():
+            os.close(fd)
+        self._files.clear()
+
+    def _open(self, path: str) -> int:
+        fd = self._files.get(path)
+        if fd is not None:
+            self._files.move_to_end(path)
+            return fd
+        directory = os.path.dirname(path)
+        if directory not in self._known_dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._known_dirs.add(directory)
+        # O_APPEND + 每个文件每批一次 write()：多个进程同时追加也不会交错半行
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._files[path] = fd
+        while len(self._files) > self.max_open_files:
+            _, old_fd = self._files.popitem(last=False)
+            os.close(old_fd)
+        return fd
+
+    def _write_batch(self, batch: dict, sync: bool) -> set:
+        """写入一个批次，返回写入失败的文件路径"""
+        failed = set()
+        for path, chunks in batch.items():
+            try:
+                fd = self._open(path)
+                data = b"".join(chunks)
+                while data:
+                    written = os.write(fd, data)
+                    data = data[written:]
+                if sync:
+                    _datasync(fd)
+            except OSError as e:
+                failed.add(path)
+                _write_errors.inc()
+                print(f"❌ Failed to write records to {path}: {e}")
+        return failed
+
+
+_default_writer = None
+_default_writer_lock = threading.Lock()
+
+
+def get_record_writer(durability: str, flush_interval_ms: int, flush_bytes: int,
+                      ack_timeout_s: float = 10.0) -> RecordWriter:
+    """进程内共享的写入器 (第一次使用时创建，进程退出时自动 flush 并关闭)"""
+    global _default_writer
+    with _default_writer_lock:
+        if _default_writer is None:
+            _default_writer = RecordWriter(durability, flush_interval_ms, flush_bytes, ack_timeout_s=ack_timeout_s)
+            atexit.register(_default_writer.close)
+        return _default_writer
@@ -0,0 +1,227 @@
+# backend/metrics.py
+#
+# 进程内的指标注册表 (计数器、仪表、直方图)，通过本地 /metrics 以 Prometheus 文本格式导出。
+# 请求线程中的 inc() / observe() 只做一次 deque.append (CPython 中是原子操作，无需加锁)；
+# 样本在读取 (snapshot / 抓取) 时才汇总，读取方承担汇总开销，抓取不会阻塞请求路径。
+
+import bisect
+import threading
+from collections import deque
+
+# 毫秒级延迟的默认分桶上界
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+# 本地 I/O 和渲染等快速操作的分桶上界 (毫秒)
+FAST_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+# token 数 / 每秒 token 数的默认分桶上界
+COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2000, 4000)
+
+# 未汇总的样本超过该数量时由写入方顺便汇总 (避免长时间无人读取时无限增长)
+_MAX_PENDING = 4096
+
+
+class _PendingMetric:
+    """无锁写入的公共部分：写入追加到 _pending，读取时在锁内汇总"""
+
+    def __init__(self, name: str, help_text: str, labels: tuple):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._pending = deque()
+        self._lock = threading.Lock()
+
+    def _append(self, value):
+        self._pending.append(value)
+        if len(self._pending) > _MAX_PENDING and self._lock.acquire(blocking=False):
+            try:
+                self._drain()
+            finally:
+                self._lock.release()
+
+    def _drain(self):
+        pending = self._pending
+        while True:
+            try:
+                value = pending.popleft()
+            except IndexError:
+                return
+            self._apply(value)
+
+    def _apply(self, value):
+        raise NotImplementedError
+
+
+class Counter(_PendingMetric):
+    """只增不减的计数器"""
+    TYPE = "counter"
+
+    def __init__(self, name: str, help_text: str = "", labels: tuple = ()):
+        super().__init__(name, help_text, labels)
+        self._value = 0
+
+    def inc(self, amount: float = 1):
+        self._append(amount)
+
+    def _apply(self, value):
+        self._value += value
+
+    def value(self) -> float:
+        with self._lock:
+            self._drain()
+            return self._value
+
+
+class Gauge(_PendingMetric):
+    """
+    可增可减的当前值。也可以用 set_function(fn) 在抓取时才计算 (例如会话数、队列长度)，
+    请求路径上没有任何开销。
+    """
+    TYPE = "gauge"
+
+    def __init__(self, name: str, help_text: str = "", labels: tuple = ()):
+        super().__init__(name, help_text, labels)
+        self._value = 0
+        self._function = None
+
+    def inc(self, amount: float = 1):
+        self._append(amount)
+
+    def dec(self, amount: float = 1):
+        self._append(-amount)
+
+    def set_function(self, fn):
+        self._function = fn
+
+    def _apply(self, value):
+        self._value += value
+
+    def value(self) -> float:
+        if self._function is not None:
+            try:
+                return self._function()
+            except Exception as e:
+                print(f"⚠️ Gauge {self.name} callback failed: {e}")
+                return float("nan")
+        with self._lock:
+            self._drain()
+            return self._value
+
+
+class Histogram(_PendingMetric):
+    """累计分桶直方图，另外保留最近的样本用于计算分位数"""
+    TYPE = "histogram"
+
+    def __init__(self, name: str, buckets=LATENCY_BUCKETS_MS, help_text: str = "", labels: tuple = (),
+                 recent: int = 2048):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._recent = deque(maxlen=recent)
+        self._bucket_counts = [0] * (len(self.buckets) + 1)  # 最后一个为 +Inf
+        self._count = 0
+        self._sum = 0.0
+
+    def observe(self, value: float):
+        if value is None:
+            return
+        self._append(value)
+
+    def _apply(self, value):
+        self._bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._count += 1
+        self._sum += value
+        self._recent.append(value)
+
+    def snapshot(self) -> dict:
+        """count / sum / 累计分桶 [(上界, 数量), ...] 以及最近样本的 p50 / p90 / p99 / max"""
+        with self._lock:
+            self._drain()
+            cumulative = []
+            running = 0
+            for bound, count in zip(self.buckets + (float("inf"),), self._bucket_counts):
+                running += count
+                cumulative.append((bound, running))
+            recent = sorted(self._recent)
+            snapshot = {"count": self._count, "sum": round(self._sum, 3), "buckets": cumulative}
+        if recent:
+            def quantile(q):
+                return recent[min(len(recent) - 1, int(q * len(recent)))]
+            snapshot.update(p50=quantile(0.5), p90=quantile(0.9), p99=quantile(0.99), max=recent[-1])
+        return snapshot
+
+
+# === 注册表 ===
+# Key: (name, labels) ；labels 为排序后的 ((key, value), ...)
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def _get_or_create(cls, name: str, labels: dict, **kwargs):
+    key = (name, tuple(sorted(labels.items())) if labels else ())
+    metric = _metrics.get(key)
+    if metric is None:
+        with _metrics_lock:
+            metric = _metrics.get(key)
+            if metric is None:
+                metric = _metrics[key] = cls(name, labels=key[1], **kwargs)
+    if not isinstance(metric, cls):
+        raise TypeError(f"Metric {name} is already registered as a {metric.TYPE}")
+    return metric
+
+
+def counter(name: str, help_text: str = "", labels: dict = None) -> Counter:
+    """按名称和标签获取 (第一次调用时创建) 计数器"""
+    return _get_or_create(Counter, name, labels, help_text=help_text)
+
+
+def gauge(name: str, help_text: str = "", labels: dict = None) -> Gauge:
+    """按名称和标签获取 (第一次调用时创建) 仪表"""
+    return _get_or_create(Gauge, name, labels, help_text=help_text)
+
+
+def histogram(name: str, buckets=LATENCY_BUCKETS_MS, help_text: str = "", labels: dict = None) -> Histogram:
+    """按名称和标签获取 (第一次调用时创建) 直方图"""
+    return _get_or_create(Histogram, name, labels, buckets=buckets, help_text=help_text)
+
+
+def snapshot_histograms() -> dict:
+    """所有 (无标签) 直方图的快照 {name: snapshot}"""
+    return {name: metric.snapshot() for (name, labels), metric in list(_metrics.items())
+            if isinstance(metric, Histogram) and not labels}
+
+
+def _format_labels(labels: tuple, extra: tuple = ()) -> str:
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_prometheus() -> str:
+    """所有指标的 Prometheus 文本格式 (text/plain; version=0.0.4)"""
+    by_name = {}
+    for (name, _), metric in sorted(list(_metrics.items()), key=lambda item: item[0]):
+        by_name.setdefault(name, []).append(metric)
+
+    lines = []
+    for name, family in by_name.items():
+        first = family[0]
+        if first.help_text:
+            lines.append(f"# HELP {name} {first.help_text}")
+        lines.append(f"# TYPE {name} {first.TYPE}")
+        for metric in family:
+            if isinstance(metric, Histogram):
+                snapshot = metric.snapshot()
+                for bound, count in snapshot["buckets"]:
+                    le = (("le", _format_value(bound)),)
+                    lines.append(f"{name}_bucket{_format_labels(metric.labels, le)} {count}")
+                lines.append(f"{name}_sum{_format_labels(metric.labels)} {_format_value(snapshot['sum'])}")
+                lines.append(f"{name}_count{_format_labels(metric.labels)} {snapshot['count']}")
+            else:
+                lines.append(f"{name}{_format_labels(metric.labels)} {_format_value(metric.value())}")
+    return "\n".join(lines) + "\n"
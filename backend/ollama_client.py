@@ -0,0 +1,229 @@
+# backend/ollama_client.py
+
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+from backend.config import (
+    OLLAMA_API_URL, OLLAMA_POOL_SIZE, OLLAMA_CONNECT_TIMEOUT,
+    OLLAMA_MAX_RETRIES, OLLAMA_RETRY_BACKOFF
+)
+
+# httpx 仅在 ASGI (asyncio) 模式下需要
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+AsyncRequestError = httpx.HTTPError if httpx is not None else OSError
+
+# 记录当前线程中建立 TCP 连接所花费的时间 (复用连接时保持为 0)
+_connect_timing = threading.local()
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    """在 connect() 时记录耗时的 HTTP 连接"""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _connect_timing.seconds = getattr(_connect_timing, 'seconds', 0.0) + (time.perf_counter() - start)
+            _connect_timing.count = getattr(_connect_timing, 'count', 0) + 1
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    """在 connect() 时记录耗时的 HTTPS 连接"""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _connect_timing.seconds = getattr(_connect_timing, 'seconds', 0.0) + (time.perf_counter() - start)
+            _connect_timing.count = getattr(_connect_timing, 'count', 0) + 1
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    """使用计时连接的 HTTPAdapter"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+class RequestTiming:
+    """一次 Ollama 请求的延迟分解：连接建立 / 响应头 / 首字节 / 结束"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.connect_s = 0.0
+        self.new_connections = 0
+        self.headers_s = None
+        self.first_byte_s = None
+        self.end_s = None
+
+    def mark_first_byte(self):
+        if self.first_byte_s is None:
+            self.first_byte_s = time.perf_counter() - self.start
+
+    def mark_end(self):
+        if self.end_s is None:
+            self.end_s = time.perf_counter() - self.start
+
+    def as_dict(self) -> dict:
+        def to_ms(value):
+            return None if value is None else round(value * 1000, 2)
+
+        return {
+            "connect_ms": to_ms(self.connect_s),
+            "headers_ms": to_ms(self.headers_s),
+            "first_byte_ms": to_ms(self.first_byte_s),
+            "end_ms": to_ms(self.end_s),
+            "new_connection": self.new_connections > 0
+        }
+
+    def __str__(self):
+        d = self.as_dict()
+        conn = "new connection" if d["new_connection"] else "reused connection"
+        return f"connect {d['connect_ms']}ms ({conn}), headers {d['headers_ms']}ms, first byte {d['first_byte_ms']}ms"
+
+
+def _create_session() -> requests.Session:
+    """创建带连接池、keep-alive 和连接重试的共享 Session"""
+    retry = Retry(
+        total=OLLAMA_MAX_RETRIES,
+        connect=OLLAMA_MAX_RETRIES,
+        read=0,  # 不重试读取错误 (生成请求代价高)
+        status=0,
+        other=0,
+        backoff_factor=OLLAMA_RETRY_BACKOFF,
+        raise_on_status=False
+    )
+    adapter = _TimedHTTPAdapter(
+        pool_connections=1,  # 只连接一个 Ollama 主机
+        pool_maxsize=OLLAMA_POOL_SIZE,
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# === 全局共享的 HTTP 客户端 ===
+_session = _create_session()
+
+
+def post_generate(payload: dict, stream: bool, read_timeout: float):
+    """
+    向 Ollama /api/generate 发送请求 (复用连接池中的连接)。
+    返回 (response, RequestTiming)。
+    """
+    _connect_timing.seconds = 0.0
+    _connect_timing.count = 0
+    timing = RequestTiming()
+    response = _session.post(
+        OLLAMA_API_URL,
+        json=payload,
+        stream=stream,
+        timeout=(OLLAMA_CONNECT_TIMEOUT, read_timeout)
+    )
+    timing.headers_s = time.perf_counter() - timing.start
+    timing.connect_s = _connect_timing.seconds
+    timing.new_connections = _connect_timing.count
+    return response, timing
+
+
+def release(response, drain: bool = False):
+    """
+    释放流式响应的连接。
+    drain=True 时读完剩余数据，使连接可以放回连接池复用；
+    否则 (例如客户端中途断开) 直接关闭连接，避免等待模型生成完毕。
+    """
+    if response is None:
+        return
+    if drain:
+        try:
+            response.raw.drain_conn()
+            response.raw.release_conn()
+            return
+        except Exception:
+            pass
+    response.close()
+
+
+# === asyncio 客户端 (ASGI 模式) ===
+# httpx.AsyncClient 绑定在创建它的事件循环上，因此延迟到第一次使用时创建
+_async_client = None
+
+
+def get_async_client():
+    """获取 (或创建) 共享的异步 HTTP 客户端"""
+    global _async_client
+    if httpx is None:
+        raise RuntimeError("The ASGI serving mode requires httpx: pip install httpx")
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=None,  # 并发流的数量由调用方控制
+                max_keepalive_connections=OLLAMA_POOL_SIZE
+            ),
+            # httpx 的 transport 重试只针对连接错误 (不带退避)
+            transport=httpx.AsyncHTTPTransport(retries=OLLAMA_MAX_RETRIES)
+        )
+    return _async_client
+
+
+async def close_async_client():
+    """关闭异步客户端 (在 ASGI lifespan shutdown 时调用)"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+async def post_generate_async(payload: dict, read_timeout: float):
+    """
+    post_generate 的异步版本，始终以流式方式发送请求。
+    返回 (httpx.Response, RequestTiming)，调用方负责 await response.aclose()。
+    """
+    client = get_async_client()
+    timing = RequestTiming()
+    connect_started = []
+
+    async def trace(event_name, info):
+        # httpcore 的 trace 事件: 记录 TCP 连接建立的耗时
+        if event_name == "connection.connect_tcp.started":
+            connect_started.append(time.perf_counter())
+        elif event_name == "connection.connect_tcp.complete" and connect_started:
+            timing.connect_s += time.perf_counter() - connect_started.pop()
+            timing.new_connections += 1
+
+    request = client.build_request(
+        "POST",
+        OLLAMA_API_URL,
+        json=payload,
+        timeout=httpx.Timeout(read_timeout, connect=OLLAMA_CONNECT_TIMEOUT),
+        extensions={"trace": trace}
+    )
+    response = await client.send(request, stream=True)
+    timing.headers_s = time.perf_counter() - timing.start
+    return response, timing
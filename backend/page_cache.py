@@ -0,0 +1,74 @@
+# backend/page_cache.py
+#
+# 已渲染页面的 LRU 缓存。
+# 对同一个 (模板, 本地化模块, 语言, context) 渲染结果是确定的 (context 只有步骤索引、
+# 步骤名和条件标志)，所以刷新页面或 redirect_to_expected_step 跳转时可以直接返回缓存的 HTML。
+# 每个条目同时保存渲染时使用的模板对象和本地化映射：模板被重新加载 (开发模式) 或
+# 本地化文本变化后它们会被替换为新对象，旧条目因此自动失效。
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class CachedPage:
+    __slots__ = ("template", "strings", "html", "etag")
+
+    def __init__(self, template, strings, html: str):
+        self.template = template
+        self.strings = strings
+        self.html = html
+        self.etag = '"' + hashlib.sha256(html.encode("utf-8")).hexdigest()[:32] + '"'
+
+
+class RenderedPageCache:
+    """有上限的 LRU 缓存 (max_entries=0 时不缓存)"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(template_name: str, module_name: str, language: str, context: dict):
+        """context 中有不可哈希的值时返回 None (不缓存)"""
+        try:
+            items = tuple(sorted(context.items())) if context else ()
+            key = (template_name, module_name, language, items)
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key, template, strings):
+        """返回仍然有效的缓存页面；模板或本地化文本已变化时返回 None"""
+        if key is None or self.max_entries <= 0:
+            return None
+        with self._lock:
+            page = self._entries.get(key)
+            if page is not None and page.template is template and page.strings is strings:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return page
+            self.misses += 1
+            return None
+
+    def put(self, key, template, strings, html: str) -> CachedPage:
+        page = CachedPage(template, strings, html)
+        if key is None or self.max_entries <= 0:
+            return page
+        with self._lock:
+            self._entries[key] = page
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return page
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
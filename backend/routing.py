@@ -0,0 +1,127 @@
+# backend/routing.py
+#
+# 实验步骤的路由表：启动时根据 config.EXPERIMENT_STEPS / VERSION_MAP / INSTRUCTION_VERSION_MAP
+# 一次性生成 (步骤索引, 条件) -> (URL, 文件名, 本地化模块)，并在生成时校验。
+# 请求处理时只做字典查找，不再逐个比较步骤名或解析 URL。
+
+import os
+from typing import NamedTuple
+
+from backend.config import EXPERIMENT_STEPS, VERSION_MAP, INSTRUCTION_VERSION_MAP
+from backend.localization import LOCALIZATION_STRINGS
+
+HTML_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "html")
+
+# 条件未知时使用的默认条件 (与之前 get_url_for_step 的回退行为一致)
+DEFAULT_CONDITION = "NON_XAI"
+
+# 步骤 (去掉 _1 / _2 后缀) -> (页面, 本地化模块)
+# 页面为 dict 时表示按 *当前* 条件选择页面
+_STEP_PAGES = {
+    "DEMOGRAPHICS": ("/html/demographics.html", "demographics"),
+    "BASELINE_MOOD": ("/html/baseline_mood.html", "baseline_mood"),
+    "INSTRUCTIONS": (INSTRUCTION_VERSION_MAP, "instructions"),
+    "DIALOGUE": (VERSION_MAP, "chat_interface"),
+    "POST_QUESTIONNAIRE": ("/html/post_questionnaire.html", "post_questionnaire"),  # 两个问卷使用同一个文件
+    "WASHOUT": ("/html/washout.html", "washout"),
+    "OPEN_ENDED_QS": ("/html/open_ended_qs.html", "open_ended_qs"),
+    "DEBRIEF": ("/html/debrief.html", "debrief"),
+}
+
+
+class StepRoute(NamedTuple):
+    index: int       # 在 EXPERIMENT_STEPS 中的索引 (Debrief 之后为 len(EXPERIMENT_STEPS))
+    step_key: str    # 例如 "DIALOGUE_2"
+    url_path: str    # 例如 "/html/XAI_Version.html" (不含 pid)
+    filename: str    # 例如 "XAI_Version.html"
+    module: str      # 本地化模块名，例如 "chat_interface"
+
+    def url(self, participant_id: str) -> str:
+        return f"{self.url_path}?pid={participant_id}"
+
+
+def _base_step(step_key: str) -> str:
+    """"DIALOGUE_2" -> "DIALOGUE"; 没有数字后缀的步骤保持不变"""
+    base, _, suffix = step_key.rpartition("_")
+    return base if base and suffix.isdigit() else step_key
+
+
+class RoutingTable:
+    """(步骤, 条件) -> StepRoute 的查找表，以及文件名 -> 步骤的反向查找"""
+
+    def __init__(self, steps, version_map: dict, instruction_version_map: dict):
+        self.steps = tuple(steps)
+        self.conditions = tuple(version_map)
+        self._index = {step_key: i for i, step_key in enumerate(self.steps)}
+        self._routes = {}       # (index, condition) -> StepRoute
+        self._by_filename = {}  # filename -> (step index, ...)
+
+        self.validate(version_map, instruction_version_map)
+
+        for i, step_key in enumerate(self.steps):
+            page, module = _STEP_PAGES[_base_step(step_key)]
+            for condition in self.conditions:
+                url_path = page[condition] if isinstance(page, dict) else page
+                route = StepRoute(i, step_key, url_path, url_path.rsplit("/", 1)[-1], module)
+                self._routes[(i, condition)] = route
+                indices = self._by_filename.setdefault(route.filename, ())
+                if i not in indices:
+                    self._by_filename[route.filename] = indices + (i,)
+
+        # 完成所有步骤之后停留在 Debrief
+        url_path, module = _STEP_PAGES["DEBRIEF"]
+        self.finished = StepRoute(len(self.steps), "DEBRIEF", url_path, url_path.rsplit("/", 1)[-1], module)
+        # 尚未开始 (-1) 或索引无效时回到 Consent 页面 (index.html，由 serve_index 处理)
+        self.consent = StepRoute(-1, "CONSENT_AGREEMENT", "/index.html", "index.html", "consent")
+
+    def validate(self, version_map: dict, instruction_version_map: dict):
+        """校验步骤序列和页面映射，配置错误时在启动时抛出 ValueError"""
+        errors = []
+        if len(self._index) != len(self.steps):
+            errors.append("EXPERIMENT_STEPS contains duplicate step keys")
+        for step_key in self.steps:
+            if _base_step(step_key) not in _STEP_PAGES:
+                errors.append(f"no page configured for step {step_key}")
+        for required in ("DIALOGUE_1", "DIALOGUE_2", "WASHOUT"):
+            if required not in self._index:
+                errors.append(f"EXPERIMENT_STEPS is missing required step {required}")
+        if DEFAULT_CONDITION not in version_map:
+            errors.append(f"VERSION_MAP has no {DEFAULT_CONDITION} page")
+        if set(version_map) != set(instruction_version_map):
+            errors.append("VERSION_MAP and INSTRUCTION_VERSION_MAP must define the same conditions")
+
+        pages = set()
+        for page, module in _STEP_PAGES.values():
+            pages.update(page.values() if isinstance(page, dict) else [page])
+            if module not in LOCALIZATION_STRINGS:
+                errors.append(f"no localization module {module}")
+        pages.update(version_map.values())
+        pages.update(instruction_version_map.values())
+        for url_path in sorted(pages):
+            if not os.path.isfile(os.path.join(HTML_DIR, url_path.rsplit("/", 1)[-1])):
+                errors.append(f"page {url_path} does not exist")
+
+        if errors:
+            raise ValueError("Invalid experiment routing: " + "; ".join(errors))
+
+    def index_of(self, step_key: str) -> int:
+        return self._index[step_key]
+
+    def route(self, index: int, condition: str) -> StepRoute:
+        """步骤索引 + 当前条件 -> 页面 (索引超出范围时为 Debrief，-1 或其他无效索引时为 Consent)"""
+        if isinstance(index, int) and index >= len(self.steps):
+            return self.finished
+        route = self._routes.get((index, condition))
+        if route is None:
+            route = self._routes.get((index, DEFAULT_CONDITION), self.consent)
+        return route
+
+    def route_for_step(self, step_key: str, condition: str) -> StepRoute:
+        return self.route(self._index[step_key], condition)
+
+    def steps_for_filename(self, filename: str) -> tuple:
+        """页面文件名 -> 使用该页面的步骤索引 (未知页面返回空元组)"""
+        return self._by_filename.get(filename, ())
+
+
+ROUTES = RoutingTable(EXPERIMENT_STEPS, VERSION_MAP, INSTRUCTION_VERSION_MAP)
@@ -0,0 +1,217 @@
+# backend/sentiment.py
+#
+# 回合级情绪评分 (只用 CPU，不调用 LLM)。
+#   - LexiconSentiment: 基于词典的评分 (VADER 风格，词的效价范围 -4 ~ +4，处理否定词，
+#     归一化为 -1 ~ +1 的 compound 分数)。英文按单词匹配，中文等 CJK 词按子串匹配。
+#     词典在启动时加载一次；可用 SENTIMENT_LEXICON_PATH 指定 VADER 格式的词典文件
+#     (每行 "词<TAB>效价[<TAB>...]")，未指定时使用内置的小词典。
+#   - SentimentWorker: 后台线程池。/chat 在回合记录写入后只投递任务，不等待评分；
+#     工作线程每次取出一批任务一起评分，再通过回调写入 DIALOGUE_TURN_SENTIMENT 记录。
+# 一条消息的评分只需要几十微秒，一个线程即可跟上整个实验室的对话速度。
+
+import math
+import queue
+import re
+import threading
+
+# 内置词典 (效价与 VADER 词典同一尺度)
+_BUILTIN_LEXICON = {
+    # English
+    "happy": 2.7, "glad": 2.0, "joy": 2.8, "love": 3.2, "loved": 2.9, "like": 1.5, "enjoy": 2.2,
+    "good": 1.9, "great": 3.1, "better": 1.9, "best": 3.2, "nice": 1.8, "fine": 0.8, "calm": 1.3,
+    "relaxed": 2.2, "relieved": 1.6, "hope": 1.9, "hopeful": 2.3, "grateful": 2.0, "thanks": 1.9,
+    "thank": 1.5, "excited": 1.4, "proud": 2.1, "safe": 1.9, "support": 1.7, "supported": 1.8,
+    "understand": 1.0, "helpful": 1.8, "comfort": 1.5, "fun": 2.3, "wonderful": 2.7, "okay": 0.9,
+    "sad": -2.1, "unhappy": -1.8, "depressed": -2.3, "lonely": -2.0, "alone": -1.0, "cry": -2.1,
+    "crying": -2.1, "hurt": -2.4, "pain": -2.3, "angry": -2.3, "mad": -2.2, "upset": -1.6,
+    "anxious": -1.0, "anxiety": -0.7, "worried": -1.2, "worry": -1.9, "stress": -1.8, "stressed": -1.4,
+    "stressful": -2.0, "afraid": -2.2, "scared": -1.9, "fear": -2.2, "tired": -1.9, "exhausted": -1.5,
+    "bad": -2.5, "worse": -2.1, "worst": -3.1, "terrible": -2.1, "awful": -2.0, "hate": -2.7,
+    "frustrated": -2.4, "annoyed": -1.6, "hopeless": -2.0, "guilty": -1.8, "ashamed": -2.1,
+    "embarrassed": -1.5, "miserable": -2.2, "wrong": -2.1, "fail": -2.5, "failed": -2.3,
+    "problem": -1.7, "difficult": -1.5, "hard": -0.4, "sorry": -0.3, "down": -0.6,
+    # 中文
+    "开心": 2.6, "高兴": 2.5, "快乐": 2.7, "幸福": 2.8, "喜欢": 1.8, "爱": 3.0, "满意": 1.9,
+    "放松": 2.0, "轻松": 1.8, "平静": 1.3, "安心": 1.8, "希望": 1.9, "感谢": 2.0, "谢谢": 1.9,
+    "好": 1.5, "不错": 1.9, "很棒": 2.9, "兴奋": 1.6, "骄傲": 2.0, "温暖": 2.0, "支持": 1.7,
+    "难过": -2.2, "伤心": -2.3, "悲伤": -2.3, "痛苦": -2.6, "孤独": -2.0, "寂寞": -1.9, "哭": -2.0,
+    "生气": -2.3, "愤怒": -2.6, "烦": -1.6, "烦躁": -1.8, "焦虑": -1.6, "担心": -1.4, "害怕": -2.1,
+    "紧张": -1.2, "压力": -1.5, "累": -1.5, "疲惫": -1.7, "失望": -2.1, "绝望": -2.9, "讨厌": -2.5,
+    "糟糕": -2.3, "难受": -2.0, "委屈": -1.8, "尴尬": -1.4, "后悔": -1.8, "崩溃": -2.7, "心情不好": -2.0,
+    "失败": -2.3, "郁闷": -1.9, "抑郁": -2.4, "沮丧": -2.1, "搞砸": -2.0,
+}
+
+_NEGATIONS = frozenset((
+    "not", "no", "never", "none", "nobody", "nothing", "neither", "nor", "cannot", "without",
+    "don't", "doesn't", "didn't", "isn't", "aren't", "wasn't", "weren't", "can't", "couldn't",
+    "won't", "wouldn't", "shouldn't", "haven't", "hasn't", "hadn't", "dont", "cant", "isnt", "wont",
+))
+_CJK_NEGATIONS = frozenset("不没别未")
+_NEGATION_SCALAR = -0.74  # 与 VADER 相同：否定词使效价反转并减弱
+_NEGATION_WINDOW = 3      # 前面几个词内出现否定词时视为否定
+_NORMALIZATION_ALPHA = 15  # compound = s / sqrt(s^2 + alpha)
+
+POSITIVE_THRESHOLD = 0.05
+NEGATIVE_THRESHOLD = -0.05
+
+_WORD_RE = re.compile(r"[a-z]+(?:'[a-z]+)?")
+_CJK_RE = re.compile(r"[\u3400-\u9fff\uf900-\ufaff]")
+
+
+def load_lexicon(path: str = None) -> dict:
+    """读取 VADER 格式的词典文件 (词<TAB>效价...)；未指定路径时返回内置词典"""
+    if not path:
+        return dict(_BUILTIN_LEXICON)
+    lexicon = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            parts = line.rstrip("\n").split("\t")
+            if len(parts) < 2 or not parts[0]:
+                continue
+            try:
+                lexicon[parts[0].lower()] = float(parts[1])
+            except ValueError:
+                continue
+    return lexicon
+
+
+def label_for(score: float) -> str:
+    if score >= POSITIVE_THRESHOLD:
+        return "positive"
+    if score <= NEGATIVE_THRESHOLD:
+        return "negative"
+    return "neutral"
+
+
+class LexiconSentiment:
+    """基于词典的情绪评分，score() 返回 -1 ~ +1 的 compound 分数"""
+
+    def __init__(self, lexicon: dict, name: str = "lexicon"):
+        self.name = name
+        self._words = {term: value for term, value in lexicon.items() if not _CJK_RE.search(term)}
+        cjk_terms = sorted((term for term in lexicon if _CJK_RE.search(term)), key=len, reverse=True)
+        self._cjk_values = {term: lexicon[term] for term in cjk_terms}
+        # 长词优先匹配 (例如 "心情不好" 优先于 "好")
+        self._cjk_re = re.compile("|".join(map(re.escape, cjk_terms))) if cjk_terms else None
+
+    def score(self, text: str) -> float:
+        if not text:
+            return 0.0
+        total = 0.0
+        lowered = text.lower()
+
+        words = _WORD_RE.findall(lowered)
+        for i, word in enumerate(words):
+            value = self._words.get(word)
+            if value is None:
+                continue
+            if any(w in _NEGATIONS for w in words[max(0, i - _NEGATION_WINDOW):i]):
+                value *= _NEGATION_SCALAR
+            total += value
+
+        if self._cjk_re is not None:
+            for match in self._cjk_re.finditer(lowered):
+                value = self._cjk_values[match.group()]
+                # 前两个字中有否定词 (例如 "不开心"、"没那么难过")
+                if any(ch in _CJK_NEGATIONS for ch in lowered[max(0, match.start() - 2):match.start()]):
+                    value *= _NEGATION_SCALAR
+                total += value
+
+        if total == 0.0:
+            return 0.0
+        return round(total / math.sqrt(total * total + _NORMALIZATION_ALPHA), 4)
+
+    def score_batch(self, texts) -> list:
+        return [self.score(text) for text in texts]
+
+
+def load_engine(lexicon_path: str = None) -> LexiconSentiment:
+    """加载情绪评分引擎 (启动时调用一次)"""
+    try:
+        lexicon = load_lexicon(lexicon_path)
+        name = f"lexicon:{lexicon_path}" if lexicon_path else "lexicon:builtin"
+    except OSError as e:
+        print(f"⚠️ Sentiment lexicon not loaded from {lexicon_path} ({e}); using the built-in lexicon.")
+        lexicon, name = load_lexicon(None), "lexicon:builtin"
+    print(f"💬 Sentiment engine ready ({name}, {len(lexicon)} terms)")
+    return LexiconSentiment(lexicon, name)
+
+
+class SentimentWorker:
+    """
+    后台情绪评分线程池。
+    - submit() 只把任务放入队列 (非阻塞)，不影响流式回复；
+    - 每个工作线程一次取出最多 batch_size 个任务，一起评分后逐个调用 on_scored(job, scores)。
+    job 为 {"texts": {"user": ..., "agent": ...}, ...}，scores 为 {"user": 分数, "agent": 分数}。
+    """
+
+    def __init__(self, engine, on_scored, num_threads: int = 1, batch_size: int = 32):
+        self.engine = engine
+        self._on_scored = on_scored
+        self.batch_size = batch_size
+        self._jobs = queue.Queue()
+        self._outstanding = {}  # participant_id -> 已投递但回调尚未完成的任务数
+        self._idle = threading.Condition()
+        self._threads = []
+        for i in range(num_threads):
+            t = threading.Thread(target=self._run, name=f"sentiment-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, job: dict):
+        """投递评分任务 (非阻塞)"""
+        participant_id = job.get("participant_id")
+        with self._idle:
+            self._outstanding[participant_id] = self._outstanding.get(participant_id, 0) + 1
+        self._jobs.put(job)
+
+    def wait_idle(self, participant_id: str, timeout: float) -> bool:
+        """等待参与者已投递的任务全部完成 (例如对话结束前)；超时返回 False"""
+        with self._idle:
+            return self._idle.wait_for(lambda: participant_id not in self._outstanding, timeout)
+
+    def _job_done(self, job: dict):
+        participant_id = job.get("participant_id")
+        with self._idle:
+            remaining = self._outstanding.get(participant_id, 0) - 1
+            if remaining > 0:
+                self._outstanding[participant_id] = remaining
+            else:
+                self._outstanding.pop(participant_id, None)
+                self._idle.notify_all()
+
+    def pending_count(self) -> int:
+        """队列中尚未评分的任务数 (近似值)"""
+        return self._jobs.qsize()
+
+    def _next_batch(self) -> list:
+        batch = [self._jobs.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._jobs.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                keys = [key for job in batch for key in job["texts"]]
+                values = self.engine.score_batch([text for job in batch for text in job["texts"].values()])
+            except Exception as e:
+                print(f"⚠️ Sentiment worker error: {e}")
+                for job in batch:
+                    self._job_done(job)
+                continue
+            offset = 0
+            for job in batch:
+                count = len(job["texts"])
+                scores = dict(zip(keys[offset:offset + count], values[offset:offset + count]))
+                offset += count
+                try:
+                    self._on_scored(job, scores)
+                except Exception as e:
+                    print(f"⚠️ Sentiment callback error for PID {job.get('participant_id')}: {e}")
+                finally:
+                    self._job_done(job)
@@ -0,0 +1,127 @@
+# backend/session_store.py
+#
+# 参与者 LLM 会话 (history / summary / turn_count ...) 的存储后端。
+#   - "memory": 保存在本进程内存中 (默认，与之前的 session_data 字典相同)；
+#   - "sqlite": 保存在本地 SQLite 文件中 (WAL 模式)，多个 worker 进程
+#     (例如 gunicorn -w 4) 可以服务同一位参与者，无需外部服务。
+#
+# 所有修改都通过 update(participant_id, fn) 完成：fn 在一个事务内接收最新的会话
+# 并就地修改，因此不同进程/线程的并发修改 (例如后台摘要和回合结束) 不会互相覆盖。
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class InMemorySessionStore:
+    """进程内会话存储 (单进程)"""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._sessions = {}
+        self._lock = threading.RLock()
+
+    def get_or_create(self, participant_id: str) -> dict:
+        """返回参与者的会话 (不存在时创建)"""
+        with self._lock:
+            if participant_id not in self._sessions:
+                self._sessions[participant_id] = self._factory()
+            return self._sessions[participant_id]
+
+    def update(self, participant_id: str, fn):
+        """在锁内对会话执行 fn(session)，返回 fn 的返回值"""
+        with self._lock:
+            return fn(self.get_or_create(participant_id))
+
+    def delete(self, participant_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(participant_id, None) is not None
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SQLiteSessionStore:
+    """
+    SQLite (WAL) 会话存储，可在同一台机器的多个进程间共享。
+    每个线程使用自己的连接；读取返回会话的快照副本。
+    """
+
+    def __init__(self, factory, path: str):
+        self._factory = factory
+        self._path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " participant_id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: 手动控制事务 (BEGIN IMMEDIATE)
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _load(self, conn, participant_id: str):
+        row = conn.execute(
+            "SELECT data FROM sessions WHERE participant_id = ?", (participant_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save(self, conn, participant_id: str, session: dict):
+        conn.execute(
+            "INSERT INTO sessions (participant_id, data, updated_at) VALUES (?, ?, ?)"
+            " ON CONFLICT(participant_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (participant_id, json.dumps(session, ensure_ascii=False), time.time())
+        )
+
+    def get_or_create(self, participant_id: str) -> dict:
+        """返回参与者会话的快照 (不存在时创建)"""
+        conn = self._connect()
+        session = self._load(conn, participant_id)
+        if session is None:
+            session = self.update(participant_id, lambda s: s)
+        return session
+
+    def update(self, participant_id: str, fn):
+        """在一个写事务内读取会话、执行 fn(session) 并写回，返回 fn 的返回值"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            session = self._load(conn, participant_id)
+            if session is None:
+                session = self._factory()
+            result = fn(session)
+            self._save(conn, participant_id, session)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def delete(self, participant_id: str) -> bool:
+        conn = self._connect()
+        cursor = conn.execute("DELETE FROM sessions WHERE participant_id = ?", (participant_id,))
+        return cursor.rowcount > 0
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+
+def create_session_store(backend: str, factory, path: str = None):
+    """根据配置创建会话存储"""
+    if backend == "memory":
+        return InMemorySessionStore(factory)
+    if backend == "sqlite":
+        return SQLiteSessionStore(factory, path)
+    raise ValueError(f"Unknown session store backend: {backend}. Must be 'memory' or 'sqlite'.")
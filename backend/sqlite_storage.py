@@ -0,0 +1,218 @@
+# backend/sqlite_storage.py
+#
+# 参与者记录和状态的 SQLite (WAL) 存储后端 (config.DATA_BACKEND = "sqlite")。
+#   - records: 每条 JSONL 记录一行，按 (participant_id, step) 建索引；
+#   - status:  每位参与者一行，current_step_index / condition 单独成列，便于统计进度。
+# 默认的文件后端 (P_<pid>.jsonl + P_<pid>_status.json) 中已有的数据可以导入：
+#
+#   python -m backend.sqlite_storage import              # 导入 DATA_DIR 中的 JSONL / 状态文件
+#   python -m backend.sqlite_storage progress            # 各参与者当前进度
+#   python -m backend.sqlite_storage export [--participant PID] [--step STEP] > out.jsonl
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS records ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    " participant_id TEXT NOT NULL,"
+    " step TEXT NOT NULL,"
+    " timestamp REAL NOT NULL,"
+    " datetime TEXT,"
+    " data TEXT NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS idx_records_participant_step ON records (participant_id, step)",
+    "CREATE TABLE IF NOT EXISTS status ("
+    " participant_id TEXT PRIMARY KEY,"
+    " current_step_index INTEGER,"
+    " condition TEXT,"
+    " data TEXT NOT NULL,"
+    " updated_at REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS idx_status_step ON status (current_step_index)",
+)
+
+
+class SQLiteStorage:
+    """
+    参与者记录和状态的 SQLite 存储，可在同一台机器的多个进程间共享。
+    每个线程使用自己的连接；状态修改在 BEGIN IMMEDIATE 事务中完成。
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        conn = self._connect()
+        for statement in _SCHEMA:
+            conn.execute(statement)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # isolation_level=None: 手动控制事务 (BEGIN IMMEDIATE)
+            conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # --- 记录 ---
+
+    def append_record(self, record: dict):
+        """写入一条记录 (与 JSONL 中的一行对应)"""
+        self._connect().execute(
+            "INSERT INTO records (participant_id, step, timestamp, datetime, data) VALUES (?, ?, ?, ?, ?)",
+            (record["participant_id"], record["step"], record["timestamp"], record.get("datetime"),
+             json.dumps(record.get("data"), ensure_ascii=False))
+        )
+
+    def get_records(self, participant_id: str = None, step: str = None) -> list:
+        """按参与者和/或步骤查询记录 (按写入顺序)，返回与 JSONL 行相同结构的字典"""
+        clauses, params = [], []
+        if participant_id is not None:
+            clauses.append("participant_id = ?")
+            params.append(participant_id)
+        if step is not None:
+            clauses.append("step = ?")
+            params.append(step)
+        sql = "SELECT timestamp, datetime, participant_id, step, data FROM records"
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY id"
+        return [
+            {"timestamp": row[0], "datetime": row[1], "participant_id": row[2], "step": row[3],
+             "data": json.loads(row[4])}
+            for row in self._connect().execute(sql, params)
+        ]
+
+    # --- 状态 ---
+
+    def get_status(self, participant_id: str) -> dict:
+        row = self._connect().execute(
+            "SELECT data FROM status WHERE participant_id = ?", (participant_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def _save_status(self, conn, participant_id: str, status_data: dict):
+        conn.execute(
+            "INSERT INTO status (participant_id, current_step_index, condition, data, updated_at)"
+            " VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT(participant_id) DO UPDATE SET current_step_index = excluded.current_step_index,"
+            " condition = excluded.condition, data = excluded.data, updated_at = excluded.updated_at",
+            (participant_id, status_data.get("current_step_index"), status_data.get("condition"),
+             json.dumps(status_data, ensure_ascii=False), time.time())
+        )
+
+    @contextmanager
+    def status_transaction(self, participant_id: str):
+        """与 data_manager.status_transaction 相同的语义：读取一次，正常退出且有变化时写回"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            original = self.get_status(participant_id)
+            status_data = dict(original)
+            yield status_data
+            if status_data != original:
+                self._save_status(conn, participant_id, status_data)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def list_progress(self) -> list:
+        """所有参与者的当前进度 (participant_id, current_step_index, condition)，按参与者排序"""
+        return [
+            {"participant_id": row[0], "current_step_index": row[1], "condition": row[2]}
+            for row in self._connect().execute(
+                "SELECT participant_id, current_step_index, condition FROM status ORDER BY participant_id"
+            )
+        ]
+
+    def count_by_step(self) -> dict:
+        """每个步骤索引上的参与者人数"""
+        return dict(self._connect().execute(
+            "SELECT current_step_index, COUNT(*) FROM status GROUP BY current_step_index"
+        ).fetchall())
+
+    # --- 从文件后端导入 ---
+
+    def import_files(self, data_dir: str) -> dict:
+        """
+        导入 data_dir 中的 P_<pid>.jsonl 和 P_<pid>_status.json。
+        已有记录的参与者会被跳过 (可重复执行)；每位参与者在一个事务中导入。
+        """
+        summary = {"participants": 0, "records": 0, "skipped": 0}
+        conn = self._connect()
+        for name in sorted(os.listdir(data_dir)):
+            if not (name.startswith("P_") and name.endswith(".jsonl")):
+                continue
+            participant_id = name[len("P_"):-len(".jsonl")]
+            if conn.execute("SELECT 1 FROM records WHERE participant_id = ? LIMIT 1",
+                            (participant_id,)).fetchone():
+                summary["skipped"] += 1
+                continue
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                count = 0
+                with open(os.path.join(data_dir, name), 'r', encoding='utf-8') as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            print(f"⚠️ Skipping malformed line in {name}")
+                            continue
+                        self.append_record(record)
+                        count += 1
+
+                status_path = os.path.join(data_dir, f"P_{participant_id}_status.json")
+                if os.path.exists(status_path) and not self.get_status(participant_id):
+                    with open(status_path, 'r', encoding='utf-8') as f:
+                        self._save_status(conn, participant_id, json.load(f))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            summary["participants"] += 1
+            summary["records"] += count
+        return summary
+
+
+def _main():
+    import argparse
+    import sys
+    from backend.config import DATA_DIR, DATA_DB_PATH
+
+    parser = argparse.ArgumentParser(description="SQLite storage for participant records and status")
+    parser.add_argument("--db", default=DATA_DB_PATH, help="SQLite database path")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_import = sub.add_parser("import", help="Import JSONL records and status files")
+    p_import.add_argument("--data-dir", default=DATA_DIR)
+    sub.add_parser("progress", help="Show each participant's current step")
+    p_export = sub.add_parser("export", help="Export records as JSON Lines to stdout")
+    p_export.add_argument("--participant")
+    p_export.add_argument("--step")
+    args = parser.parse_args()
+
+    storage = SQLiteStorage(args.db)
+    if args.command == "import":
+        summary = storage.import_files(args.data_dir)
+        print(f"✅ Imported {summary['records']} records for {summary['participants']} participants "
+              f"({summary['skipped']} already present) into {args.db}")
+    elif args.command == "progress":
+        for row in storage.list_progress():
+            print(f"{row['participant_id']}\tstep={row['current_step_index']}\tcondition={row['condition']}")
+        print(f"📊 Participants per step index: {storage.count_by_step()}")
+    else:
+        for record in storage.get_records(args.participant, args.step):
+            sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    _main()
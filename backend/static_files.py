@@ -0,0 +1,160 @@
+# backend/static_files.py
+#
+# 静态文件 (assets/ 和 admin_setup.html) 的内存缓存：
+#   - 启动时读取文件，计算内容哈希 (ETag) 并预先生成 gzip / brotli 压缩版本；
+#   - If-None-Match 命中时返回 304，不再重发文件内容；
+#   - 带内容哈希的 URL (asset_url() 生成的 ?v=<hash>) 使用一年的 immutable 缓存，
+#     其余 URL 每次向服务器验证 (no-cache + ETag)。
+# brotli 为可选依赖 (pip install brotli)；未安装时只提供 gzip。
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import threading
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 内容可压缩的类型 (PNG 等图片本身已压缩，不再压缩)
+_COMPRESSIBLE_TYPES = ("text/", "image/svg+xml", "application/json", "application/manifest+json",
+                       "application/javascript", "image/x-icon", "image/vnd.microsoft.icon")
+# 压缩后至少节省这么多才保留压缩版本
+_MIN_COMPRESSION_RATIO = 0.9
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+
+
+class StaticAsset:
+    """一个静态文件：原始内容、压缩版本和 ETag"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.signature = _stat_signature(os.fstat(f.fileno()))
+            data = f.read()
+        self.mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        self.hash = hashlib.sha256(data).hexdigest()[:16]
+        # encoding -> (内容, ETag)；"identity" 为未压缩版本
+        self.variants = {"identity": (data, f'"{self.hash}"')}
+
+        if self.mimetype.startswith(_COMPRESSIBLE_TYPES):
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(compressed) < len(data) * _MIN_COMPRESSION_RATIO:
+                self.variants["gzip"] = (compressed, f'"{self.hash}-gz"')
+            if brotli is not None:
+                compressed = brotli.compress(data, quality=11)
+                if len(compressed) < len(data) * _MIN_COMPRESSION_RATIO:
+                    self.variants["br"] = (compressed, f'"{self.hash}-br"')
+        self.etags = frozenset(etag for _, etag in self.variants.values())
+
+    def select(self, accept_encoding: str) -> tuple:
+        """根据 Accept-Encoding 选择 (encoding, 内容, ETag)，优先 br，其次 gzip"""
+        if len(self.variants) > 1 and accept_encoding:
+            accepted = _parse_accept_encoding(accept_encoding)
+            for encoding in ("br", "gzip"):
+                if encoding in self.variants and encoding in accepted:
+                    return (encoding,) + self.variants[encoding]
+        return ("identity",) + self.variants["identity"]
+
+
+def _stat_signature(st: os.stat_result) -> tuple:
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def _parse_accept_encoding(header: str) -> set:
+    """返回客户端接受的编码 (忽略 q=0 的编码)"""
+    accepted = set()
+    for part in header.split(","):
+        encoding, _, params = part.strip().partition(";")
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+class StaticFileCache:
+    """某个目录下静态文件的缓存 (启动时全部载入内存)"""
+
+    def __init__(self, root: str, include=None, auto_reload: bool = False, max_file_size: int = 8 * 1024 * 1024):
+        self.root = os.path.abspath(root)
+        self.auto_reload = auto_reload  # 开发模式：文件修改后重新载入
+        self.max_file_size = max_file_size
+        self._assets = {}
+        self._lock = threading.Lock()
+
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, "/")
+                if include is None or name in include:
+                    self._load(name)
+
+    def _load(self, name: str):
+        path = os.path.join(self.root, name)
+        try:
+            if os.path.getsize(path) > self.max_file_size:
+                return None
+            asset = StaticAsset(path)
+        except OSError:
+            return None
+        with self._lock:
+            self._assets[name] = asset
+        return asset
+
+    def get(self, name: str):
+        """返回缓存的文件 (不存在或未缓存时返回 None)"""
+        asset = self._assets.get(name)
+        if asset is not None and self.auto_reload:
+            try:
+                if _stat_signature(os.stat(asset.path)) != asset.signature:
+                    asset = self._load(name)
+            except OSError:
+                with self._lock:
+                    self._assets.pop(name, None)
+                return None
+        return asset
+
+    def asset_url(self, url_prefix: str, name: str) -> str:
+        """带内容哈希的 URL (内容变化时 URL 随之变化，浏览器可以永久缓存)"""
+        asset = self.get(name)
+        if asset is None:
+            return f"{url_prefix}/{name}"
+        return f"{url_prefix}/{name}?v={asset.hash}"
+
+    def response(self, name: str, request):
+        """
+        生成静态文件的响应；文件未缓存时返回 None (由调用方回退到 send_from_directory)。
+        """
+        asset = self.get(name)
+        if asset is None:
+            return None
+
+        encoding, body, etag = asset.select(request.headers.get("Accept-Encoding", ""))
+        versioned = request.args.get("v") == asset.hash
+        headers = {
+            "ETag": etag,
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if versioned else REVALIDATE_CACHE_CONTROL,
+            "Vary": "Accept-Encoding",
+        }
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            if "*" in tags or tags & asset.etags:
+                return Response(status=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(body, mimetype=asset.mimetype, headers=headers)
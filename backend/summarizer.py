@@ -0,0 +1,69 @@
+# backend/summarizer.py
+
+import queue
+import threading
+
+
+class SummaryWorker:
+    """
+    后台摘要生成线程池。
+    - 按参与者合并请求：同一参与者排队中的旧请求会被最新的请求替换；
+    - 每个参与者同时最多只有一个摘要在生成；
+    - 调用方 (流式回复) 只负责投递请求，不会等待摘要完成。
+    """
+
+    def __init__(self, summarize_fn, num_threads: int = 1):
+        # summarize_fn(participant_id, job) 在后台线程中执行
+        self._summarize_fn = summarize_fn
+        self._lock = threading.Lock()
+        self._pending = {}  # participant_id -> 最新的 job (尚未开始)
+        self._in_flight = set()  # 正在生成摘要的 participant_id
+        self._ready = queue.Queue()  # 可以开始处理的 participant_id
+        self._threads = []
+        for i in range(num_threads):
+            t = threading.Thread(target=self._run, name=f"summary-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, participant_id: str, job: dict):
+        """投递摘要请求 (非阻塞)"""
+        with self._lock:
+            coalesced = participant_id in self._pending
+            self._pending[participant_id] = job
+            if not coalesced and participant_id not in self._in_flight:
+                self._ready.put(participant_id)
+        if coalesced:
+            print(f"🗜️ Summary request coalesced for PID {participant_id}")
+
+    def discard(self, participant_id: str):
+        """丢弃参与者尚未开始的摘要请求 (例如会话被清除时)"""
+        with self._lock:
+            self._pending.pop(participant_id, None)
+
+    def pending_count(self) -> int:
+        """排队中 (尚未开始) 和正在生成的摘要请求数"""
+        with self._lock:
+            return len(self._pending) + len(self._in_flight)
+
+    def _run(self):
+        while True:
+            participant_id = self._ready.get()
+            with self._lock:
+                # discard() 之后重新 submit 可能使同一参与者在队列中出现两次：
+                # 已有摘要在生成时跳过，生成结束后 finally 中会重新排队
+                if participant_id in self._in_flight:
+                    continue
+                job = self._pending.pop(participant_id, None)
+                if job is None:  # 已被 discard
+                    continue
+                self._in_flight.add(participant_id)
+            try:
+                self._summarize_fn(participant_id, job)
+            except Exception as e:
+                print(f"⚠️ Summary worker error for PID {participant_id}: {e}")
+            finally:
+                with self._lock:
+                    self._in_flight.discard(participant_id)
+                    # 生成期间又有新的请求：重新排队
+                    if participant_id in self._pending:
+                        self._ready.put(participant_id)
@@ -0,0 +1,51 @@
+# backend/token_counter.py
+#
+# 文本的 token 数。
+# 配置了离线分词器 (config.TOKENIZER_PATH，与模型相同的 qwen2.5 词表) 时使用真实分词结果，
+# 分词器在导入时只加载一次，结果按文本做 LRU 缓存 (同一条用户输入在回合记录和提示词预算中都会统计)。
+# 没有分词器时回退为按字符数估算 (英文偏高，中文等 CJK 文本明显偏低)。
+# 运行 python -m benchmarks.bench_token_counter 比较两种方式的耗时和误差。
+
+from functools import lru_cache
+
+from backend.config import TOKENIZER_PATH, TOKEN_COUNT_CACHE_SIZE
+
+try:
+    from tokenizers import Tokenizer
+except ImportError:
+    Tokenizer = None
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的 token 数 (假设一个字符平均 1/3 个 token)"""
+    return max(1, int(len(text.strip()) / 3))
+
+
+def _load_tokenizer(path: str):
+    if Tokenizer is None or not path:
+        return None
+    try:
+        tokenizer = Tokenizer.from_file(path)
+    except Exception as e:  # 文件不存在或格式错误
+        print(f"⚠️ Tokenizer not loaded from {path} ({e}); token counts are estimated from characters.")
+        return None
+    print(f"🔤 Tokenizer loaded from {path}")
+    return tokenizer
+
+
+_tokenizer = _load_tokenizer(TOKENIZER_PATH)
+
+# 回合记录中标注 token 数的来源: "tokenizer" 或 "estimate" (AI 回复另有 "eval_count")
+TOKEN_COUNT_METHOD = "tokenizer" if _tokenizer is not None else "estimate"
+
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def _count_with_tokenizer(text: str) -> int:
+    return max(1, len(_tokenizer.encode(text, add_special_tokens=False).ids))
+
+
+def count_tokens(text: str) -> int:
+    """文本的 token 数 (有分词器时为真实值，否则为估算值)"""
+    if _tokenizer is None:
+        return estimate_tokens(text)
+    return _count_with_tokenizer(text.strip())
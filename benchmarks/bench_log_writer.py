@@ -0,0 +1,98 @@
+# benchmarks/bench_log_writer.py
+#
+# 比较 JSONL 记录写入的吞吐量 (records/sec)：
+#   legacy:          每条记录 os.makedirs + open(append) + close (旧的 save_turn_data 路径)
+#   legacy+fsync:    同上，但每条记录 fsync (与 "always" 模式的持久化程度相同)
+#   writer/<mode>:   backend.log_writer.RecordWriter 的三种持久化模式
+#
+# 运行: python -m benchmarks.bench_log_writer [--records 5000] [--threads 8] [--participants 30]
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from backend.log_writer import RecordWriter, DURABILITY_MODES
+
+
+def _make_line(participant_id: str, i: int) -> str:
+    record = {
+        "timestamp": time.time(),
+        "datetime": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()),
+        "participant_id": participant_id,
+        "step": "DIALOGUE_TURN",
+        "data": {"turn": i, "condition": "XAI", "user_input_length_token": 12, "agent_response_length_token": 80}
+    }
+    return json.dumps(record, ensure_ascii=False)
+
+
+def _legacy_append(data_dir: str, participant_id: str, line: str, fsync: bool):
+    os.makedirs(data_dir, exist_ok=True)
+    with open(os.path.join(data_dir, f"P_{participant_id}.jsonl"), 'a', encoding='utf-8') as f:
+        f.write(line + '\n')
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def _run_threads(num_records: int, num_threads: int, num_participants: int, append):
+    per_thread = num_records // num_threads
+
+    def worker(t):
+        for i in range(per_thread):
+            participant_id = f"bench{(t * per_thread + i) % num_participants}"
+            append(participant_id, _make_line(participant_id, i))
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(num_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return per_thread * num_threads, start
+
+
+def bench_legacy(data_dir, num_records, num_threads, num_participants, fsync=False) -> float:
+    count, start = _run_threads(num_records, num_threads, num_participants,
+                                lambda pid, line: _legacy_append(data_dir, pid, line, fsync))
+    return count / (time.perf_counter() - start)
+
+
+def bench_writer(data_dir, num_records, num_threads, num_participants, durability) -> float:
+    writer = RecordWriter(durability=durability)
+    count, start = _run_threads(
+        num_records, num_threads, num_participants,
+        lambda pid, line: writer.append(os.path.join(data_dir, f"P_{pid}.jsonl"), line))
+    writer.close()  # 计入最后的写入和 fsync
+    return count / (time.perf_counter() - start)
+
+
+def run(num_records: int = 5000, num_threads: int = 8, num_participants: int = 30) -> dict:
+    """运行所有变体，返回 {名称: records/sec}"""
+    results = {}
+    root = tempfile.mkdtemp(prefix="bench_log_writer_")
+    try:
+        results["legacy"] = bench_legacy(os.path.join(root, "legacy"), num_records, num_threads, num_participants)
+        results["legacy+fsync"] = bench_legacy(os.path.join(root, "legacy_fsync"), num_records // 5,
+                                               num_threads, num_participants, fsync=True)
+        for mode in DURABILITY_MODES:
+            results[f"writer/{mode}"] = bench_writer(os.path.join(root, mode), num_records, num_threads,
+                                                     num_participants, mode)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="JSONL record writer throughput benchmark")
+    parser.add_argument("--records", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--participants", type=int, default=30)
+    args = parser.parse_args()
+
+    print(f"📊 {args.records} records, {args.threads} threads, {args.participants} participants")
+    for name, rate in run(args.records, args.threads, args.participants).items():
+        print(f"  {name:<16} {rate:>12,.0f} records/sec")
@@ -0,0 +1,96 @@
+# benchmarks/bench_stream.py
+#
+# 流式回复热循环的 CPU 开销 (微秒/token)，回复长度从 500 到 4000 token：
+#   legacy:  旧的循环 — 每行 json.loads、str += 累积回复、app 层 bytes += 再累积一次
+#   relay:   llm_service._relay_stream — 片段列表累积、orjson (可选) 解析、每个片段 encode 一次
+# 输入是内存中预先生成的 Ollama NDJSON 行 (不涉及网络)，只测量 CPU 开销。
+# 每 token 开销不随回复长度增长，说明没有二次方的拼接。
+#
+# 运行: python -m benchmarks.bench_stream [--tokens 500 1000 2000 4000] [--repeat 5]
+
+import argparse
+import json
+import time
+
+from backend import llm_service
+from backend.ollama_client import RequestTiming
+
+
+def make_lines(num_tokens: int) -> list:
+    """模拟 Ollama /api/generate 的流式输出 (每行一个 token，最后一行 done=true)"""
+    lines = [
+        json.dumps({"model": "qwen2.5:1.5b", "created_at": "2025-01-01T00:00:00Z",
+                    "response": " word" if i % 7 else " 情绪", "done": False}, ensure_ascii=False).encode("utf-8")
+        for i in range(num_tokens)
+    ]
+    lines.append(json.dumps({"model": "qwen2.5:1.5b", "response": "", "done": True,
+                             "context": list(range(num_tokens)), "eval_count": num_tokens}).encode("utf-8"))
+    return lines
+
+
+def legacy_loop(lines) -> str:
+    """旧实现：llm_service 中 str += 累积，app.chat 中 bytes += 再累积一次"""
+    full_ai_reply = ""
+    app_reply = b''
+    final_data = None
+    for line in lines:
+        if line:
+            try:
+                data = json.loads(line.decode("utf-8"))
+            except json.JSONDecodeError:
+                continue
+            text_chunk = data.get("response", "")
+            if text_chunk:
+                full_ai_reply += text_chunk
+                chunk = text_chunk.encode("utf-8")
+                app_reply += chunk
+            if data.get("done", False):
+                final_data = data
+    return full_ai_reply
+
+
+def relay_loop(lines) -> str:
+    """新实现：llm_service._relay_stream + app.chat 只记录是否有回复"""
+    state = llm_service._StreamState()
+    got_reply = False
+    for _ in llm_service._relay_stream(lines, RequestTiming(), state):
+        got_reply = True
+    return state.reply
+
+
+def bench(loop, lines, repeat: int) -> float:
+    """返回最快一次的 微秒/token"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        loop(lines)
+        best = min(best, time.perf_counter() - start)
+    return best / (len(lines) - 1) * 1e6
+
+
+def run(token_counts, repeat: int) -> dict:
+    results = {}
+    for num_tokens in token_counts:
+        lines = make_lines(num_tokens)
+        assert legacy_loop(lines) == relay_loop(lines)
+        results[num_tokens] = {
+            "legacy": bench(legacy_loop, lines, repeat),
+            "relay": bench(relay_loop, lines, repeat),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming hot loop microbenchmark")
+    parser.add_argument("--tokens", type=int, nargs="+", default=[500, 1000, 2000, 4000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    decoder = "orjson" if llm_service._json_loads is not json.loads else "json"
+    print(f"📊 Streaming hot loop (us/token, best of {args.repeat}, decoder: {decoder})")
+    for num_tokens, result in run(args.tokens, args.repeat).items():
+        print(f"  {num_tokens:>5} tokens   legacy {result['legacy']:6.2f}   relay {result['relay']:6.2f}")
+
+
+if __name__ == "__main__":
+    main()
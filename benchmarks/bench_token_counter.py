@@ -0,0 +1,87 @@
+# benchmarks/bench_token_counter.py
+#
+# 用户输入 token 计数的开销 (微秒/次) 和估算误差：
+#   estimate:  按字符数估算 (len / 3)
+#   tokenizer: 离线分词器，未命中缓存 (每条消息第一次统计)
+#   cached:    离线分词器，命中 LRU 缓存 (同一回合中再次统计同一条输入)
+# 输入是英文、中文和中英混合的典型用户消息。没有安装 tokenizers 或找不到 tokenizer.json 时只测量估算。
+#
+# 运行: python -m benchmarks.bench_token_counter [--tokenizer path/to/tokenizer.json] [--repeat 5]
+
+import argparse
+import time
+from functools import lru_cache
+
+from backend import token_counter
+from backend.config import TOKENIZER_PATH
+
+MESSAGES = {
+    "en": [
+        "I feel sad today.",
+        "Work has been really stressful lately and I can't seem to switch off when I get home in the evening.",
+        "My friend didn't reply to my messages for a week and I keep wondering if I did something wrong. "
+        "I know it's probably nothing, but it still bothers me a lot and I can't focus on anything else.",
+    ],
+    "zh": [
+        "我今天心情不太好。",
+        "最近工作压力很大，晚上回家以后也没办法放松下来，总是想着明天要做的事情。",
+        "我的朋友一个星期都没有回我的消息，我一直在想是不是我做错了什么。我知道可能没什么事，但还是很在意，什么都做不进去。",
+    ],
+    "mixed": [
+        "今天的 presentation 搞砸了，感觉很 down。",
+        "我和 roommate 因为 cleaning schedule 吵了一架，现在气氛很尴尬，不知道该怎么开口 apologize。",
+    ],
+}
+
+
+def bench(fn, texts, repeat: int, before=None) -> float:
+    """返回最快一次的 微秒/条"""
+    best = float("inf")
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        for text in texts:
+            fn(text)
+        best = min(best, time.perf_counter() - start)
+    return best / len(texts) * 1e6
+
+
+def run(tokenizer, repeat: int) -> dict:
+    results = {}
+    for language, texts in MESSAGES.items():
+        texts = texts * 20  # 每轮 40-60 次调用，减少计时误差
+        result = {"estimate_us": bench(token_counter.estimate_tokens, texts, repeat)}
+        if tokenizer is not None:
+            def count(text):
+                return len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+            cached = lru_cache(maxsize=token_counter.TOKEN_COUNT_CACHE_SIZE)(count)
+            result["tokenizer_us"] = bench(count, texts, repeat)
+            result["cached_us"] = bench(cached, texts, repeat, before=lambda: [cached(t) for t in texts])
+            errors = [token_counter.estimate_tokens(t) / count(t) - 1 for t in MESSAGES[language]]
+            result["estimate_error"] = sum(errors) / len(errors)  # 估算值相对真实值的平均偏差
+        results[language] = result
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Token counting microbenchmark")
+    parser.add_argument("--tokenizer", default=TOKENIZER_PATH, help="tokenizer.json (qwen2.5)")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    tokenizer = token_counter._load_tokenizer(args.tokenizer)
+    if tokenizer is None:
+        print("ℹ️ No tokenizer available (pip install tokenizers, see TOKENIZER_PATH); measuring the estimate only")
+    print(f"📊 Token counting (us/message, best of {args.repeat})")
+    for language, result in run(tokenizer, args.repeat).items():
+        line = f"  {language:>5}   estimate {result['estimate_us']:6.2f}"
+        if "tokenizer_us" in result:
+            line += (f"   tokenizer {result['tokenizer_us']:7.2f}   cached {result['cached_us']:6.2f}"
+                     f"   estimate error {result['estimate_error']:+.0%}")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# benchmarks/suite.py
+#
+# 请求热路径的微基准套件 (离线运行，不需要 Ollama)：
+#   - data_manager: get_participant_status (缓存命中 / 未命中)、update_participant_step、
+#     save_participant_data、save_turn_data (使用 config 中的存储后端和持久化模式)
+#   - render_template_page: 每个页面模板 (跳过页面缓存，测量真实渲染) 以及页面缓存命中
+#     (都包含 test_request_context 的固定开销，可用页面缓存命中一项作为参照)
+#   - get_localization_for_page: 每个本地化模块
+#   - 提示词构建 (get_llm_response_stream 发送请求前的 _prepare_turn)，历史长度递增
+#   - calculate_text_metrics: 短 / 长 / 中文文本
+# 数据写入临时目录，不影响 data/。结果 (每项的中位数、p90 等，单位微秒) 保存为 JSON，
+# 与之前保存的基线比较时，中位数变慢超过阈值的项目标记为回归 (退出码 1)。
+#
+# 运行: python -m benchmarks.suite [--out results.json] [--baseline baseline.json] [--threshold 0.15]
+#                                  [--repeat 200] [--filter render]
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from backend import config
+
+SAMPLE_TEXTS = {
+    "short": "I feel sad today.",
+    "long": "Work has been really stressful lately and I can't seem to switch off when I get home. " * 8,
+    "cjk": "最近工作压力很大，晚上回家以后也没办法放松下来，总是想着明天要做的事情。" * 4,
+}
+HISTORY_SIZES = (0, 10, 50, 200)
+
+
+def _use_scratch_data_dir() -> str:
+    """在导入 data_manager / app 之前把所有数据路径指向临时目录"""
+    data_dir = tempfile.mkdtemp(prefix="bench_suite_")
+    config.DATA_DIR = data_dir
+    config.DATA_DB_PATH = os.path.join(data_dir, "experiment.sqlite3")
+    config.SESSION_STORE_PATH = os.path.join(data_dir, "llm_sessions.sqlite3")
+    return data_dir
+
+
+# 没有 setup 的基准每个样本连续调用多次，使样本至少持续这么久 (减少计时器误差)
+_MIN_SAMPLE_S = 0.0002
+
+
+def _calibrate(fn) -> int:
+    number = 1
+    while number < 100000:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if time.perf_counter() - start >= _MIN_SAMPLE_S:
+            break
+        number *= 2
+    return number
+
+
+def measure(fn, repeat: int, setup=None, warmup: int = 5) -> dict:
+    """
+    计时 fn() 并返回每次调用的微秒统计。
+    有 setup 时每个样本只调用一次 (setup 不计时)；否则每个样本连续调用 number 次取平均。
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        fn()
+    number = 1 if setup is not None else _calibrate(fn)
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) * 1e6 / number)
+    samples.sort()
+    return {
+        "runs": repeat,
+        "number": number,
+        "median_us": round(samples[len(samples) // 2], 3),
+        "p90_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.9))], 3),
+        "min_us": round(samples[0], 3),
+        "mean_us": round(sum(samples) / len(samples), 3),
+    }
+
+
+def collect_benchmarks() -> dict:
+    """name -> (fn, setup)；在这里导入 backend，保证使用临时数据目录"""
+    from backend import app as app_module
+    from backend import data_manager, llm_service
+    from backend.localization import LOCALIZATION_STRINGS, get_localization_for_page
+    from backend.routing import ROUTES
+
+    app = app_module.app
+    benchmarks = {}
+
+    # --- data_manager ---
+    pid = "BENCH_DM"
+    data_manager.init_participant_session(pid, "AB", "en")
+    step = {"index": 0}
+
+    def next_step():
+        step["index"] = (step["index"] + 1) % len(config.EXPERIMENT_STEPS)
+        data_manager.update_participant_step(pid, step["index"])
+
+    turn_data = {"user_id": pid, "condition": "XAI", "turn": 1, "session_part": 1,
+                 "user_input_length_token": 5, "agent_response_length_token": 60, "llm_stats": {"ttft_ms": 300.0}}
+    benchmarks["data_manager.get_participant_status[cached]"] = (
+        lambda: data_manager.get_participant_status(pid), None)
+    benchmarks["data_manager.get_participant_status[uncached]"] = (
+        lambda: data_manager.get_participant_status(pid), lambda: data_manager._status_cache.pop(pid, None))
+    benchmarks["data_manager.update_participant_step"] = (next_step, None)
+    benchmarks["data_manager.save_participant_data"] = (
+        lambda: data_manager.save_participant_data(pid, "BASELINE_MOOD", {"valence": 5, "arousal": 3}), None)
+    benchmarks["data_manager.save_turn_data"] = (lambda: data_manager.save_turn_data(pid, turn_data), None)
+
+    # --- render_template_page (每个模板，参与者处于对应步骤) ---
+    pages = {("index.html", "consent", -1, "CONSENT_AGREEMENT")}
+    for index in range(len(config.EXPERIMENT_STEPS)):
+        for condition in ROUTES.conditions:
+            route = ROUTES.route(index, condition)
+            pages.add((route.filename, route.module, route.index, route.step_key))
+    render_pid = "BENCH_RENDER"
+    data_manager.init_participant_session(render_pid, "AB", "en")
+
+    def render(filename, module, index, step_key):
+        context = {"current_step_index": index, "current_step_name": step_key}
+        if module == "post_questionnaire":
+            context["is_xai_condition"] = True
+        elif step_key == "WASHOUT":
+            context["washout_seconds"] = config.WASHOUT_SECONDS
+        with app.test_request_context(f"/html/{filename}?pid={render_pid}"):
+            return app_module.render_template_page(filename, module, render_pid, context=context)
+
+    for page in sorted(pages):
+        benchmarks[f"render_template_page[{page[0]}]"] = (
+            lambda page=page: render(*page), app_module.page_cache.clear)
+    first_page = sorted(pages)[0]
+    benchmarks["render_template_page[page cache hit]"] = (lambda: render(*first_page), None)
+
+    # --- localization ---
+    for module in sorted(LOCALIZATION_STRINGS):
+        benchmarks[f"get_localization_for_page[{module}]"] = (
+            lambda module=module: get_localization_for_page(module, "en"), None)
+
+    # --- 提示词构建 (历史长度递增；每次计时前恢复到相同的历史) ---
+    for size in HISTORY_SIZES:
+        prompt_pid = f"BENCH_PROMPT_{size}"
+        history = []
+        for i in range(size):
+            role = "user" if i % 2 == 0 else "ai"
+            content = SAMPLE_TEXTS["short"] if role == "user" else SAMPLE_TEXTS["long"][:300]
+            history.append({"role": role, "content": content, "tokens": app_module.count_tokens(content)})
+
+        def reset(prompt_pid=prompt_pid, history=history):
+            def apply(session):
+                session['history'] = list(history)
+                session['summary'] = "The participant talked about stress at work." if history else ""
+                session['summary_tokens'] = 20 if history else 0
+                session['context'] = None
+            llm_service.session_store.update(prompt_pid, apply)
+
+        benchmarks[f"llm_service._prepare_turn[history={size}]"] = (
+            lambda prompt_pid=prompt_pid: llm_service._prepare_turn(prompt_pid, SAMPLE_TEXTS["short"]), reset)
+
+    # --- calculate_text_metrics ---
+    for name, text in SAMPLE_TEXTS.items():
+        benchmarks[f"calculate_text_metrics[{name}]"] = (
+            lambda text=text: app_module.calculate_text_metrics(text), None)
+    return benchmarks
+
+
+def run(repeat: int, name_filter: str = None) -> dict:
+    data_dir = _use_scratch_data_dir()
+    results = {}
+    try:
+        # 被测函数会打印日志 (保存成功、提示词等)，计时期间丢弃输出
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            benchmarks = collect_benchmarks()
+            for name, (fn, setup) in benchmarks.items():
+                if name_filter and name_filter not in name:
+                    continue
+                results[name] = measure(fn, repeat, setup)
+            from backend import data_manager
+            data_manager.flush_records()
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": repeat,
+            "data_backend": config.DATA_BACKEND,
+            "log_durability": config.LOG_DURABILITY,
+            "log_turn_durability": config.LOG_TURN_DURABILITY,
+        },
+        "results": results,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> dict:
+    """name -> (基线中位数, 当前中位数, 变化比例, "regression" / "improvement" / "ok")"""
+    comparison = {}
+    for name, stats in results["results"].items():
+        base = baseline.get("results", {}).get(name)
+        if base is None or not base.get("median_us"):
+            continue
+        change = stats["median_us"] / base["median_us"] - 1
+        verdict = "regression" if change > threshold else "improvement" if change < -threshold else "ok"
+        comparison[name] = (base["median_us"], stats["median_us"], change, verdict)
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark suite for the request hot paths")
+    parser.add_argument("--repeat", type=int, default=200, help="timed runs per benchmark")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare the medians against a previous results JSON")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="relative slowdown of the median reported as a regression")
+    args = parser.parse_args()
+
+    results = run(args.repeat, args.filter)
+    comparison = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            comparison = compare(results, json.load(f), args.threshold)
+
+    print(f"📊 Benchmark suite (us per call, {args.repeat} runs, "
+          f"{results['meta']['data_backend']} backend, durability {results['meta']['log_durability']})")
+    marks = {"regression": "🔺", "improvement": "🟢", "ok": "  "}
+    for name, stats in results["results"].items():
+        line = f"  {name:<58} median {stats['median_us']:10.2f}   p90 {stats['p90_us']:10.2f}"
+        if name in comparison:
+            base, _, change, verdict = comparison[name]
+            line += f"   baseline {base:10.2f}  {change:+7.1%} {marks[verdict]}"
+        print(line)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"💾 Results written to {args.out}")
+
+    regressions = [name for name, (_, _, _, verdict) in comparison.items() if verdict == "regression"]
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s) over {args.threshold:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
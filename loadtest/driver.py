@@ -0,0 +1,258 @@
+# loadtest/driver.py
+#
+# 端到端压力测试：N 个模拟参与者同时走完整个实验流程 (EXPERIMENT_STEPS)：
+#   /start_experiment → index.html → 每一步的 HTML 页面 → /save_data
+#   → 对话步骤中的多轮 /chat 和 /end_dialogue → washout (等待缩短后的计时) → debrief
+# 报告每个路由的 p50 / p95 / p99 延迟和错误率，以及 /chat 的首 token 延迟 (TTFT)。
+#
+# 准备 (三个终端)：
+#   python -m loadtest.mock_ollama --ttft-ms 300 --tokens-per-sec 40
+#   OLLAMA_API_URL=http://127.0.0.1:11434/api/generate WASHOUT_SECONDS=5 DATA_DIR=/tmp/loadtest-data python -m backend.asgi
+#   python -m loadtest.driver --participants 30 --turns 5 --washout-seconds 5 [--json results.json]
+# 注意：压测会在服务器的 DATA_DIR 中写入 LT_* 参与者的数据 (用环境变量 DATA_DIR 指向临时目录)。
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+
+import requests
+
+from backend.config import EXPERIMENT_STEPS
+
+_MESSAGES = (
+    "I feel a bit stressed about my exams this week.",
+    "My friend didn't reply to my messages and I keep wondering why.",
+    "Work has been really tiring lately and I can't switch off.",
+    "今天心情不太好，感觉什么都做不好。",
+    "I had an argument with my roommate about cleaning.",
+    "Thanks, that actually helps a little.",
+)
+
+
+class Recorder:
+    """按路由收集延迟 (毫秒) 和错误 (线程安全)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}  # route -> [毫秒, ...] (成功的请求)
+        self.errors = {}   # route -> 错误数
+        self.error_examples = {}  # route -> 第一个错误的描述
+
+    def add(self, route: str, elapsed_ms: float, error: str = None):
+        with self._lock:
+            if error is None:
+                self.samples.setdefault(route, []).append(elapsed_ms)
+            else:
+                self.errors[route] = self.errors.get(route, 0) + 1
+                self.error_examples.setdefault(route, error)
+
+    def report(self) -> dict:
+        with self._lock:
+            routes = sorted(set(self.samples) | set(self.errors))
+            return {route: summarize(self.samples.get(route, []), self.errors.get(route, 0)) for route in routes}
+
+
+def percentile(sorted_values: list, q: float):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+def summarize(values: list, errors: int) -> dict:
+    values = sorted(values)
+    total = len(values) + errors
+    return {
+        "count": total,
+        "errors": errors,
+        "error_rate": errors / total if total else 0.0,
+        "p50_ms": percentile(values, 0.50),
+        "p95_ms": percentile(values, 0.95),
+        "p99_ms": percentile(values, 0.99),
+        "max_ms": values[-1] if values else None,
+    }
+
+
+class Participant:
+    """一个模拟参与者：独立的 HTTP 会话 (keep-alive)，按顺序完成所有步骤"""
+
+    def __init__(self, base_url: str, recorder: Recorder, args, index: int):
+        self.base_url = base_url.rstrip("/")
+        self.recorder = recorder
+        self.args = args
+        self.pid = f"LT_{uuid.uuid4().hex[:8]}_{index}"
+        self.condition_order = "AB" if index % 2 == 0 else "BA"
+        self.http = requests.Session()
+        self.next_url = None
+
+    def _request(self, route: str, method: str, path: str, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, timeout=self.args.timeout, **kwargs)
+        except requests.RequestException as e:
+            self.recorder.add(route, 0, f"{type(e).__name__}: {e}")
+            raise
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if response.status_code >= 400:
+            self.recorder.add(route, elapsed_ms, f"HTTP {response.status_code}: {response.text[:200]}")
+            raise RuntimeError(f"{route} returned HTTP {response.status_code}")
+        self.recorder.add(route, elapsed_ms)
+        return response
+
+    def think(self):
+        if self.args.think_ms:
+            time.sleep(random.uniform(0.5, 1.5) * self.args.think_ms / 1000)
+
+    def get_page(self, url: str):
+        # 路由按页面文件名区分 (去掉 ?pid=...)
+        self._request("GET " + url.split("?", 1)[0], "GET", url)
+
+    def save(self, step_name: str, step_index: int, data: dict = None):
+        response = self._request("POST /save_data", "POST", "/save_data", json={
+            "participant_id": self.pid, "step_name": step_name,
+            "data": data or {"loadtest": True}, "current_step_index": step_index,
+        })
+        self.next_url = response.json()["next_url"]
+        self.get_page(self.next_url)
+
+    def chat(self):
+        message = random.choice(_MESSAGES)
+        start = time.perf_counter()
+        try:
+            with self.http.post(self.base_url + "/chat", json={"participant_id": self.pid, "message": message},
+                                stream=True, timeout=self.args.timeout) as response:
+                if response.status_code >= 400:
+                    raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+                first_chunk = None
+                body = []
+                for chunk in response.iter_content(chunk_size=None):
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter()
+                    body.append(chunk)
+        except (requests.RequestException, RuntimeError) as e:
+            self.recorder.add("POST /chat", (time.perf_counter() - start) * 1000, f"{type(e).__name__}: {e}")
+            return
+        end = time.perf_counter()
+        reply = b"".join(body).decode("utf-8", errors="replace")
+        if first_chunk is None or "⚠️" in reply:
+            # 流式回复已经开始 (200)，后端错误以 ⚠️ 文本的形式出现在回复中
+            self.recorder.add("POST /chat", (end - start) * 1000, f"backend error in reply: {reply[-200:]!r}")
+            return
+        self.recorder.add("POST /chat", (end - start) * 1000)
+        self.recorder.add("/chat TTFT", (first_chunk - start) * 1000)
+
+    def dialogue(self):
+        for _ in range(self.args.turns):
+            self.think()
+            self.chat()
+        response = self._request("POST /end_dialogue", "POST", "/end_dialogue", json={"participant_id": self.pid})
+        self.next_url = response.json()["next_url"]
+        self.get_page(self.next_url)
+
+    def run(self) -> bool:
+        """完成整个流程，返回是否成功到达 debrief"""
+        try:
+            self._request("POST /start_experiment", "POST", "/start_experiment",
+                          json={"participant_id": self.pid, "condition_order": self.condition_order})
+            self.get_page(f"/index.html?pid={self.pid}")
+            self.save("CONSENT", -1)
+
+            for index, step in enumerate(EXPERIMENT_STEPS):
+                if step == "DEBRIEF":
+                    break
+                self.think()
+                if step.startswith("DIALOGUE"):
+                    self.dialogue()
+                elif step == "WASHOUT":
+                    # 服务器拒绝提前提交；等待服务器的 WASHOUT_SECONDS (压测时缩短)
+                    time.sleep(self.args.washout_seconds + 0.2)
+                    self.save(step, index)
+                else:
+                    self.save(step, index)
+            return self.next_url is not None and "debrief" in self.next_url
+        except Exception as e:
+            print(f"⚠️ Participant {self.pid} stopped: {e}")
+            return False
+        finally:
+            self.http.close()
+
+
+def run_load(base_url: str, args) -> dict:
+    recorder = Recorder()
+    results = []
+    results_lock = threading.Lock()
+
+    def worker(index: int):
+        ok = Participant(base_url, recorder, args, index).run()
+        with results_lock:
+            results.append(ok)
+
+    threads = []
+    start = time.perf_counter()
+    for i in range(args.participants):
+        t = threading.Thread(target=worker, args=(i,), name=f"participant-{i}", daemon=True)
+        t.start()
+        threads.append(t)
+        if args.ramp_s:
+            time.sleep(args.ramp_s / args.participants)  # 参与者在 ramp 时间内陆续开始
+    for t in threads:
+        t.join()
+    wall_s = time.perf_counter() - start
+
+    routes = recorder.report()
+    # TTFT 是 /chat 请求的一部分，不单独计为请求
+    total = sum(stats["count"] for route, stats in routes.items() if route != "/chat TTFT")
+    errors = sum(stats["errors"] for stats in routes.values())
+    return {
+        "participants": args.participants,
+        "completed": sum(results),
+        "turns_per_dialogue": args.turns,
+        "wall_s": round(wall_s, 2),
+        "requests": total,
+        "error_rate": errors / total if total else 0.0,
+        "routes": routes,
+        "error_examples": recorder.error_examples,
+    }
+
+
+def print_report(report: dict):
+    def fmt(value):
+        return f"{value:8.1f}" if value is not None else "       -"
+
+    print(f"\n📊 {report['completed']}/{report['participants']} participants completed the flow "
+          f"in {report['wall_s']}s ({report['requests']} requests, error rate {report['error_rate']:.2%})")
+    print(f"  {'route':<42} {'count':>6} {'err%':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for route, stats in report["routes"].items():
+        print(f"  {route:<42} {stats['count']:>6} {stats['error_rate']:>6.1%} {fmt(stats['p50_ms'])} "
+              f"{fmt(stats['p95_ms'])} {fmt(stats['p99_ms'])} {fmt(stats['max_ms'])}")
+    for route, example in report["error_examples"].items():
+        print(f"  ❌ {route}: {example}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end load test of the experiment flow")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5000")
+    parser.add_argument("--participants", type=int, default=10, help="simultaneous participants")
+    parser.add_argument("--turns", type=int, default=5, help="chat turns per dialogue part")
+    parser.add_argument("--think-ms", type=float, default=500, help="average pause between actions")
+    parser.add_argument("--ramp-s", type=float, default=0, help="spread participant starts over this many seconds")
+    parser.add_argument("--washout-seconds", type=float, default=5,
+                        help="must match the server's WASHOUT_SECONDS environment variable")
+    parser.add_argument("--timeout", type=float, default=120, help="per-request timeout (seconds)")
+    parser.add_argument("--json", help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    print(f"🚦 {args.participants} participants x {len(EXPERIMENT_STEPS)} steps, {args.turns} turns per dialogue "
+          f"against {args.base_url}")
+    report = run_load(args.base_url, args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"💾 Report written to {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# loadtest/mock_ollama.py
+#
+# Ollama /api/generate 的本地替身 (只用标准库)，用于在没有 GPU / 模型的机器上压力测试服务器：
+#   - stream=true 时按 NDJSON 流式返回，可配置首 token 延迟 (TTFT)、生成速度 (token/s) 和回复长度；
+#   - stream=false (摘要请求) 在模拟的生成时间后一次性返回；
+#   - 最后一行与真实 Ollama 相同，带 context、prompt_eval_count、eval_count 和各项耗时 (纳秒)；
+#   - 故障注入：按比例返回 HTTP 500，或在流中途断开连接。
+# 每个请求一个线程，模拟的是 "模型足够快地并行服务所有请求"，压测结果反映的是本服务器的开销和排队。
+#
+# 运行: python -m loadtest.mock_ollama [--port 11434] [--ttft-ms 300] [--tokens-per-sec 40] [--reply-tokens 60]
+#                                      [--fail-rate 0.0] [--drop-rate 0.0]
+# 服务器使用: OLLAMA_API_URL=http://127.0.0.1:11434/api/generate python -m backend.asgi
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_WORDS = ("I", "hear", "you", "that", "sounds", "really", "hard", "and", "it", "makes", "sense", "to", "feel",
+          "this", "way", "would", "you", "like", "to", "talk", "more", "about", "what", "happened", "today")
+
+
+class MockSettings:
+    def __init__(self, ttft_ms: float = 300, tokens_per_sec: float = 40, reply_tokens: int = 60,
+                 jitter: float = 0.2, fail_rate: float = 0.0, drop_rate: float = 0.0, cold_load_ms: float = 0,
+                 model: str = "qwen2.5:1.5b"):
+        self.ttft_ms = ttft_ms
+        self.tokens_per_sec = tokens_per_sec
+        self.reply_tokens = reply_tokens
+        self.jitter = jitter  # 延迟和回复长度的随机波动比例
+        self.fail_rate = fail_rate
+        self.drop_rate = drop_rate
+        self.cold_load_ms = cold_load_ms  # 第一个请求额外的模型加载时间
+        self.model = model
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def vary(self, value: float) -> float:
+        return value * random.uniform(1 - self.jitter, 1 + self.jitter) if self.jitter else value
+
+    def take_load_ms(self) -> float:
+        """第一次调用返回冷启动时间，之后返回 0"""
+        with self._lock:
+            if self._loaded:
+                return 0.0
+            self._loaded = True
+            return self.cold_load_ms
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    settings = MockSettings()
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status: int, obj: dict):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_chunk(self, data: bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            self._send_json(200, {"models": [{"name": self.settings.model}]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path != "/api/generate":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "invalid JSON"})
+            return
+
+        settings = self.settings
+        if random.random() < settings.fail_rate:
+            self._send_json(500, {"error": "mock failure (injected)"})
+            return
+
+        start = time.perf_counter()
+        load_ms = settings.take_load_ms()
+        prompt_tokens = max(1, len(body.get("prompt", "").split()))
+        reply_tokens = max(1, int(settings.vary(settings.reply_tokens)))
+        token_interval = 1.0 / settings.tokens_per_sec
+        time.sleep((load_ms + settings.vary(settings.ttft_ms)) / 1000)
+        prompt_done = time.perf_counter()
+
+        words = [random.choice(_WORDS) for _ in range(reply_tokens)]
+        if not body.get("stream"):
+            time.sleep(reply_tokens * token_interval)
+            self._send_json(200, self._final(body, " ".join(words), start, prompt_done, load_ms,
+                                             prompt_tokens, reply_tokens))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        drop_at = random.randrange(reply_tokens) if random.random() < settings.drop_rate else None
+        next_at = time.perf_counter()
+        for i, word in enumerate(words):
+            if i == drop_at:
+                self.close_connection = True
+                self.connection.shutdown(2)  # 模拟 Ollama 崩溃 / 网络中断 (没有结束块)
+                return
+            chunk = {"model": settings.model, "response": word if i == 0 else " " + word, "done": False}
+            self._write_chunk((json.dumps(chunk) + "\n").encode("utf-8"))
+            next_at += token_interval
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+        final = self._final(body, "", start, prompt_done, load_ms, prompt_tokens, reply_tokens)
+        self._write_chunk((json.dumps(final) + "\n").encode("utf-8"))
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _final(self, body: dict, response: str, start: float, prompt_done: float, load_ms: float,
+               prompt_tokens: int, reply_tokens: int) -> dict:
+        end = time.perf_counter()
+        context = list(body.get("context") or []) + list(range(prompt_tokens + reply_tokens))
+        return {
+            "model": self.settings.model,
+            "response": response,
+            "done": True,
+            "context": context,
+            "total_duration": int((end - start) * 1e9),
+            "load_duration": int(load_ms * 1e6),
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(max(0.0, prompt_done - start - load_ms / 1000) * 1e9),
+            "eval_count": reply_tokens,
+            "eval_duration": int((end - prompt_done) * 1e9),
+        }
+
+
+class MockOllamaServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024  # 大量参与者同时连接时不拒绝连接
+
+
+def make_server(host: str, port: int, settings: MockSettings) -> MockOllamaServer:
+    handler = type("ConfiguredMockOllamaHandler", (MockOllamaHandler,), {"settings": settings})
+    return MockOllamaServer((host, port), handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for Ollama's /api/generate")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--ttft-ms", type=float, default=300, help="time to first token (prompt eval)")
+    parser.add_argument("--tokens-per-sec", type=float, default=40, help="generation speed per request")
+    parser.add_argument("--reply-tokens", type=int, default=60, help="average reply length")
+    parser.add_argument("--jitter", type=float, default=0.2, help="random +/- fraction on TTFT and length")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fraction of requests answered with HTTP 500")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="fraction of streams cut off mid-reply")
+    parser.add_argument("--cold-load-ms", type=float, default=0, help="extra load time on the first request")
+    args = parser.parse_args()
+
+    settings = MockSettings(args.ttft_ms, args.tokens_per_sec, args.reply_tokens, args.jitter,
+                            args.fail_rate, args.drop_rate, args.cold_load_ms)
+    server = make_server(args.host, args.port, settings)
+    print(f"🧪 Mock Ollama on http://{args.host}:{args.port}/api/generate "
+          f"(TTFT {args.ttft_ms}ms, {args.tokens_per_sec} tok/s, {args.reply_tokens} tokens, "
+          f"fail {args.fail_rate:.0%}, drop {args.drop_rate:.0%})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# tests/test_summarizer.py
+
+import threading
+import time
+
+from backend.summarizer import SummaryWorker
+
+
+def _wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_discard_then_resubmit_runs_one_summary_at_a_time():
+    gates = {pid: threading.Event() for pid in ("A", "B", "C")}
+    started = {pid: threading.Event() for pid in ("A", "B", "C")}
+    lock = threading.Lock()
+    running = {"A": 0}
+    max_running = {"A": 0}
+    jobs_run = []
+
+    def summarize(participant_id, job):
+        if participant_id == "A":
+            with lock:
+                running["A"] += 1
+                max_running["A"] = max(max_running["A"], running["A"])
+                jobs_run.append(job["n"])
+        started[participant_id].set()
+        gates[participant_id].wait(5)
+        if participant_id == "A":
+            with lock:
+                running["A"] -= 1
+
+    worker = SummaryWorker(summarize, num_threads=2)
+    # 两个线程都被占用，A 的请求只能排队
+    worker.submit("B", {"n": 0})
+    worker.submit("C", {"n": 0})
+    assert started["B"].wait(5) and started["C"].wait(5)
+
+    # discard 后重新 submit：A 在队列中出现两次
+    worker.submit("A", {"n": 1})
+    worker.discard("A")
+    worker.submit("A", {"n": 1})
+
+    gates["B"].set()  # 第一个线程取出 A 并开始生成
+    assert started["A"].wait(5)
+    worker.submit("A", {"n": 2})  # 生成期间的新请求进入 _pending
+    gates["C"].set()  # 第二个线程取出队列中重复的 A
+    time.sleep(0.2)
+    assert max_running["A"] == 1
+
+    gates["A"].set()
+    _wait_until(lambda: worker.pending_count() == 0)
+    assert jobs_run == [1, 2]
+    assert max_running["A"] == 1